@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : browser_pool.py
+@Software: PyCharm
+@Description: Worker内的浏览器池，复用已启动并已登录的Chrome会话
+"""
+import os
+import time
+import logging
+import threading
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# 浏览器池配置
+BROWSER_POOL_MAX_IDLE = int(os.environ.get('BROWSER_POOL_MAX_IDLE', 4))  # 每个池最多保留的空闲浏览器数
+BROWSER_MAX_PAGES = int(os.environ.get('BROWSER_MAX_PAGES', 50))  # 浏览器处理多少个页面后回收
+BROWSER_MAX_RSS_MB = int(os.environ.get('BROWSER_MAX_RSS_MB', 1536))  # 浏览器进程树内存超过该值后回收
+BROWSER_MAX_IDLE_SECONDS = int(os.environ.get('BROWSER_MAX_IDLE_SECONDS', 1800))  # 空闲超过该时长的浏览器在取用时回收
+
+
+class BrowserLoginError(Exception):
+    """池中浏览器登录失败"""
+
+
+class PooledBrowser:
+    """池中的一个浏览器会话"""
+
+    def __init__(self, driver, account, user_id):
+        self.driver = driver
+        self.account = account
+        self.user_id = user_id
+        self.pages_served = 0
+        self.created_at = time.time()
+        self.last_used_at = time.time()
+
+    def rss_mb(self):
+        """浏览器进程及其子进程占用的内存（MB），无法获取时返回0"""
+        pid = getattr(self.driver, 'browser_pid', None)
+        if not pid:
+            return 0
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+            total = 0
+            for p in processes:
+                try:
+                    total += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            return total / 1024 / 1024
+        except psutil.Error:
+            return 0
+
+    def info(self):
+        return {
+            'account': self.account,
+            'user_id': self.user_id,
+            'pages_served': self.pages_served,
+            'age_seconds': int(time.time() - self.created_at),
+            'idle_seconds': int(time.time() - self.last_used_at),
+        }
+
+
+class BrowserPool:
+    """
+    按账号分组的浏览器池
+
+    - checkout 优先取出同一账号下健康的空闲浏览器，没有时启动新浏览器并登录
+    - checkin 归还浏览器，处理页面数或内存超过阈值、或空闲数已满时直接关闭
+    - 池只限制空闲浏览器的数量，同时运行的浏览器数由调用方（调度器槽位）控制
+
+    Args:
+        name: 池名称，用于日志
+        driver_factory: 无参函数，返回新的WebDriver
+        login: login(driver, account) -> 用户标识，登录失败时返回假值或抛出异常
+        session_cookie: 登录态cookie名，取出浏览器时检查该cookie是否仍然存在
+        reset: reset(driver)，归还时恢复调用方对浏览器所做的会话级设置
+    """
+
+    def __init__(self, name, driver_factory, login, session_cookie=None, reset=None, max_idle=BROWSER_POOL_MAX_IDLE,
+                 max_pages=BROWSER_MAX_PAGES, max_rss_mb=BROWSER_MAX_RSS_MB, max_idle_seconds=BROWSER_MAX_IDLE_SECONDS):
+        self.name = name
+        self.driver_factory = driver_factory
+        self.login = login
+        self.session_cookie = session_cookie
+        self.reset = reset
+        self.max_idle = max_idle
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.max_idle_seconds = max_idle_seconds
+        self._lock = threading.Lock()
+        self._idle = []  # 空闲浏览器，越靠后越新
+        self._in_use = set()
+        self._closed = False
+
+    def checkout(self, account=None):
+        """取出一个已登录 account 的浏览器，account为None时使用任意可用的本地cookies登录"""
+        while True:
+            with self._lock:
+                browser = None
+                for candidate in reversed(self._idle):
+                    if candidate.account == account:
+                        browser = candidate
+                        break
+                if browser is None:
+                    break
+                self._idle.remove(browser)
+
+            if self._is_healthy(browser):
+                with self._lock:
+                    self._in_use.add(browser)
+                browser.last_used_at = time.time()
+                logger.info(f"[{self.name}] 复用浏览器，账号: {account}，已处理页面: {browser.pages_served}")
+                return browser
+            self._quit(browser, "健康检查未通过")
+
+        browser = self._launch(account)
+        with self._lock:
+            self._in_use.add(browser)
+        return browser
+
+    def checkin(self, browser, pages=1, discard=False):
+        """
+        归还浏览器
+
+        Args:
+            pages: 本次使用中处理的页面数
+            discard: 为True时直接关闭（浏览器状态不可信时使用）
+        """
+        with self._lock:
+            self._in_use.discard(browser)
+        browser.pages_served += pages
+        browser.last_used_at = time.time()
+
+        reason = None
+        if discard:
+            reason = "调用方要求丢弃"
+        elif self._closed:
+            reason = "浏览器池已关闭"
+        elif browser.pages_served >= self.max_pages:
+            reason = f"已处理 {browser.pages_served} 个页面"
+        else:
+            rss_mb = browser.rss_mb()
+            if rss_mb >= self.max_rss_mb:
+                reason = f"内存占用 {rss_mb:.0f}MB"
+        if reason:
+            self._quit(browser, reason)
+            return
+
+        try:
+            if self.reset:
+                self.reset(browser.driver)
+            # 离开当前页面，停止视频播放并释放页面内存
+            browser.driver.get('about:blank')
+        except Exception as e:
+            self._quit(browser, f"重置页面失败: {str(e)}")
+            return
+
+        evicted = None
+        with self._lock:
+            self._idle.append(browser)
+            if len(self._idle) > self.max_idle:
+                evicted = self._idle.pop(0)
+        if evicted:
+            self._quit(evicted, "空闲浏览器数已满")
+
+    def warm(self, account=None, count=1):
+        """预先启动 count 个已登录的浏览器放入池中"""
+        for _ in range(count):
+            try:
+                browser = self._launch(account)
+            except Exception as e:
+                logger.error(f"[{self.name}] 预热浏览器失败: {str(e)}")
+                return
+            self.checkin(browser, pages=0)
+
+    def close_all(self):
+        """关闭所有空闲浏览器，使用中的浏览器在归还时关闭"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for browser in idle:
+            self._quit(browser, "关闭浏览器池")
+
+    def reopen(self):
+        """关闭后重新允许浏览器归还入池"""
+        with self._lock:
+            self._closed = False
+
+    def status(self):
+        """返回池当前状态"""
+        with self._lock:
+            idle = [browser.info() for browser in self._idle]
+            in_use = [browser.info() for browser in self._in_use]
+        return {'name': self.name, 'max_idle': self.max_idle, 'idle': idle, 'in_use': in_use}
+
+    def _launch(self, account):
+        start_time = time.time()
+        driver = self.driver_factory()
+        try:
+            user_id = self.login(driver, account)
+        except Exception as e:
+            self._quit_driver(driver)
+            raise BrowserLoginError(f"账号 {account} 登录失败: {str(e)}") from e
+        if not user_id:
+            self._quit_driver(driver)
+            raise BrowserLoginError(f"账号 {account} 登录失败")
+        logger.info(f"[{self.name}] 启动并登录新浏览器，账号: {account}，耗时 {time.time() - start_time:.1f} 秒")
+        return PooledBrowser(driver, account, user_id)
+
+    def _is_healthy(self, browser):
+        if time.time() - browser.last_used_at > self.max_idle_seconds:
+            return False
+        try:
+            browser.driver.execute_script('return 1')
+            if self.session_cookie:
+                # 通过CDP读取所有域名的cookie，不受当前页面（about:blank）影响
+                cookies = browser.driver.execute_cdp_cmd('Network.getAllCookies', {}).get('cookies', [])
+                if not any(cookie['name'] == self.session_cookie for cookie in cookies):
+                    logger.info(f"[{self.name}] 浏览器登录态已失效")
+                    return False
+            return True
+        except Exception as e:
+            logger.info(f"[{self.name}] 浏览器无响应: {str(e)}")
+            return False
+
+    def _quit(self, browser, reason):
+        logger.info(f"[{self.name}] 关闭浏览器（{reason}），账号: {browser.account}")
+        self._quit_driver(browser.driver)
+
+    def _quit_driver(self, driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"[{self.name}] 关闭WebDriver时发生错误: {str(e)}")
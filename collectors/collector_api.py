@@ -19,9 +19,10 @@ import json
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask, request, jsonify
 
-from common.mysql import MySQLDatabase
-from tiktok_collect_by_uc import process_task, get_public_ip, check_account_status, send_promotion_messages
-from x_collect import check_x_account_status
+from common.mysql import MySQLDatabase, close_all_pools, ensure_database_schema
+from tiktok_collect_by_uc import get_public_ip, check_account_status, send_promotion_messages, tiktok_browser_pool
+from task_scheduler import TikTokTaskScheduler, compute_browser_slots
+from x_collect import check_x_account_status, x_browser_pool
 
 
 # Flask应用初始化
@@ -29,6 +30,7 @@ app = Flask(__name__)
 
 # 常量定义
 MAX_CONCURRENT_CHROME = 50
+BROWSER_POOL_WARM_COUNT = int(os.environ.get('TIKTOK_BROWSER_POOL_WARM', 1))  # 启动时预热的已登录TikTok浏览器数
 PROJECT_PATH = Path(__file__).parent.parent
 
 # 日志配置
@@ -60,12 +62,27 @@ logger = setup_logger()
 # 全局变量
 worker_ip = get_public_ip()
 worker_name = socket.gethostname()
+task_scheduler = TikTokTaskScheduler(worker_ip, compute_browser_slots(MAX_CONCURRENT_CHROME))
+# 每个槽位保留一个空闲浏览器，槽位补位时可以直接复用
+tiktok_browser_pool.max_idle = task_scheduler.max_slots
 
 # 工具函数
 def get_chrome_process_count():
     """获取当前运行的Chrome进程数"""
     return len([p for p in psutil.process_iter(['name']) if 'chrome' in p.info['name'].lower()])
 
+def warm_browser_pool():
+    """后台预热已登录的TikTok浏览器"""
+    count = min(BROWSER_POOL_WARM_COUNT, tiktok_browser_pool.max_idle)
+    if count > 0:
+        threading.Thread(target=tiktok_browser_pool.warm, kwargs={'count': count},
+                         name='browser-pool-warm', daemon=True).start()
+
+def close_browser_pools():
+    """关闭浏览器池中的空闲浏览器"""
+    tiktok_browser_pool.close_all()
+    x_browser_pool.close_all()
+
 def kill_chrome_processes():
     """强制终止所有Chrome进程"""
     killed_count = 0
@@ -90,6 +107,10 @@ def pull_and_restart():
         raise
 
 # Worker管理函数
+def migrate_database():
+    """建表并执行尚未执行的数据库结构迁移，失败时抛出异常，worker 不在不完整的表结构上启动"""
+    ensure_database_schema()
+
 def register_worker():
     db = MySQLDatabase()
     db.connect()
@@ -110,39 +131,26 @@ def update_worker_status(status='active'):
 
 # 任务管理函数
 def check_and_execute_tasks():
-    """检查并执行待处理的任务"""
-    current_chrome_count = get_chrome_process_count()
-    if current_chrome_count > 0:
-        logger.info(f"当前有 {current_chrome_count} 个Chrome进程正在运行，跳过任务检查")
+    """有空闲浏览器槽位时领取待处理的任务，交给调度器执行"""
+    free_slots = task_scheduler.free_slots()
+    if free_slots <= 0:
+        logger.info("没有空闲的浏览器槽位，跳过任务检查")
         return
 
     db = MySQLDatabase()
     db.connect()
     try:
         pending_tasks = list(db.get_pending_tiktok_tasks() or [])
-        running_tasks = list(db.get_running_tiktok_tasks() or [])
-        tasks = pending_tasks + running_tasks
-        
-        if len(tasks) == 0:
+        if len(pending_tasks) == 0:
             logger.info("没有待处理的任务")
             return
-        
-        for task in tasks:
-            if get_chrome_process_count() >= MAX_CONCURRENT_CHROME:
-                break
-            
-            if task['status'] == 'pending':
-                db.update_tiktok_task_status(task['id'], 'running')
-                db.update_tiktok_task_server_ip(task['id'], worker_ip)
-            
-            task_thread = threading.Thread(
-                target=process_task, 
-                args=(task['id'], task['keyword'], worker_ip)
-            )
-            task_thread.start()
-            
+
+        for task in pending_tasks[:free_slots]:
+            db.update_tiktok_task_status(task['id'], 'running')
+            db.update_tiktok_task_server_ip(task['id'], worker_ip)
             logger.info(f"自动开始执行任务: {task['id']}")
-            time.sleep(60)
+        task_scheduler.start()
+        task_scheduler.wake()
     except Exception as e:
         logger.error(f"检查和执行任务时发生错误: {str(e)}")
     finally:
@@ -249,12 +257,6 @@ def trigger_tiktok_task():
     db = MySQLDatabase()
     db.connect()
     try:
-        chrome_count = get_chrome_process_count()
-        if chrome_count >= MAX_CONCURRENT_CHROME:
-            return jsonify({
-                "error": f"Maximum number of concurrent Chrome processes ({MAX_CONCURRENT_CHROME}) reached"
-            }), 429
-
         task = db.get_tiktok_task_by_id(task_id)
         if not task:
             return jsonify({"error": f"Task ID {task_id} does not exist"}), 404
@@ -262,15 +264,14 @@ def trigger_tiktok_task():
         db.update_tiktok_task_status(task_id, 'running')
         db.update_tiktok_task_server_ip(task_id, worker_ip)
 
-        task_thread = threading.Thread(
-            target=process_task,
-            args=(task_id, task['keyword'], worker_ip)
-        )
-        task_thread.start()
+        # 由调度器按空闲浏览器槽位分配视频
+        task_scheduler.start()
+        task_scheduler.wake()
 
         return jsonify({
             "message": "Task triggered successfully",
-            "task_id": task_id
+            "task_id": task_id,
+            "free_slots": task_scheduler.free_slots()
         }), 200
     finally:
         db.disconnect()
@@ -285,12 +286,6 @@ def resume_tiktok_task():
     db = MySQLDatabase()
     db.connect()
     try:
-        chrome_count = get_chrome_process_count()
-        if chrome_count >= MAX_CONCURRENT_CHROME:
-            return jsonify({
-                "error": f"Maximum number of concurrent Chrome processes ({MAX_CONCURRENT_CHROME}) reached"
-            }), 429
-
         task = db.get_tiktok_task_by_id(task_id)
         if not task:
             return jsonify({"error": "Task not found"}), 404
@@ -301,19 +296,25 @@ def resume_tiktok_task():
         db.update_tiktok_task_status(task_id, 'running')
         db.update_tiktok_task_server_ip(task_id, worker_ip)
 
-        task_thread = threading.Thread(
-            target=process_task,
-            args=(task_id, task['keyword'], worker_ip)
-        )
-        task_thread.start()
+        # 由调度器按空闲浏览器槽位分配视频
+        task_scheduler.start()
+        task_scheduler.wake()
 
         return jsonify({
             "message": "Task resumed successfully",
-            "task_id": task_id
+            "task_id": task_id,
+            "free_slots": task_scheduler.free_slots()
         }), 200
     finally:
         db.disconnect()
 
+@app.route('/tiktok_scheduler_status', methods=['GET'])
+def tiktok_scheduler_status():
+    """查看本机采集调度器的槽位占用情况和浏览器池状态"""
+    status = task_scheduler.status()
+    status['browser_pools'] = [tiktok_browser_pool.status(), x_browser_pool.status()]
+    return jsonify(status), 200
+
 @app.route('/check_tiktok_account', methods=['POST'])
 def check_tiktok_account():
     """检查TikTok账号状态"""
@@ -353,7 +354,10 @@ def check_tiktok_account():
 def force_stop_all_tasks():
     """强制停止所有任务"""
     try:
+        close_browser_pools()
         killed_count = kill_chrome_processes()
+        tiktok_browser_pool.reopen()
+        x_browser_pool.reopen()
         return jsonify({
             "message": f"强制停止了 {killed_count} 个Chrome进程"
         }), 200
@@ -437,12 +441,19 @@ def graceful_shutdown(signum, frame):
     
     # # 停止定时任务
     # scheduler.shutdown()
+
+    # 停止采集调度器
+    task_scheduler.stop()
     
-    # 结束所有Chrome进程
+    # 关闭浏览器池，结束所有Chrome进程
+    close_browser_pools()
     kill_chrome_processes()
     
     # 更新worker状态
     update_worker_status('inactive')
+
+    # 关闭连接池中的数据库连接
+    close_all_pools()
     
     logger.info("清理完成，退出程序")
     sys.exit(0)
@@ -453,7 +464,13 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, graceful_shutdown)
     signal.signal(signal.SIGINT, graceful_shutdown)
     
+    migrate_database()
     register_worker()
+
+    # 开启reloader时只在实际提供服务的子进程中启动调度器，恢复本机上运行中的任务
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_browser_pool()
+        task_scheduler.start()
     
     # scheduler = BackgroundScheduler()
     # scheduler.add_job(check_and_execute_tasks, 'interval', minutes=1)
@@ -9,6 +9,11 @@
 """
 
 import os
+import json
+import time
+import threading
+import collections
+import contextlib
 import pymysql
 import logging
 from pymysql.converters import escape_string
@@ -18,6 +23,555 @@ import datetime
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 连接池配置
+POOL_MAX_SIZE = int(os.environ.get('MYSQL_POOL_SIZE', 20))  # 每个进程最多持有的连接数
+POOL_MAX_IDLE_SECONDS = int(os.environ.get('MYSQL_POOL_MAX_IDLE', 300))  # 空闲超过该时间的连接会被回收
+POOL_MAX_LIFETIME_SECONDS = int(os.environ.get('MYSQL_POOL_MAX_LIFETIME', 3600))  # 连接最长使用时间
+POOL_PING_INTERVAL_SECONDS = int(os.environ.get('MYSQL_POOL_PING_INTERVAL', 30))  # 空闲超过该时间的连接在借出前做健康检查
+POOL_CHECKOUT_TIMEOUT = int(os.environ.get('MYSQL_POOL_TIMEOUT', 30))  # 连接池耗尽时的最长等待时间
+STREAM_CHUNK_SIZE = int(os.environ.get('MYSQL_STREAM_CHUNK_SIZE', 5000))  # 流式查询每块的行数
+
+# 增量过滤水位只推进到采集时间早于该秒数的评论：多个采集槽并发写入时，较小的自增ID可能晚于较大的ID提交，
+# 只要写评论的事务在该时间的一半内完成，水位以下就不会再出现新提交的评论
+FILTER_WATERMARK_SETTLE_SECONDS = int(os.environ.get('FILTER_WATERMARK_SETTLE_SECONDS', 120))
+
+# 视频领取租约配置
+VIDEO_LEASE_SECONDS = int(os.environ.get('TIKTOK_VIDEO_LEASE_SECONDS', 300))  # 租约时长，过期后其他worker可以重新领取
+
+# 后台分析任务租约配置
+ANALYSIS_JOB_LEASE_SECONDS = int(os.environ.get('ANALYSIS_JOB_LEASE_SECONDS', 600))  # 单个GPT批次可能重试较久，租约比视频长
+ANALYSIS_JOB_MAX_ATTEMPTS = int(os.environ.get('ANALYSIS_JOB_MAX_ATTEMPTS', 3))  # 租约过期（worker崩溃）后最多重新领取的次数
+
+# 页面轮询分析任务进度时读取的列（不含prompt和预分类模型）
+ANALYSIS_JOB_PROGRESS_COLUMNS = (
+    "id, platform, keyword, model, batch_size, total_comments, status, stage, progress_done, progress_total, "
+    "cached_count, pre_labeled_count, first_round_saved, second_round_saved, ignored_count, lease_owner, "
+    "lease_expires_at, attempts, error_message, created_at, started_at, finished_at, updated_at"
+)
+
+
+class MySQLConnectionPool:
+    """
+    进程内共享的MySQL连接池（线程安全）
+
+    - 连接总数受 max_size 限制，耗尽时借出方阻塞等待
+    - 借出前对空闲较久的连接做 ping 健康检查，失效的连接会被替换
+    - 归还时回滚未提交的事务，超过最长使用时间的连接直接关闭
+    - 空闲超过 max_idle_seconds 的连接在借出/归还时被回收
+    """
+
+    def __init__(self, connect_kwargs, max_size=POOL_MAX_SIZE, max_idle_seconds=POOL_MAX_IDLE_SECONDS,
+                 max_lifetime_seconds=POOL_MAX_LIFETIME_SECONDS, ping_interval=POOL_PING_INTERVAL_SECONDS,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT):
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.ping_interval = ping_interval
+        self.checkout_timeout = checkout_timeout
+        self._idle = collections.deque()  # 元素为 (connection, 最后归还时间)
+        self._created_at = {}  # id(connection) -> 创建时间
+        self._size = 0  # 已创建且未关闭的连接数（含借出和空闲）
+        self._cond = threading.Condition()
+
+    def _new_connection(self):
+        connection = pymysql.connect(**self.connect_kwargs)
+        self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _close_connection(self, connection):
+        self._created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _reap_idle_locked(self):
+        """回收空闲过久的连接，需在持有锁时调用"""
+        now = time.monotonic()
+        # 空闲队列左侧是最早归还的连接
+        while self._idle and now - self._idle[0][1] > self.max_idle_seconds:
+            connection, _ = self._idle.popleft()
+            self._size -= 1
+            self._close_connection(connection)
+            logger.info("回收空闲过久的数据库连接")
+
+    def acquire(self):
+        """借出一个可用连接"""
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            while True:
+                self._reap_idle_locked()
+                if self._idle:
+                    # 后进先出，优先复用最近使用过的热连接
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise pymysql.err.OperationalError(f"数据库连接池已耗尽（最大连接数 {self.max_size}）")
+                self._cond.wait(remaining)
+
+        try:
+            if connection is None:
+                return self._new_connection()
+            if time.monotonic() - last_used > self.ping_interval:
+                try:
+                    connection.ping(reconnect=False)
+                except pymysql.Error:
+                    logger.warning("空闲连接健康检查失败，重新建立连接")
+                    self._close_connection(connection)
+                    return self._new_connection()
+            return connection
+        except Exception:
+            # 建立连接失败，释放占用的名额
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, connection, discard=False):
+        """归还连接，discard=True 时直接关闭"""
+        if not discard:
+            created_at = self._created_at.get(id(connection), 0)
+            if time.monotonic() - created_at > self.max_lifetime_seconds:
+                discard = True
+        if not discard:
+            try:
+                # 结束可能残留的事务，避免下一个使用者读到旧快照或持有锁
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            if discard:
+                self._size -= 1
+                self._close_connection(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._reap_idle_locked()
+            self._cond.notify()
+
+    def close_all(self):
+        """关闭所有空闲连接，借出中的连接在归还时关闭"""
+        with self._cond:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._size -= 1
+                self._close_connection(connection)
+            self._cond.notify_all()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, port, user, password, database):
+    """获取进程内共享的连接池，相同连接参数复用同一个池"""
+    key = (host, port, user, database)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = MySQLConnectionPool({
+                'host': host,
+                'port': port,
+                'user': user,
+                'password': password,
+                'database': database,
+                'cursorclass': pymysql.cursors.DictCursor
+            })
+            _pools[key] = pool
+        return pool
+
+
+def close_all_pools():
+    """关闭所有连接池中的空闲连接（进程退出时调用）"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_all()
+
+
+# keyword_stats 各统计字段对应的重新计算语句（均可走关键词索引）
+KEYWORD_STATS_QUERIES = {
+    'total_videos': "SELECT COUNT(*) FROM tiktok_videos WHERE keyword = %s",
+    'processed_videos': "SELECT COUNT(*) FROM tiktok_videos WHERE keyword = %s AND status IN ('completed', 'failed')",
+    'comments_count': "SELECT COUNT(*) FROM tiktok_comments WHERE keyword = %s",
+    'filtered_count': "SELECT COUNT(*) FROM tiktok_filtered_comments WHERE keyword = %s",
+    'potential_count': "SELECT COUNT(*) FROM tiktok_analyzed_comments WHERE keyword = %s AND classification = '潜在客户'",
+    'high_intent_count': "SELECT COUNT(*) FROM tiktok_second_round_analyzed_comments "
+                         "WHERE keyword = %s AND second_round_classification = '高意向客户'",
+    'messages_sent_count': "SELECT COUNT(*) FROM tiktok_messages WHERE keyword = %s AND status = 'sent'",
+}
+
+
+def _build_keyword_stats_backfill():
+    """生成按 tiktok_tasks 中所有关键词回填 keyword_stats 的语句"""
+    columns = ', '.join(KEYWORD_STATS_QUERIES)
+    subqueries = ', '.join(
+        f"({sql.replace('%s', 'k.keyword')})" for sql in KEYWORD_STATS_QUERIES.values()
+    )
+    updates = ', '.join(f"{field} = VALUES({field})" for field in KEYWORD_STATS_QUERIES)
+    return f"""
+        INSERT INTO keyword_stats (keyword, {columns})
+        SELECT k.keyword, {subqueries}
+        FROM (SELECT DISTINCT keyword FROM tiktok_tasks) k
+        ON DUPLICATE KEY UPDATE {updates}
+        """
+
+
+# 数据库结构迁移，按版本号顺序执行，每个版本只执行一次（记录在 schema_migrations 表中）
+# 新的表结构变更只追加新版本，不要修改已发布的版本
+SCHEMA_MIGRATIONS = [
+    (1, "为关键词和任务状态访问路径添加复合索引", [
+        "ALTER TABLE tiktok_tasks ADD INDEX idx_keyword_created (keyword, created_at)",
+        "ALTER TABLE tiktok_tasks ADD INDEX idx_status_created (status, created_at)",
+        "ALTER TABLE tiktok_videos ADD INDEX idx_task_status (task_id, status)",
+        "ALTER TABLE tiktok_videos ADD INDEX idx_keyword_status (keyword, status)",
+        "ALTER TABLE tiktok_comments ADD INDEX idx_keyword_user (keyword, user_id)",
+        "ALTER TABLE tiktok_task_logs ADD INDEX idx_task_created (task_id, created_at)",
+        "ALTER TABLE tiktok_filtered_comments ADD INDEX idx_keyword_user (keyword, user_id)",
+        "ALTER TABLE tiktok_analyzed_comments ADD INDEX idx_keyword_classification (keyword, classification)",
+        "ALTER TABLE tiktok_messages ADD INDEX idx_keyword_status (keyword, status)",
+        "ALTER TABLE x_tasks ADD INDEX idx_keyword_created (keyword, created_at)",
+        "ALTER TABLE x_tweets ADD INDEX idx_task_status (task_id, status)",
+        "ALTER TABLE x_comments ADD INDEX idx_keyword_user (keyword, user_id)",
+        "ALTER TABLE x_filtered_comments ADD INDEX idx_keyword_user (keyword, user_id)",
+        "ALTER TABLE x_analyzed_comments ADD INDEX idx_keyword_classification (keyword, classification)",
+        "ALTER TABLE x_messages ADD INDEX idx_keyword_status (keyword, status)",
+    ]),
+    (2, "创建GPT结果缓存表", [
+        """
+        CREATE TABLE IF NOT EXISTS gpt_result_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            model VARCHAR(100),
+            template_hash CHAR(64),
+            result JSON,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_template_hash (template_hash)
+        )
+        """,
+    ]),
+    (3, "创建关键词统计汇总表并回填", [
+        """
+        CREATE TABLE IF NOT EXISTS keyword_stats (
+            keyword VARCHAR(255) PRIMARY KEY,
+            total_videos INT NOT NULL DEFAULT 0,
+            processed_videos INT NOT NULL DEFAULT 0,
+            comments_count INT NOT NULL DEFAULT 0,
+            filtered_count INT NOT NULL DEFAULT 0,
+            potential_count INT NOT NULL DEFAULT 0,
+            high_intent_count INT NOT NULL DEFAULT 0,
+            messages_sent_count INT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+        """,
+        _build_keyword_stats_backfill(),
+    ]),
+    (4, "视频领取改为带过期时间的租约", [
+        "ALTER TABLE tiktok_videos ADD COLUMN lease_owner VARCHAR(100) NULL",
+        "ALTER TABLE tiktok_videos ADD COLUMN lease_expires_at DATETIME NULL",
+        "ALTER TABLE tiktok_videos ADD INDEX idx_task_status_lease (task_id, status, lease_expires_at)",
+        "ALTER TABLE tiktok_videos ADD INDEX idx_status_lease (status, lease_expires_at)",
+    ]),
+    (5, "任务级的资源屏蔽开关", [
+        "ALTER TABLE tiktok_tasks ADD COLUMN block_resources TINYINT(1) NOT NULL DEFAULT 1",
+    ]),
+    (6, "评论的平台ID和父评论ID（network采集引擎）", [
+        "ALTER TABLE tiktok_comments ADD COLUMN platform_comment_id VARCHAR(32) NULL",
+        "ALTER TABLE tiktok_comments ADD COLUMN platform_parent_id VARCHAR(32) NULL",
+        "ALTER TABLE tiktok_comments ADD UNIQUE INDEX idx_platform_comment_id (platform_comment_id)",
+        "ALTER TABLE tiktok_comments ADD INDEX idx_video_platform_parent (video_id, platform_parent_id)",
+    ]),
+    (7, "增量过滤：过滤结果按 (keyword, user_id) 唯一，记录每个关键词的过滤水位", [
+        # 之前重复保存产生的重复行只保留最新的一条
+        """
+        DELETE f1 FROM tiktok_filtered_comments f1
+        JOIN tiktok_filtered_comments f2 ON f1.keyword = f2.keyword AND f1.user_id = f2.user_id AND f1.id < f2.id
+        """,
+        "ALTER TABLE tiktok_filtered_comments ADD UNIQUE INDEX uk_keyword_user (keyword, user_id)",
+        "ALTER TABLE tiktok_filtered_comments DROP INDEX idx_keyword_user",
+        """
+        DELETE f1 FROM x_filtered_comments f1
+        JOIN x_filtered_comments f2 ON f1.keyword = f2.keyword AND f1.user_id = f2.user_id AND f1.id < f2.id
+        """,
+        "ALTER TABLE x_filtered_comments ADD UNIQUE INDEX uk_keyword_user (keyword, user_id)",
+        "ALTER TABLE x_filtered_comments DROP INDEX idx_keyword_user",
+        "ALTER TABLE tiktok_comments ADD INDEX idx_keyword_id (keyword, id)",
+        """
+        CREATE TABLE IF NOT EXISTS filter_watermarks (
+            platform VARCHAR(20) NOT NULL,
+            keyword VARCHAR(255) NOT NULL,
+            last_comment_id INT NOT NULL DEFAULT 0,
+            rules_hash CHAR(64),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (platform, keyword)
+        )
+        """,
+    ]),
+    (8, "过滤结果的近重复计数和垃圾评论标记", [
+        "ALTER TABLE tiktok_filtered_comments ADD COLUMN duplicate_count INT NOT NULL DEFAULT 0",
+        "ALTER TABLE tiktok_filtered_comments ADD COLUMN spam_reason VARCHAR(100) NULL",
+        "ALTER TABLE x_filtered_comments ADD COLUMN duplicate_count INT NOT NULL DEFAULT 0",
+        "ALTER TABLE x_filtered_comments ADD COLUMN spam_reason VARCHAR(100) NULL",
+    ]),
+    (9, "第一轮分析结果的标注来源（GPT或本地预分类）", [
+        "ALTER TABLE tiktok_analyzed_comments ADD COLUMN label_source VARCHAR(20) NOT NULL DEFAULT 'gpt'",
+        "ALTER TABLE x_analyzed_comments ADD COLUMN label_source VARCHAR(20) NOT NULL DEFAULT 'gpt'",
+    ]),
+    (10, "GPT批量任务（Batch API）及其请求清单", [
+        """
+        CREATE TABLE IF NOT EXISTS gpt_batch_jobs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            platform VARCHAR(20) NOT NULL,
+            keyword VARCHAR(255) NOT NULL,
+            analysis_round TINYINT NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            template_hash CHAR(64),
+            output_fields JSON,
+            status VARCHAR(20) NOT NULL DEFAULT 'preparing',
+            provider_batch_id VARCHAR(100),
+            input_file_id VARCHAR(100),
+            output_file_id VARCHAR(100),
+            error_file_id VARCHAR(100),
+            request_count INT NOT NULL DEFAULT 0,
+            comment_count INT NOT NULL DEFAULT 0,
+            completed_requests INT NOT NULL DEFAULT 0,
+            failed_requests INT NOT NULL DEFAULT 0,
+            saved_count INT NOT NULL DEFAULT 0,
+            missing_count INT NOT NULL DEFAULT 0,
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            finished_at DATETIME NULL,
+            INDEX idx_keyword_round (platform, keyword, analysis_round),
+            INDEX idx_status (status)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS gpt_batch_requests (
+            job_id INT NOT NULL,
+            custom_id VARCHAR(64) NOT NULL,
+            comments MEDIUMTEXT NOT NULL,
+            PRIMARY KEY (job_id, custom_id)
+        )
+        """,
+    ]),
+    (11, "后台分析任务（与页面会话解耦，按租约领取，可断点续跑）", [
+        """
+        CREATE TABLE IF NOT EXISTS analysis_jobs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            platform VARCHAR(20) NOT NULL,
+            keyword VARCHAR(255) NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            batch_size INT NOT NULL,
+            total_comments INT NOT NULL,
+            prompt_template_first MEDIUMTEXT NOT NULL,
+            prompt_template_second MEDIUMTEXT NOT NULL,
+            pre_classifier MEDIUMBLOB NULL,
+            pre_threshold FLOAT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            stage VARCHAR(20) NOT NULL DEFAULT 'first_round',
+            progress_done INT NOT NULL DEFAULT 0,
+            progress_total INT NOT NULL DEFAULT 0,
+            cached_count INT NOT NULL DEFAULT 0,
+            pre_labeled_count INT NOT NULL DEFAULT 0,
+            first_round_saved INT NOT NULL DEFAULT 0,
+            second_round_saved INT NOT NULL DEFAULT 0,
+            ignored_count INT NOT NULL DEFAULT 0,
+            lease_owner VARCHAR(100) NULL,
+            lease_expires_at DATETIME NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME NULL,
+            finished_at DATETIME NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_status_lease (status, lease_expires_at),
+            INDEX idx_keyword_created (platform, keyword, created_at)
+        )
+        """,
+    ]),
+]
+
+# 迁移语句重复执行时的错误码（索引/列/表已存在、要删除的索引不存在），视为已执行
+MIGRATION_IDEMPOTENT_ERRORS = {1050, 1060, 1061, 1091}
+# 迁移语句涉及的表不存在（只建了部分平台的表时直接调用 run_migrations），跳过该语句并记录警告
+MIGRATION_MISSING_TABLE_ERROR = 1146
+
+
+class SchemaMigrationError(Exception):
+    """建表或数据库迁移未能全部完成，表结构不是当前代码需要的版本"""
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_database_schema():
+    """
+    建表并执行尚未执行的迁移，每个进程成功执行一次（采集 worker 启动时和 Streamlit 页面加载时调用）
+
+    失败时抛出 SchemaMigrationError，调用方不应在迁移不完整的表结构上继续运行；下次调用会重试。
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        db = MySQLDatabase()
+        db.connect()
+        try:
+            db.initialize_tables()
+            db.initialize_x_tables()
+            db.run_migrations()
+        finally:
+            db.disconnect()
+        _schema_ready = True
+
+# 页面和采集依赖的主要查询：对应的方法和 QUERY_PLAN_CHECKS 共用同一份SQL，EXPLAIN 检查的就是实际执行的语句
+TIKTOK_TASKS_BY_KEYWORD_QUERY = "SELECT * FROM tiktok_tasks WHERE keyword = %s ORDER BY created_at DESC"
+
+TIKTOK_TASK_LOGS_BY_KEYWORD_QUERY = """
+        SELECT l.* FROM tiktok_task_logs l
+        JOIN tiktok_tasks t ON l.task_id = t.id
+        WHERE t.keyword = %s
+        ORDER BY l.created_at DESC
+        LIMIT 99999
+        """
+
+# 领取视频分两步：先领取租约已过期的处理中视频，再领取待处理视频。每条只涉及一个状态，
+# 在 idx_task_status_lease 上是一段连续的索引范围（NULL 排在最前，没有租约的处理中视频，如页面上手动改为处理中的，也视为已过期），
+# 按主键取第一行并只锁定领取的那一行，不再对所有候选行排序加锁
+CLAIM_EXPIRED_VIDEO_QUERY = """
+        SELECT id, video_url, status FROM tiktok_videos
+        WHERE task_id = %s AND status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+        """
+
+CLAIM_PENDING_VIDEO_QUERY = """
+        SELECT id, video_url, status FROM tiktok_videos
+        WHERE task_id = %s AND status = 'pending'
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+        """
+
+# 任务中还没处理完的视频数（包括其他机器正在处理的），为0时任务才能标记完成
+UNFINISHED_TASK_VIDEOS_QUERY = """
+        SELECT COUNT(*) AS unfinished FROM tiktok_videos
+        WHERE task_id = %s AND status IN ('pending', 'processing')
+        """
+
+TIKTOK_COMMENTS_BY_KEYWORD_QUERY = """
+        SELECT * FROM tiktok_comments
+        WHERE keyword = %s
+        LIMIT 99999
+        """
+
+POTENTIAL_CUSTOMERS_QUERIES = {
+    platform: f"""
+        SELECT * FROM {platform}_analyzed_comments
+        WHERE keyword = %s AND classification = '潜在客户'
+        ORDER BY analyzed_at DESC
+        LIMIT %s
+        """
+    for platform in ('tiktok', 'x')
+}
+
+PROCESSING_MESSAGE_WORKERS_QUERIES = {
+    platform: f"""
+        SELECT DISTINCT worker_ip
+        FROM {platform}_messages
+        WHERE keyword = %s AND status = 'processing' AND worker_ip IS NOT NULL
+        """
+    for platform in ('tiktok', 'x')
+}
+
+
+def build_comments_stream_query(platform, min_id=False, max_id=False, order_by_user=False):
+    """
+    按关键词流式读取评论的查询（stream_*_comments_by_keyword 使用），参数依次为 keyword[, min_id][, max_id]
+
+    min_id/max_id 为True时加上 id 的下界/上界条件，order_by_user 为True时按 user_id 排序。
+    """
+    if platform == 'x':
+        query = """
+        SELECT c.* FROM x_comments c
+        JOIN x_tweets t ON c.tweet_id = t.id
+        JOIN x_tasks x ON t.task_id = x.id
+        WHERE x.keyword = %s
+        """
+        prefix = 'c.'
+    else:
+        query = """
+        SELECT * FROM tiktok_comments
+        WHERE keyword = %s
+        """
+        prefix = ''
+    if min_id:
+        query += f" AND {prefix}id > %s"
+    if max_id:
+        query += f" AND {prefix}id <= %s"
+    if order_by_user:
+        query += f" ORDER BY {prefix}user_id"
+    return query
+
+
+def build_filtered_comments_query(platform, include_spam=False):
+    """按关键词读取过滤后评论的查询（get_filtered_*_comments_by_keyword 使用），参数为 keyword, limit"""
+    query = f"""
+        SELECT * FROM {platform}_filtered_comments
+        WHERE keyword = %s
+        """
+    if not include_spam:
+        query += " AND spam_reason IS NULL"
+    return query + " LIMIT %s"
+
+
+# 读取已保存过滤结果的内容，增量过滤时用于预先填充近重复索引，参数为 keyword
+FILTERED_COMMENT_TEXTS_QUERIES = {
+    platform: f"SELECT user_id, reply_content FROM {platform}_filtered_comments WHERE keyword = %s"
+    for platform in ('tiktok', 'x')
+}
+
+
+# EXPLAIN 检查的查询，每项为 (检查项名称, 查询, 参数名)，参数由 check_query_plans 按参数名填充
+QUERY_PLAN_CHECKS = [
+    ("任务列表-按关键词查询任务", TIKTOK_TASKS_BY_KEYWORD_QUERY, ("keyword",)),
+    ("任务列表-视频总数", KEYWORD_STATS_QUERIES['total_videos'], ("keyword",)),
+    ("任务列表-已处理视频数", KEYWORD_STATS_QUERIES['processed_videos'], ("keyword",)),
+    ("任务列表-评论数", KEYWORD_STATS_QUERIES['comments_count'], ("keyword",)),
+    ("任务列表-过滤后评论数", KEYWORD_STATS_QUERIES['filtered_count'], ("keyword",)),
+    ("任务列表-潜在客户数", KEYWORD_STATS_QUERIES['potential_count'], ("keyword",)),
+    ("任务列表-已发送消息数", KEYWORD_STATS_QUERIES['messages_sent_count'], ("keyword",)),
+    ("任务日志-按关键词查询", TIKTOK_TASK_LOGS_BY_KEYWORD_QUERY, ("keyword",)),
+    ("采集-领取过期租约视频", CLAIM_EXPIRED_VIDEO_QUERY, ("task_id",)),
+    ("采集-领取待处理视频", CLAIM_PENDING_VIDEO_QUERY, ("task_id",)),
+    ("采集-任务未完成视频数", UNFINISHED_TASK_VIDEOS_QUERY, ("task_id",)),
+    ("采集页-按关键词读取评论", TIKTOK_COMMENTS_BY_KEYWORD_QUERY, ("keyword",)),
+    ("过滤页-按关键词读取评论", build_comments_stream_query('tiktok', max_id=True, order_by_user=True),
+     ("keyword", "max_id")),
+    ("过滤页-增量读取新评论", build_comments_stream_query('tiktok', min_id=True, max_id=True),
+     ("keyword", "min_id", "max_id")),
+    ("过滤页-增量过滤读取已保存结果", FILTERED_COMMENT_TEXTS_QUERIES['tiktok'], ("keyword",)),
+    ("分析页-按关键词读取过滤后评论", build_filtered_comments_query('tiktok'), ("keyword", "limit")),
+    ("分析页-潜在客户", POTENTIAL_CUSTOMERS_QUERIES['tiktok'], ("keyword", "limit")),
+    ("触达页-处理中的消息", PROCESSING_MESSAGE_WORKERS_QUERIES['tiktok'], ("keyword",)),
+    ("X过滤页-按关键词读取评论", build_comments_stream_query('x', max_id=True, order_by_user=True),
+     ("keyword", "max_id")),
+    ("X过滤页-增量读取新评论", build_comments_stream_query('x', min_id=True, max_id=True),
+     ("keyword", "min_id", "max_id")),
+    ("X过滤页-增量过滤读取已保存结果", FILTERED_COMMENT_TEXTS_QUERIES['x'], ("keyword",)),
+    ("X分析页-按关键词读取过滤后评论", build_filtered_comments_query('x'), ("keyword", "limit")),
+    ("X分析页-潜在客户", POTENTIAL_CUSTOMERS_QUERIES['x'], ("keyword", "limit")),
+    ("X触达页-处理中的消息", PROCESSING_MESSAGE_WORKERS_QUERIES['x'], ("keyword",)),
+]
+
+
 class MySQLDatabase:
     def __init__(self):
         self.host = os.environ['MYSQL_HOST']
@@ -27,7 +581,9 @@ class MySQLDatabase:
         self.database = os.environ['MYSQL_DATABASE']
         if not all([self.host, self.user, self.password, self.database]):
             raise ValueError("缺少必要的MySQL连接环境变量配置")
+        self.pool = get_connection_pool(self.host, self.port, self.user, self.password, self.database)
         self.connection = None
+        self.in_transaction = False
 
     def log_sql(self, query, params=None):
         """记录 SQL 查询"""
@@ -44,17 +600,14 @@ class MySQLDatabase:
         logger.info(f"执行 SQL: {formatted_query}")
 
     def connect(self):
-        """建立数据库连接"""
+        """从连接池借出数据库连接"""
+        if self.connection is not None:
+            # 重复调用connect时先归还旧连接，失效的连接直接丢弃
+            self.pool.release(self.connection, discard=not self.connection.open)
+            self.connection = None
         try:
-            self.connection = pymysql.connect(
-                host=self.host,
-                port=self.port,  # 添加端口参数
-                user=self.user,
-                password=self.password,
-                database=self.database,
-                cursorclass=pymysql.cursors.DictCursor
-            )
-            logger.info(f"成功连接到MySQL数据库，地址：{self.host}:{self.port}")
+            self.connection = self.pool.acquire()
+            logger.debug(f"已从连接池获取MySQL连接，地址：{self.host}:{self.port}")
         except pymysql.Error as e:
             logger.error(f"连接数据库时出错: {e}")
     
@@ -69,10 +622,30 @@ class MySQLDatabase:
             return False
 
     def disconnect(self):
-        """关闭数据库连接"""
+        """将数据库连接归还连接池"""
         if self.connection:
-            self.connection.close()
-            logger.info("数据库连接已关闭")
+            self.pool.release(self.connection, discard=not self.connection.open)
+            self.connection = None
+            logger.debug("数据库连接已归还连接池")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        在 self.connection 上执行一个事务：期间 execute_query/execute_update/insert_many 不单独提交，
+        出错时抛出 pymysql.Error 而不是返回 None/-1；正常退出时整体提交，发生异常时整体回滚
+        """
+        if self.in_transaction:
+            raise RuntimeError("不支持嵌套事务")
+        self.in_transaction = True
+        try:
+            self.connection.begin()
+            yield self
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self.in_transaction = False
 
     def execute_query(self, query, params=None):
         """执行查询操作"""
@@ -84,6 +657,8 @@ class MySQLDatabase:
             return result
         except pymysql.Error as e:
             logger.error(f"执行查询时出错: {e}")
+            if self.in_transaction:
+                raise
             return None
 
     def execute_update(self, query, params=None):
@@ -92,10 +667,13 @@ class MySQLDatabase:
         try:
             with self.connection.cursor() as cursor:
                 cursor.execute(query, params or ())
-            self.connection.commit()
+            if not self.in_transaction:
+                self.connection.commit()
             return cursor.rowcount
         except pymysql.Error as e:
             logger.error(f"执行更新时出错: {e}")
+            if self.in_transaction:
+                raise
             self.connection.rollback()
             return -1
 
@@ -105,13 +683,142 @@ class MySQLDatabase:
         try:
             with self.connection.cursor() as cursor:
                 cursor.executemany(query, data)
-            self.connection.commit()
+            if not self.in_transaction:
+                self.connection.commit()
             return cursor.rowcount
         except pymysql.Error as e:
             logger.error(f"批量插入数据时出错: {e}")
+            if self.in_transaction:
+                raise
             self.connection.rollback()
             return -1
 
+    def stream_query(self, query, params=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        使用服务端游标（SSDictCursor）流式执行查询，按块产出结果
+
+        查询在单独借出的连接上执行，遍历期间仍可使用 self.connection 执行其他语句。
+        未遍历完就停止时该连接直接关闭，避免读完剩余结果。
+        与 execute_query 不同，出错时抛出 pymysql.Error，调用方据此区分部分结果和完整结果。
+
+        Yields:
+            list: 每块最多 chunk_size 行的字典列表
+        """
+        self.log_sql(query, params)
+        try:
+            connection = self.pool.acquire()
+        except pymysql.Error as e:
+            logger.error(f"流式查询获取连接时出错: {e}")
+            raise
+
+        exhausted = False
+        cursor = connection.cursor(pymysql.cursors.SSDictCursor)
+        try:
+            cursor.execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+            exhausted = True
+        except pymysql.Error as e:
+            logger.error(f"执行流式查询时出错: {e}")
+            raise
+        finally:
+            if exhausted:
+                cursor.close()
+            self.pool.release(connection, discard=not exhausted)
+
+    def _create_schema_migrations_table(self):
+        return """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+
+    def get_applied_migrations(self):
+        """获取已执行的迁移版本号"""
+        results = self.execute_query("SELECT version FROM schema_migrations")
+        return {row['version'] for row in results or []}
+
+    def run_migrations(self):
+        """
+        执行尚未执行的数据库结构迁移（应先建表，见 ensure_database_schema）
+
+        多个进程同时启动时通过 GET_LOCK 串行化；单个语句因对象已存在而失败时视为已执行，
+        因表不存在而失败时跳过该语句；其他错误抛出 SchemaMigrationError，后续版本不再执行。
+
+        Returns:
+            list: 本次执行的迁移版本号
+        """
+        if self.execute_update(self._create_schema_migrations_table()) < 0:
+            raise SchemaMigrationError("创建 schema_migrations 表失败")
+        lock = self.execute_query("SELECT GET_LOCK('schema_migrations', 60) AS locked")
+        if not lock or not lock[0]['locked']:
+            raise SchemaMigrationError("获取数据库迁移锁失败")
+
+        applied_now = []
+        try:
+            applied = self.get_applied_migrations()
+            for version, description, statements in SCHEMA_MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"执行数据库迁移 {version}: {description}")
+                for statement in statements:
+                    self.log_sql(statement)
+                    try:
+                        with self.connection.cursor() as cursor:
+                            cursor.execute(statement)
+                    except pymysql.Error as e:
+                        if e.args and e.args[0] in MIGRATION_IDEMPOTENT_ERRORS:
+                            logger.info(f"迁移语句已生效，跳过: {e}")
+                        elif e.args and e.args[0] == MIGRATION_MISSING_TABLE_ERROR:
+                            logger.warning(f"数据库迁移 {version} 涉及的表不存在，跳过该语句: {e}")
+                        else:
+                            logger.error(f"数据库迁移 {version} 执行失败: {e}")
+                            raise SchemaMigrationError(f"数据库迁移 {version} 执行失败: {e}") from e
+                if self.execute_update(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                ) < 0:
+                    raise SchemaMigrationError(f"记录数据库迁移 {version} 失败")
+                applied_now.append(version)
+            if applied_now:
+                logger.info(f"数据库迁移完成，本次执行版本: {applied_now}")
+            return applied_now
+        finally:
+            self.execute_query("SELECT RELEASE_LOCK('schema_migrations')")
+
+    def explain_query(self, query, params=None):
+        """返回查询的 EXPLAIN 结果"""
+        return self.execute_query(f"EXPLAIN {query}", params)
+
+    def check_query_plans(self, keyword='__explain_check__', task_id=0):
+        """
+        对 QUERY_PLAN_CHECKS 中的查询执行 EXPLAIN，找出全表扫描（type=ALL）的查询
+
+        应在执行过迁移、数据量接近线上的本地MySQL上运行。
+
+        Returns:
+            list: [(检查项名称, EXPLAIN行)]，为空表示没有全表扫描
+        """
+        params = {'keyword': keyword, 'task_id': task_id, 'min_id': 0, 'max_id': 2 ** 31 - 1, 'limit': 1000}
+        problems = []
+        for name, query, param_names in QUERY_PLAN_CHECKS:
+            plan = self.explain_query(query, tuple(params[param_name] for param_name in param_names))
+            if plan is None:
+                problems.append((name, {'error': 'EXPLAIN 执行失败'}))
+                continue
+            for row in plan:
+                if row.get('type') == 'ALL':
+                    problems.append((name, row))
+                    logger.warning(f"[{name}] 全表扫描: table={row.get('table')}, rows={row.get('rows')}")
+                else:
+                    logger.info(f"[{name}] table={row.get('table')}, type={row.get('type')}, key={row.get('key')}")
+        return problems
+
     def initialize_tables(self):
         """初始化并创建所需的表"""
         create_tables_queries = [
@@ -128,7 +835,8 @@ class MySQLDatabase:
         ]
 
         for query in create_tables_queries:
-            self.execute_update(query)
+            if self.execute_update(query) < 0:
+                raise SchemaMigrationError("创建TikTok数据表失败")
         
         logger.info("所有必要的表和索引已创建或已存在")
 
@@ -299,7 +1007,7 @@ class MySQLDatabase:
         )
         """
 
-    def create_tiktok_task(self, keyword):
+    def create_tiktok_task(self, keyword, block_resources=True):
         """创建TikTok任务,如果已��相同关键字待处理任务则返回该任务ID"""
         # 首先检查是否存在相同关键字的待处理任务
         check_query = f"""
@@ -315,8 +1023,8 @@ class MySQLDatabase:
             return existing_task_id
         
         # 如果不存在, 创建新任务
-        insert_query = f"INSERT INTO tiktok_tasks (keyword) VALUES ('{keyword}')"
-        result = self.execute_update(insert_query)
+        insert_query = "INSERT INTO tiktok_tasks (keyword, block_resources) VALUES (%s, %s)"
+        result = self.execute_update(insert_query, (keyword, 1 if block_resources else 0))
         
         if result > 0:
             new_task_id = self.execute_query("SELECT LAST_INSERT_ID() as id")[0]['id']
@@ -342,6 +1050,7 @@ class MySQLDatabase:
 
     def delete_tiktok_task(self, task_id):
         """删除TikTok任务及相关数据"""
+        task = self.get_tiktok_task_by_id(task_id)
         try:
             with self.connection.cursor() as cursor:
                 # 1. 删除与任务相关的评论数据
@@ -381,12 +1090,63 @@ class MySQLDatabase:
 
             self.connection.commit()
             logger.info(f"成功删除任务 ID: {task_id} 及其所有相关数据")
+            if task:
+                self.refresh_keyword_stats(task['keyword'])
             return True
         except Exception as e:
             logger.error(f"删除任务时出错: {e}")
             self.connection.rollback()
             return False
 
+    def bump_keyword_stats(self, keyword, cursor=None, **deltas):
+        """
+        增量更新关键词统计，如 bump_keyword_stats(kw, comments_count=10)
+
+        传入 cursor 时在调用方的事务中执行（由调用方提交）。
+        """
+        deltas = {field: delta for field, delta in deltas.items() if field in KEYWORD_STATS_QUERIES and delta}
+        if not keyword or not deltas:
+            return 0
+        columns = ', '.join(deltas)
+        placeholders = ', '.join(['%s'] * len(deltas))
+        updates = ', '.join(f"{field} = GREATEST({field} + VALUES({field}), 0)" for field in deltas)
+        query = f"""
+        INSERT INTO keyword_stats (keyword, {columns})
+        VALUES (%s, {placeholders})
+        ON DUPLICATE KEY UPDATE {updates}
+        """
+        params = (keyword, *deltas.values())
+        if cursor is not None:
+            cursor.execute(query, params)
+            return cursor.rowcount
+        return self.execute_update(query, params)
+
+    def refresh_keyword_stats(self, keyword, fields=None):
+        """用索引COUNT重新计算关键词的统计字段（默认全部字段）"""
+        fields = [field for field in (fields or KEYWORD_STATS_QUERIES) if field in KEYWORD_STATS_QUERIES]
+        if not keyword or not fields:
+            return 0
+        columns = ', '.join(fields)
+        subqueries = ', '.join(f"({KEYWORD_STATS_QUERIES[field]})" for field in fields)
+        updates = ', '.join(f"{field} = VALUES({field})" for field in fields)
+        query = f"""
+        INSERT INTO keyword_stats (keyword, {columns})
+        VALUES (%s, {subqueries})
+        ON DUPLICATE KEY UPDATE {updates}
+        """
+        return self.execute_update(query, (keyword,) * (len(fields) + 1))
+
+    def refresh_video_keyword_stats(self, video_id):
+        """视频状态变化后重新计算其关键词的已处理视频数"""
+        result = self.execute_query("SELECT keyword FROM tiktok_videos WHERE id = %s", (video_id,))
+        if result:
+            self.refresh_keyword_stats(result[0]['keyword'], ['processed_videos'])
+
+    def get_all_keyword_stats(self):
+        """获取所有关键词的统计汇总，返回 {keyword: stats}"""
+        results = self.execute_query("SELECT * FROM keyword_stats")
+        return {row['keyword']: row for row in results or []}
+
     def get_tiktok_task_status(self, task_id):
         """获取TikTok任务状态"""
         query = f"SELECT status FROM tiktok_tasks WHERE id = {task_id}"
@@ -406,12 +1166,87 @@ class MySQLDatabase:
         VALUES (%s, %s, %s, %s, %s, %s, %s)
         """
         params = (video_id, user_id, reply_content, reply_time, keyword, collected_by, video_url)
-        return self.execute_update(query, params)
+        affected_rows = self.execute_update(query, params)
+        if affected_rows > 0:
+            self.bump_keyword_stats(keyword, comments_count=affected_rows)
+        return affected_rows
+
+    def add_tiktok_comments_batch(self, comments, task_id=None):
+        """
+        批量写入TikTok评论，忽略重复的user_id和reply_content组合
+
+        整批评论通过一条多行 INSERT IGNORE 写入（pymysql 的 executemany 会把 VALUES 子句合并为多行插入），
+        传入 task_id 时再在同一事务内执行一条 SELECT 查询任务状态，整批共两次往返、一次提交，
+        而逐条插入每条评论都需要一次往返和提交。
+
+        :param comments: 评论字典列表，字段同 add_tiktok_comment 的参数，
+            可选 platform_comment_id、platform_parent_id、likes_count、is_pinned（network采集引擎提供）
+        :param task_id: 可选，传入时同时返回该任务的当前状态
+        :return: {'inserted': 新插入条数, 'duplicates': 重复忽略条数, 'task_status': 任务状态或None}，出错时返回None
+        """
+        if not comments:
+            return {'inserted': 0, 'duplicates': 0, 'task_status': None}
+
+        query = """
+        INSERT IGNORE INTO tiktok_comments 
+        (video_id, user_id, reply_content, reply_time, keyword, collected_by, video_url,
+         platform_comment_id, platform_parent_id, likes_count, is_pinned)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        data = [(
+            comment['video_id'],
+            comment['user_id'],
+            comment['reply_content'],
+            comment['reply_time'],
+            comment['keyword'],
+            comment['collected_by'],
+            comment['video_url'],
+            comment.get('platform_comment_id'),
+            comment.get('platform_parent_id'),
+            comment.get('likes_count'),
+            bool(comment.get('is_pinned', False))
+        ) for comment in comments]
+
+        keywords = {comment['keyword'] for comment in comments}
+
+        self.log_sql(query, f"(批量插入 {len(data)} 条评论)")
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.executemany(query, data)
+                inserted = cursor.rowcount
+                if inserted > 0 and len(keywords) == 1:
+                    # 同一事务内更新关键词评论数
+                    self.bump_keyword_stats(next(iter(keywords)), cursor=cursor, comments_count=inserted)
+                task_status = None
+                if task_id is not None:
+                    cursor.execute("SELECT status FROM tiktok_tasks WHERE id = %s", (task_id,))
+                    row = cursor.fetchone()
+                    task_status = row['status'] if row else None
+            self.connection.commit()
+            if inserted > 0 and len(keywords) > 1:
+                # 混合多个关键词时无法按关键词拆分插入数，改为重新计算
+                for keyword in keywords:
+                    self.refresh_keyword_stats(keyword, ['comments_count'])
+            return {'inserted': inserted, 'duplicates': len(data) - inserted, 'task_status': task_status}
+        except pymysql.Error as e:
+            logger.error(f"批量插入评论时出错: {e}")
+            self.connection.rollback()
+            return None
+
+    def link_tiktok_comment_parents(self, video_id):
+        """按平台父评论ID回填视频下回复的 parent_comment_id，返回关联的回复数"""
+        query = """
+        UPDATE tiktok_comments c
+        JOIN tiktok_comments p ON p.platform_comment_id = c.platform_parent_id
+        SET c.parent_comment_id = p.id
+        WHERE c.video_id = %s AND c.platform_parent_id IS NOT NULL AND c.parent_comment_id IS NULL
+        """
+        return self.execute_update(query, (video_id,))
 
     def add_tiktok_task_log(self, task_id, log_type, message):
         """添加TikTok任务日志"""
-        query = f"INSERT INTO tiktok_task_logs (task_id, log_type, message) VALUES ({task_id}, '{log_type}', '{message}')"
-        return self.execute_update(query)
+        query = "INSERT INTO tiktok_task_logs (task_id, log_type, message) VALUES (%s, %s, %s)"
+        return self.execute_update(query, (task_id, log_type, message))
 
     def get_pending_tiktok_tasks(self):
         """获取待处理的TikTok任务"""
@@ -478,56 +1313,111 @@ class MySQLDatabase:
         """
         return self.execute_query(query)
 
-    def get_next_pending_video(self, task_id, server_ip):
-        """获取下一个待处理的视频，优先返回正在处理中的本机视频"""
+    def claim_next_video(self, task_id, lease_owner, server_ip=None, lease_seconds=VIDEO_LEASE_SECONDS):
+        """
+        领取任务的下一个视频并加租约
+
+        在一个短事务内用 SELECT ... FOR UPDATE SKIP LOCKED 先选租约已过期的视频，没有时再选待处理的视频，
+        再按主键更新为 processing 并写入租约持有者和过期时间。并发的领取方会跳过已被锁定的行，互不等待。
+
+        Returns:
+            dict: {'id', 'video_url', 'status', 'reclaimed'}，没有可领取的视频时返回None
+        """
+        update_query = """
+        UPDATE tiktok_videos
+        SET status = 'processing', processing_server_ip = %s, lease_owner = %s,
+            lease_expires_at = NOW() + INTERVAL %s SECOND
+        WHERE id = %s
+        """
         try:
             with self.connection.cursor() as cursor:
-                # 步骤1：查找正在处理中且由本机IP处理的视频
-                processing_query = f"""
-                SELECT id, video_url, 'processing' as status FROM tiktok_videos
-                WHERE task_id = {task_id} AND status = 'processing' AND processing_server_ip = '{server_ip}'
-                LIMIT 1
-                """
-                cursor.execute(processing_query)
-                processing_result = cursor.fetchone()
-
-                if processing_result:
-                    logger.info(f"找正在理中的本机视频：ID {processing_result['id']}, URL {processing_result['video_url']}")
-                    return processing_result
-
-                # 步骤2：如果没有正在处理的本机视频，则查找新的待处理视频
-                select_query = f"""
-                SELECT id, video_url FROM tiktok_videos
-                WHERE task_id = {task_id} AND status = 'pending'
-                LIMIT 1
-                FOR UPDATE
-                """
-                cursor.execute(select_query)
-                result = cursor.fetchone()
-
-                if result:
-                    video_id, video_url = result['id'], result['video_url']
-                    
-                    # 更新视频状态
-                    update_query = f"""
-                    UPDATE tiktok_videos
-                    SET status = 'processing', processing_server_ip = '{server_ip}'
-                    WHERE id = {video_id}
-                    """
-                    cursor.execute(update_query)
+                video = None
+                for select_query in (CLAIM_EXPIRED_VIDEO_QUERY, CLAIM_PENDING_VIDEO_QUERY):
+                    self.log_sql(select_query, (task_id,))
+                    cursor.execute(select_query, (task_id,))
+                    video = cursor.fetchone()
+                    if video:
+                        break
+                if not video:
                     self.connection.commit()
-
-                    logger.info(f"成功更新新的待处理视频状态：ID {video_id}, URL {video_url}")
-                    return {'id': video_id, 'video_url': video_url, 'status': 'processing'}
-                else:
-                    logger.info(f"任务 {task_id} 没有更多待理的视频")
                     return None
-
+                cursor.execute(update_query, (server_ip, lease_owner, lease_seconds, video['id']))
+            self.connection.commit()
+            reclaimed = video['status'] == 'processing'
+            logger.info(f"{lease_owner} 领取视频 ID {video['id']}{'（回收过期租约）' if reclaimed else ''}")
+            return {'id': video['id'], 'video_url': video['video_url'], 'status': 'processing', 'reclaimed': reclaimed}
         except pymysql.Error as e:
-            logger.error(f"获取下一个待处理视频时出错: {e}")
+            logger.error(f"领取视频时出错: {e}")
             self.connection.rollback()
             return None
 
+    def count_unfinished_task_videos(self, task_id):
+        """
+        统计任务中待处理或处理中的视频数
+
+        Returns:
+            int: 未完成的视频数，查询出错时返回None
+        """
+        result = self.execute_query(UNFINISHED_TASK_VIDEOS_QUERY, (task_id,))
+        if result is None:
+            return None
+        return result[0]['unfinished'] if result else 0
+
+    def extend_video_lease(self, video_id, lease_owner, lease_seconds=VIDEO_LEASE_SECONDS):
+        """
+        延长视频租约
+
+        Returns:
+            bool: 租约仍由 lease_owner 持有时返回True，已被回收或视频已结束时返回False
+        """
+        query = """
+        UPDATE tiktok_videos
+        SET lease_expires_at = NOW() + INTERVAL %s SECOND
+        WHERE id = %s AND lease_owner = %s AND status = 'processing'
+        """
+        if self.execute_update(query, (lease_seconds, video_id, lease_owner)) > 0:
+            return True
+        # 同一秒内重复延期时影响行数为0，需要确认租约是否仍属于自己
+        result = self.execute_query(
+            "SELECT 1 FROM tiktok_videos WHERE id = %s AND lease_owner = %s AND status = 'processing'",
+            (video_id, lease_owner)
+        )
+        return bool(result)
+
+    def release_video_lease(self, video_id, lease_owner, status):
+        """
+        结束视频租约并设置最终状态（completed/failed/pending）
+
+        Returns:
+            bool: 租约仍由 lease_owner 持有且已更新时返回True
+        """
+        query = """
+        UPDATE tiktok_videos
+        SET status = %s, lease_owner = NULL, lease_expires_at = NULL,
+            processing_server_ip = CASE WHEN %s = 'completed' THEN processing_server_ip ELSE NULL END
+        WHERE id = %s AND lease_owner = %s AND status = 'processing'
+        """
+        released = self.execute_update(query, (status, status, video_id, lease_owner)) > 0
+        if released and status in ('completed', 'failed'):
+            self.refresh_video_keyword_stats(video_id)
+        return released
+
+    def reclaim_expired_video_leases(self, task_id=None):
+        """把租约已过期的处理中视频重置为待处理，返回回收的视频数"""
+        query = """
+        UPDATE tiktok_videos
+        SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, processing_server_ip = NULL
+        WHERE status = 'processing' AND lease_expires_at < NOW()
+        """
+        params = None
+        if task_id is not None:
+            query += " AND task_id = %s"
+            params = (task_id,)
+        reclaimed = self.execute_update(query, params)
+        if reclaimed > 0:
+            logger.info(f"回收了 {reclaimed} 个租约过期的视频")
+        return reclaimed
+
     def update_task_progress(self, task_id, videos_processed):
         """更新任务进度"""
         query = f"""
@@ -540,7 +1430,10 @@ class MySQLDatabase:
     def mark_video_completed(self, video_id):
         """标记视频为已完成"""
         query = f"UPDATE tiktok_videos SET status = 'completed' WHERE id = {video_id}"
-        return self.execute_update(query)
+        affected_rows = self.execute_update(query)
+        if affected_rows > 0:
+            self.refresh_video_keyword_stats(video_id)
+        return affected_rows
 
     def get_tiktok_videos_for_task(self, task_id, limit=100):
         """获取指定任务的待处理视频列表"""
@@ -562,8 +1455,11 @@ class MySQLDatabase:
         try:
             with self.connection.cursor() as cursor:
                 cursor.executemany(query, data)
+                affected_rows = cursor.rowcount
+                if affected_rows > 0:
+                    # 同一事务内更新关键词视频总数
+                    self.bump_keyword_stats(keyword, cursor=cursor, total_videos=affected_rows)
             self.connection.commit()
-            affected_rows = cursor.rowcount
             logger.info(f"成功插入 {affected_rows} 条新视频记录，忽略了 {len(data) - affected_rows} 条重复记录")
             return affected_rows
         except pymysql.Error as e:
@@ -624,33 +1520,43 @@ class MySQLDatabase:
 
     def get_tiktok_tasks_by_keyword(self, keyword):
         """获取指定关键词的TikTok任务"""
-        query = "SELECT * FROM tiktok_tasks WHERE keyword LIKE %s ORDER BY created_at DESC"
-        params = (f"%{keyword}%",)
-        return self.execute_query(query, params)
+        return self.execute_query(TIKTOK_TASKS_BY_KEYWORD_QUERY, (keyword,))
 
     def get_tiktok_comments_by_keyword(self, keyword):
         """获取指定关键词的TikTok评论"""
+        return self.execute_query(TIKTOK_COMMENTS_BY_KEYWORD_QUERY, (keyword,))
+
+    def stream_tiktok_comments_by_keyword(self, keyword, chunk_size=STREAM_CHUNK_SIZE, order_by_user=False,
+                                          min_id=None, max_id=None):
+        """
+        流式获取指定关键词的TikTok评论，按块产出，不限制总数
+
+        Args:
+            order_by_user: 为True时按 user_id 排序（走 idx_keyword_user）
+            min_id: 只取 id 大于该值的评论（增量过滤，走 idx_keyword_id）
+            max_id: 只取 id 小于等于该值的评论
+        """
+        query = build_comments_stream_query('tiktok', min_id is not None, max_id is not None, order_by_user)
+        params = [keyword] + [value for value in (min_id, max_id) if value is not None]
+        return self.stream_query(query, tuple(params), chunk_size=chunk_size)
+
+    def get_max_tiktok_comment_id(self, keyword, settle_seconds=FILTER_WATERMARK_SETTLE_SECONDS):
+        """
+        获取指定关键词可以作为过滤水位的最大评论ID，没有评论时返回0
+
+        只考虑采集时间早于 settle_seconds 秒前的评论（见 FILTER_WATERMARK_SETTLE_SECONDS），
+        更新的评论留到下次增量过滤。
+        """
         query = """
-        SELECT c.* FROM tiktok_comments c
-        JOIN tiktok_videos v ON c.video_id = v.id
-        JOIN tiktok_tasks t ON v.task_id = t.id
-        WHERE t.keyword LIKE %s
-        LIMIT 99999
+        SELECT MAX(id) AS max_id FROM tiktok_comments
+        WHERE keyword = %s AND collected_at < NOW() - INTERVAL %s SECOND
         """
-        params = (f"%{keyword}%",)
-        return self.execute_query(query, params)
+        result = self.execute_query(query, (keyword, settle_seconds))
+        return result[0]['max_id'] or 0 if result else 0
 
     def get_tiktok_task_logs_by_keyword(self, keyword):
         """获取指定关键词的任务日志"""
-        query = """
-        SELECT l.* FROM tiktok_task_logs l
-        JOIN tiktok_tasks t ON l.task_id = t.id
-        WHERE t.keyword LIKE %s
-        ORDER BY l.created_at DESC
-        LIMIT 99999
-        """
-        params = (f"%{keyword}%",)
-        return self.execute_query(query, params)
+        return self.execute_query(TIKTOK_TASK_LOGS_BY_KEYWORD_QUERY, (keyword,))
 
     def get_tiktok_collection_stats(self):
         """获取TikTok收集统计信息"""
@@ -684,24 +1590,20 @@ class MySQLDatabase:
         """获取指定关键词的总视频数"""
         query = """
         SELECT COUNT(*) as total_videos
-        FROM tiktok_videos v
-        JOIN tiktok_tasks t ON v.task_id = t.id
-        WHERE t.keyword LIKE %s
+        FROM tiktok_videos
+        WHERE keyword = %s
         """
-        params = (f"%{keyword}%",)
-        result = self.execute_query(query, params)
+        result = self.execute_query(query, (keyword,))
         return result[0]['total_videos'] if result else 0
 
     def get_processed_videos_for_keyword(self, keyword):
         """获取指定关键词的已处理视频数"""
         query = """
         SELECT COUNT(*) as processed_videos
-        FROM tiktok_videos v
-        JOIN tiktok_tasks t ON v.task_id = t.id
-        WHERE t.keyword LIKE %s AND v.status IN ('completed', 'failed')
+        FROM tiktok_videos
+        WHERE keyword = %s AND status IN ('completed', 'failed')
         """
-        params = (f"%{keyword}%",)
-        result = self.execute_query(query, params)
+        result = self.execute_query(query, (keyword,))
         return result[0]['processed_videos'] if result else 0
 
     def get_tiktok_task_by_id(self, task_id):
@@ -787,7 +1689,10 @@ class MySQLDatabase:
         WHERE id = %s
         """
         params = (status, status, video_id)
-        return self.execute_update(query, params)
+        affected_rows = self.execute_update(query, params)
+        if affected_rows > 0:
+            self.refresh_video_keyword_stats(video_id)
+        return affected_rows
 
     def add_tiktok_account(self, username, password, email, login_ips):
         """添加新的TikTok账号"""
@@ -851,12 +1756,23 @@ class MySQLDatabase:
         return [result['keyword'] for result in results if result.get('keyword')]
 
     def save_filtered_comments(self, filtered_comments):
-        """保存过滤后的评论到新表"""
+        """
+        保存过滤后的评论到新表
+
+        按 (keyword, user_id) 去重：用户已有过滤结果时把新评论追加到原评论后面（增量过滤时合并同一用户），
+        likes_count 累加；新评论不是垃圾评论时清除原有的 spam_reason。
+        """
         query = """
         INSERT INTO tiktok_filtered_comments 
         (video_id, keyword, user_id, reply_content, reply_time, likes_count, is_pinned, 
-        parent_comment_id, collected_at, collected_by, video_url)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        parent_comment_id, collected_at, collected_by, video_url, spam_reason)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            reply_content = IF(LOCATE(VALUES(reply_content), reply_content) > 0, reply_content,
+                               CONCAT_WS(' ', reply_content, VALUES(reply_content))),
+            likes_count = COALESCE(likes_count, 0) + COALESCE(VALUES(likes_count), 0),
+            is_pinned = is_pinned OR VALUES(is_pinned),
+            spam_reason = IF(VALUES(spam_reason) IS NULL, NULL, spam_reason)
         """
         values = [(
             comment.get('video_id'),
@@ -869,35 +1785,87 @@ class MySQLDatabase:
             comment.get('parent_comment_id'),
             comment['collected_at'],
             comment['collected_by'],
-            comment['video_url']
+            comment['video_url'],
+            comment.get('spam_reason')
         ) for comment in filtered_comments]
         
-        return self.insert_many(query, values)
+        saved_count = self.insert_many(query, values)
+        if saved_count > 0:
+            for keyword in {comment['keyword'] for comment in filtered_comments}:
+                self.refresh_keyword_stats(keyword, ['filtered_count'])
+        return saved_count
+
+    def stream_filtered_tiktok_comment_texts(self, keyword, chunk_size=STREAM_CHUNK_SIZE):
+        """流式获取指定关键词已保存的过滤结果的 user_id 和 reply_content（含垃圾评论），按块产出"""
+        return self.stream_query(FILTERED_COMMENT_TEXTS_QUERIES['tiktok'], (keyword,), chunk_size=chunk_size)
+
+    def get_filtered_tiktok_comments_by_keyword(self, keyword, limit=1000, include_spam=False):
+        """获取指定关键词的过滤后评论，默认不含被标记为垃圾评论的行"""
+        return self.execute_query(build_filtered_comments_query('tiktok', include_spam), (keyword, limit))
+
+    def get_filter_watermark(self, platform, keyword):
+        """获取关键词的过滤水位 {'last_comment_id', 'rules_hash', 'updated_at'}，没有记录时返回None"""
+        query = """
+        SELECT last_comment_id, rules_hash, updated_at FROM filter_watermarks
+        WHERE platform = %s AND keyword = %s
+        """
+        result = self.execute_query(query, (platform, keyword))
+        return result[0] if result else None
 
-    def get_filtered_tiktok_comments_by_keyword(self, keyword, limit=1000):
+    def save_filter_watermark(self, platform, keyword, last_comment_id, rules_hash):
+        """记录关键词已过滤到的评论ID和所用规则"""
         query = """
-        SELECT * FROM tiktok_filtered_comments
-        WHERE keyword = %s
-        LIMIT %s
+        INSERT INTO filter_watermarks (platform, keyword, last_comment_id, rules_hash)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE last_comment_id = VALUES(last_comment_id), rules_hash = VALUES(rules_hash)
         """
-        return self.execute_query(query, (keyword, limit))
+        return self.execute_update(query, (platform, keyword, last_comment_id, rules_hash))
+
+    def add_filtered_duplicate_counts(self, keyword, duplicate_counts):
+        """累加过滤结果的近重复计数，duplicate_counts 为 {user_id: 被合并的近重复评论数}"""
+        if not duplicate_counts:
+            return 0
+        query = """
+        UPDATE tiktok_filtered_comments SET duplicate_count = duplicate_count + %s
+        WHERE keyword = %s AND user_id = %s
+        """
+        return self.insert_many(query, [(count, keyword, user_id) for user_id, count in duplicate_counts.items()])
+
+    def clear_filtered_comments_by_keyword(self, keyword):
+        """清空指定关键词的过滤结果和过滤水位（全量重新过滤时与重新写入在同一事务中调用）"""
+        result = self.execute_update("DELETE FROM tiktok_filtered_comments WHERE keyword = %s", (keyword,))
+        self.execute_update("DELETE FROM filter_watermarks WHERE platform = 'tiktok' AND keyword = %s", (keyword,))
+        self.refresh_keyword_stats(keyword, ['filtered_count'])
+        return result
 
     def save_analyzed_comments(self, keyword, analyzed_data):
         """保存分析后的评论数据"""
         query = """
         INSERT INTO tiktok_analyzed_comments 
-        (keyword, user_id, reply_content, classification, analysis_reason)
-        VALUES (%s, %s, %s, %s, %s)
+        (keyword, user_id, reply_content, classification, analysis_reason, label_source)
+        VALUES (%s, %s, %s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE
         classification = VALUES(classification),
         analysis_reason = VALUES(analysis_reason),
+        label_source = VALUES(label_source),
         analyzed_at = CURRENT_TIMESTAMP
         """
         values = [
-            (keyword, row['用户ID'], row['评论内容'], row['分类结果'], row['分析理由'])
+            (keyword, row['用户ID'], row['评论内容'], row['分类结果'], row['分析理由'], row.get('标注来源') or 'gpt')
             for _, row in analyzed_data.iterrows()
         ]
-        return self.insert_many(query, values)
+        saved_count = self.insert_many(query, values)
+        if saved_count > 0:
+            self.refresh_keyword_stats(keyword, ['potential_count'])
+        return saved_count
+
+    def get_pre_classifier_training_data(self, keyword):
+        """获取用于训练本地预分类模型的GPT第一轮分类结果（不含预分类模型自己标注的结果）"""
+        query = """
+        SELECT reply_content, classification FROM tiktok_analyzed_comments
+        WHERE keyword = %s AND label_source = 'gpt'
+        """
+        return self.execute_query(query, (keyword,)) or []
 
     def get_analyzed_comments(self, keyword, limit=1000):
         """获取指定关键词的分析后评论数据"""
@@ -910,11 +1878,11 @@ class MySQLDatabase:
         return self.execute_query(query, (keyword, limit))
 
     def get_filtered_tiktok_comments_count(self, keyword):
-        """获取指定关键词的已过滤评论数量"""
+        """获取指定关键词可用于分析的已过滤评论数量（不含垃圾评论）"""
         query = """
         SELECT COUNT(*) as count
         FROM tiktok_filtered_comments
-        WHERE keyword = %s
+        WHERE keyword = %s AND spam_reason IS NULL
         """
         result = self.execute_query(query, (keyword,))
         return result[0]['count'] if result else 0
@@ -934,7 +1902,10 @@ class MySQLDatabase:
             (keyword, row['用户ID'], row['评论内容'], row['第一轮分类结果'], row['第二轮分类结果'], row['分析理由'])
             for _, row in analyzed_data.iterrows()
         ]
-        return self.insert_many(query, values)
+        saved_count = self.insert_many(query, values)
+        if saved_count > 0:
+            self.refresh_keyword_stats(keyword, ['high_intent_count'])
+        return saved_count
 
     def get_second_round_analyzed_comments(self, keyword, limit=1000):
         """获取指定关键词的第二轮分析后评论数据"""
@@ -958,13 +1929,279 @@ class MySQLDatabase:
 
     def get_potential_customers(self, keyword, limit=1000):
         """获取指定关键词潜在客户评论数据"""
+        return self.execute_query(POTENTIAL_CUSTOMERS_QUERIES['tiktok'], (keyword, limit))
+
+    def get_gpt_cache_results(self, cache_keys, chunk_size=1000):
+        """
+        按缓存键批量查询GPT结果缓存
+
+        Returns:
+            dict: {cache_key: result}，未命中的键不在结果中
+        """
+        results = {}
+        cache_keys = list(cache_keys)
+        for i in range(0, len(cache_keys), chunk_size):
+            chunk = cache_keys[i:i + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            query = f"SELECT cache_key, result FROM gpt_result_cache WHERE cache_key IN ({placeholders})"
+            rows = self.execute_query(query, tuple(chunk)) or []
+            for row in rows:
+                result = row['result']
+                results[row['cache_key']] = json.loads(result) if isinstance(result, (str, bytes)) else result
+        return results
+
+    def save_gpt_cache_results(self, entries):
+        """
+        批量写入GPT结果缓存
+
+        Args:
+            entries: [(cache_key, model, template_hash, result_dict)]
+        """
+        if not entries:
+            return 0
         query = """
-        SELECT * FROM tiktok_analyzed_comments
-        WHERE keyword = %s AND classification = '潜在客户'
-        ORDER BY analyzed_at DESC
-        LIMIT %s
+        INSERT INTO gpt_result_cache (cache_key, model, template_hash, result)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+        result = VALUES(result),
+        created_at = CURRENT_TIMESTAMP
         """
-        return self.execute_query(query, (keyword, limit))
+        values = [
+            (cache_key, model, template_hash, json.dumps(result, ensure_ascii=False))
+            for cache_key, model, template_hash, result in entries
+        ]
+        return self.insert_many(query, values)
+
+    def create_gpt_batch_job(self, platform, keyword, analysis_round, model, template_hash, fields):
+        """创建一条GPT批量任务记录（状态为 preparing），返回任务ID"""
+        query = """
+        INSERT INTO gpt_batch_jobs (platform, keyword, analysis_round, model, template_hash, output_fields)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        result = self.execute_update(query, (platform, keyword, analysis_round, model, template_hash,
+                                             json.dumps(fields, ensure_ascii=False)))
+        if result > 0:
+            return self.execute_query("SELECT LAST_INSERT_ID() as id")[0]['id']
+        logger.error(f"创建关键字为 '{keyword}' 的GPT批量任务失败")
+        return None
+
+    def add_gpt_batch_requests(self, job_id, requests):
+        """
+        保存批量任务中每个请求对应的评论，导入结果时按 custom_id 找回
+
+        Args:
+            requests: [(custom_id, [{'user_id', 'reply_content'}])]
+        """
+        query = "INSERT INTO gpt_batch_requests (job_id, custom_id, comments) VALUES (%s, %s, %s)"
+        values = [(job_id, custom_id, json.dumps(comments, ensure_ascii=False)) for custom_id, comments in requests]
+        return self.insert_many(query, values)
+
+    def get_gpt_batch_requests(self, job_id):
+        """获取批量任务的请求清单 {custom_id: 评论列表}"""
+        rows = self.execute_query("SELECT custom_id, comments FROM gpt_batch_requests WHERE job_id = %s",
+                                  (job_id,)) or []
+        return {row['custom_id']: json.loads(row['comments']) for row in rows}
+
+    def update_gpt_batch_job(self, job_id, **kwargs):
+        """更新GPT批量任务的状态、文件ID和统计字段"""
+        allowed_fields = ['status', 'provider_batch_id', 'input_file_id', 'output_file_id', 'error_file_id',
+                          'request_count', 'comment_count', 'completed_requests', 'failed_requests',
+                          'saved_count', 'missing_count', 'error_message', 'finished_at']
+        updates = [(key, value) for key, value in kwargs.items() if key in allowed_fields]
+        if not updates:
+            logger.warning("没有提供有效的更新字段")
+            return 0
+        query = f"UPDATE gpt_batch_jobs SET {', '.join(f'{key} = %s' for key, _ in updates)} WHERE id = %s"
+        return self.execute_update(query, tuple(value for _, value in updates) + (job_id,))
+
+    def expire_stale_gpt_batch_jobs(self, timeout_seconds):
+        """
+        把超过 timeout_seconds 秒没有更新、仍未提交到服务端的 preparing 任务标记为failed
+        （提交进程在写文件或上传途中退出），返回标记的任务数
+        """
+        query = """
+        UPDATE gpt_batch_jobs
+        SET status = 'failed', error_message = %s, finished_at = NOW()
+        WHERE status = 'preparing' AND provider_batch_id IS NULL AND updated_at < NOW() - INTERVAL %s SECOND
+        """
+        expired = self.execute_update(query, (f"超过 {timeout_seconds} 秒未完成提交", timeout_seconds))
+        if expired > 0:
+            logger.warning(f"{expired} 个GPT批量任务提交超时，已标记为failed")
+        return expired
+
+    def get_gpt_batch_jobs(self, platform=None, keyword=None, statuses=None, limit=100):
+        """按平台、关键词和状态查询GPT批量任务，按创建时间倒序"""
+        conditions, params = [], []
+        if platform:
+            conditions.append("platform = %s")
+            params.append(platform)
+        if keyword:
+            conditions.append("keyword = %s")
+            params.append(keyword)
+        if statuses:
+            conditions.append(f"status IN ({', '.join(['%s'] * len(statuses))})")
+            params.extend(statuses)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT * FROM gpt_batch_jobs {where} ORDER BY created_at DESC LIMIT %s"
+        rows = self.execute_query(query, tuple(params) + (limit,)) or []
+        for row in rows:
+            if isinstance(row.get('output_fields'), (str, bytes)):
+                row['output_fields'] = json.loads(row['output_fields'])
+        return rows
+
+    def create_analysis_job(self, platform, keyword, model, batch_size, total_comments, prompt_template_first,
+                            prompt_template_second, pre_classifier=None, pre_threshold=None):
+        """
+        创建后台分析任务，同一关键词已有未结束的任务时返回该任务ID
+
+        Args:
+            pre_classifier: 序列化后的本地预分类模型（bytes），None表示不使用
+        """
+        existing = self.execute_query(
+            "SELECT id FROM analysis_jobs WHERE platform = %s AND keyword = %s AND status IN ('pending', 'running') "
+            "ORDER BY id DESC LIMIT 1",
+            (platform, keyword)
+        )
+        if existing:
+            logger.info(f"关键字 '{keyword}' 已有未结束的分析任务，任务ID: {existing[0]['id']}")
+            return existing[0]['id']
+
+        query = """
+        INSERT INTO analysis_jobs (platform, keyword, model, batch_size, total_comments, prompt_template_first,
+                                   prompt_template_second, pre_classifier, pre_threshold)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        result = self.execute_update(query, (platform, keyword, model, batch_size, total_comments,
+                                             prompt_template_first, prompt_template_second, pre_classifier,
+                                             pre_threshold))
+        if result > 0:
+            job_id = self.execute_query("SELECT LAST_INSERT_ID() as id")[0]['id']
+            logger.info(f"创建关键字为 '{keyword}' 的分析任务，任务ID: {job_id}")
+            return job_id
+        logger.error(f"创建关键字为 '{keyword}' 的分析任务失败")
+        return None
+
+    def claim_analysis_job(self, lease_owner, lease_seconds=ANALYSIS_JOB_LEASE_SECONDS,
+                           max_attempts=ANALYSIS_JOB_MAX_ATTEMPTS):
+        """
+        领取一个待执行或租约已过期的分析任务并加租约（SELECT ... FOR UPDATE SKIP LOCKED，与 claim_next_video 相同）
+
+        Returns:
+            dict: 完整的任务行（含prompt和预分类模型），没有可领取的任务时返回None
+        """
+        select_query = """
+        SELECT * FROM analysis_jobs
+        WHERE (status = 'pending' OR (status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < NOW())))
+          AND attempts < %s
+        ORDER BY status = 'running' DESC, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+        """
+        update_query = """
+        UPDATE analysis_jobs
+        SET status = 'running', lease_owner = %s, lease_expires_at = NOW() + INTERVAL %s SECOND,
+            attempts = attempts + 1, started_at = COALESCE(started_at, NOW())
+        WHERE id = %s
+        """
+        self.log_sql(select_query, (max_attempts,))
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(select_query, (max_attempts,))
+                job = cursor.fetchone()
+                if not job:
+                    self.connection.commit()
+                    return None
+                cursor.execute(update_query, (lease_owner, lease_seconds, job['id']))
+            self.connection.commit()
+            resumed = job['status'] == 'running'
+            logger.info(f"{lease_owner} 领取分析任务 ID {job['id']}{'（回收过期租约，从 ' + job['stage'] + ' 继续）' if resumed else ''}")
+            job.update(status='running', lease_owner=lease_owner, attempts=job['attempts'] + 1)
+            return job
+        except pymysql.Error as e:
+            logger.error(f"领取分析任务时出错: {e}")
+            self.connection.rollback()
+            return None
+
+    def update_analysis_job_progress(self, job_id, lease_owner, lease_seconds=ANALYSIS_JOB_LEASE_SECONDS, **kwargs):
+        """
+        记录分析任务的阶段和进度并续租
+
+        Returns:
+            bool: 任务仍由 lease_owner 持有且在运行时返回True；任务已取消或租约被回收时返回False，调用方应停止
+        """
+        allowed_fields = ['stage', 'progress_done', 'progress_total', 'cached_count', 'pre_labeled_count',
+                          'first_round_saved', 'second_round_saved', 'ignored_count']
+        updates = [(key, value) for key, value in kwargs.items() if key in allowed_fields]
+        assignments = ''.join(f"{key} = %s, " for key, _ in updates)
+        query = f"""
+        UPDATE analysis_jobs
+        SET {assignments}lease_expires_at = NOW() + INTERVAL %s SECOND
+        WHERE id = %s AND lease_owner = %s AND status = 'running'
+        """
+        params = tuple(value for _, value in updates) + (lease_seconds, job_id, lease_owner)
+        if self.execute_update(query, params) > 0:
+            return True
+        # 值未变化且同一秒内续租时影响行数为0，需要确认任务是否仍属于自己
+        result = self.execute_query(
+            "SELECT 1 FROM analysis_jobs WHERE id = %s AND lease_owner = %s AND status = 'running'",
+            (job_id, lease_owner)
+        )
+        return bool(result)
+
+    def finish_analysis_job(self, job_id, lease_owner, status, error_message=None):
+        """结束分析任务（completed / failed），任务已被取消或租约已被回收时不修改"""
+        query = """
+        UPDATE analysis_jobs
+        SET status = %s, error_message = %s, finished_at = NOW(), lease_expires_at = NULL
+        WHERE id = %s AND lease_owner = %s AND status = 'running'
+        """
+        return self.execute_update(query, (status, error_message, job_id, lease_owner)) > 0
+
+    def fail_exhausted_analysis_jobs(self, max_attempts=ANALYSIS_JOB_MAX_ATTEMPTS):
+        """把租约已过期且重试次数用完的任务标记为失败，返回标记的任务数"""
+        query = """
+        UPDATE analysis_jobs
+        SET status = 'failed', finished_at = NOW(), error_message = COALESCE(error_message, %s)
+        WHERE status = 'running' AND lease_expires_at < NOW() AND attempts >= %s
+        """
+        return self.execute_update(query, (f"worker 多次中断（已执行 {max_attempts} 次）", max_attempts))
+
+    def cancel_analysis_job(self, job_id):
+        """取消未结束的分析任务，运行中的任务在下一次记录进度时停止"""
+        query = """
+        UPDATE analysis_jobs SET status = 'cancelled', finished_at = NOW(), lease_expires_at = NULL
+        WHERE id = %s AND status IN ('pending', 'running')
+        """
+        return self.execute_update(query, (job_id,))
+
+    def retry_analysis_job(self, job_id):
+        """重新执行失败或已取消的分析任务，从上次记录的阶段继续（已保存的结果通过结果缓存跳过）"""
+        query = """
+        UPDATE analysis_jobs
+        SET status = 'pending', attempts = 0, error_message = NULL, finished_at = NULL,
+            lease_owner = NULL, lease_expires_at = NULL
+        WHERE id = %s AND status IN ('failed', 'cancelled')
+        """
+        return self.execute_update(query, (job_id,))
+
+    def get_analysis_job(self, job_id):
+        """获取分析任务的状态和进度"""
+        result = self.execute_query(f"SELECT {ANALYSIS_JOB_PROGRESS_COLUMNS} FROM analysis_jobs WHERE id = %s",
+                                    (job_id,))
+        return result[0] if result else None
+
+    def get_analysis_jobs(self, platform=None, keyword=None, limit=20):
+        """按平台和关键词查询分析任务的状态和进度，按创建时间倒序"""
+        conditions, params = [], []
+        if platform:
+            conditions.append("platform = %s")
+            params.append(platform)
+        if keyword:
+            conditions.append("keyword = %s")
+            params.append(keyword)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT {ANALYSIS_JOB_PROGRESS_COLUMNS} FROM analysis_jobs {where} ORDER BY created_at DESC, id DESC LIMIT %s"
+        return self.execute_query(query, tuple(params) + (limit,)) or []
 
     def get_global_stats(self):
         """获取全局统计数据"""
@@ -975,20 +2212,18 @@ class MySQLDatabase:
         result = self.execute_query(query)
         stats['keyword_count'] = result[0]['keyword_count'] if result else 0
 
-        # 获取已收集的评论总数
-        query = "SELECT COUNT(*) as comment_count FROM tiktok_comments"
-        result = self.execute_query(query)
-        stats['comment_count'] = result[0]['comment_count'] if result else 0
-
-        # 获取潜在客户数量
-        query = "SELECT COUNT(*) as potential_customer_count FROM tiktok_analyzed_comments WHERE classification = '潜在客户'"
-        result = self.execute_query(query)
-        stats['potential_customer_count'] = result[0]['potential_customer_count'] if result else 0
-
-        # 获取高意向客户数量
-        query = "SELECT COUNT(*) as high_intent_customer_count FROM tiktok_second_round_analyzed_comments WHERE second_round_classification = '高意向客户'"
+        # 评论总数、潜在客户和高意向客户数量从关键词统计汇总表读取，避免全表COUNT
+        query = """
+        SELECT COALESCE(SUM(comments_count), 0) as comment_count,
+               COALESCE(SUM(potential_count), 0) as potential_customer_count,
+               COALESCE(SUM(high_intent_count), 0) as high_intent_customer_count
+        FROM keyword_stats
+        """
         result = self.execute_query(query)
-        stats['high_intent_customer_count'] = result[0]['high_intent_customer_count'] if result else 0
+        row = result[0] if result else {}
+        stats['comment_count'] = int(row.get('comment_count', 0))
+        stats['potential_customer_count'] = int(row.get('potential_customer_count', 0))
+        stats['high_intent_customer_count'] = int(row.get('high_intent_customer_count', 0))
 
         return stats
 
@@ -1007,12 +2242,14 @@ class MySQLDatabase:
         """清空指定关键字的第一轮分析结果"""
         query = "DELETE FROM tiktok_analyzed_comments WHERE keyword = %s"
         result = self.execute_update(query, (keyword,))
+        self.refresh_keyword_stats(keyword, ['potential_count'])
         return result > 0  # 如果影响的行数大于0，则返回True
 
     def clear_second_round_analysis_by_keyword(self, keyword):
         """清空指定关键字的第二轮分析结果"""
         query = "DELETE FROM tiktok_second_round_analyzed_comments WHERE keyword = %s"
         result = self.execute_update(query, (keyword,))
+        self.refresh_keyword_stats(keyword, ['high_intent_count'])
         return result > 0  # 如果影响的行数大于0，则返回True
 
     def save_tiktok_message(self, keyword, user_id, message, delivery_method='unknown'):
@@ -1026,7 +2263,11 @@ class MySQLDatabase:
         status = 'pending',
         updated_at = CURRENT_TIMESTAMP
         """
-        return self.execute_update(query, (keyword, user_id, message, delivery_method))
+        affected_rows = self.execute_update(query, (keyword, user_id, message, delivery_method))
+        if affected_rows == 2:
+            # 覆盖了已有消息（状态重置为pending），已发送数可能变化
+            self.refresh_keyword_stats(keyword, ['messages_sent_count'])
+        return affected_rows
 
     def get_tiktok_messages(self, keyword, limit=1000):
         """获取指定关键词的TikTok私信"""
@@ -1053,7 +2294,12 @@ class MySQLDatabase:
         query += " WHERE user_id = %s"
         params.append(user_id)
 
-        return self.execute_update(query, tuple(params))
+        affected_rows = self.execute_update(query, tuple(params))
+        if affected_rows > 0:
+            keywords = self.execute_query("SELECT DISTINCT keyword FROM tiktok_messages WHERE user_id = %s", (user_id,))
+            for row in keywords or []:
+                self.refresh_keyword_stats(row['keyword'], ['messages_sent_count'])
+        return affected_rows
 
     def get_tiktok_messages_status(self, user_ids):
         query = """
@@ -1067,12 +2313,7 @@ class MySQLDatabase:
 
     def get_worker_ip_for_processing_messages(self, keyword):
         """获取正在处理指定关键词消息的worker IP"""
-        query = """
-        SELECT DISTINCT worker_ip
-        FROM tiktok_messages
-        WHERE keyword = %s AND status = 'processing' AND worker_ip IS NOT NULL
-        """
-        results = self.execute_query(query, (keyword,))
+        results = self.execute_query(PROCESSING_MESSAGE_WORKERS_QUERIES['tiktok'], (keyword,))
         return [result['worker_ip'] for result in results if result.get('worker_ip')]
 
     def update_tiktok_message_status_and_worker(self, user_id, status, worker_ip):
@@ -1210,7 +2451,8 @@ class MySQLDatabase:
         ]
 
         for query in create_tables_queries:
-            self.execute_update(query)
+            if self.execute_update(query) < 0:
+                raise SchemaMigrationError("创建X平台数据表失败")
         
         logger.info("所有必要的X平台表已创建或已存在")
 
@@ -1318,6 +2560,24 @@ class MySQLDatabase:
         """
         return self.execute_query(query, (keyword,))
 
+    def stream_x_comments_by_keyword(self, keyword, chunk_size=STREAM_CHUNK_SIZE, order_by_user=False,
+                                     min_id=None, max_id=None):
+        """流式获取指定关键词的X评论，按块产出，不限制总数；参数同 stream_tiktok_comments_by_keyword"""
+        query = build_comments_stream_query('x', min_id is not None, max_id is not None, order_by_user)
+        params = [keyword] + [value for value in (min_id, max_id) if value is not None]
+        return self.stream_query(query, tuple(params), chunk_size=chunk_size)
+
+    def get_max_x_comment_id(self, keyword, settle_seconds=FILTER_WATERMARK_SETTLE_SECONDS):
+        """获取指定关键词可以作为过滤水位的最大X评论ID，没有评论时返回0；参数同 get_max_tiktok_comment_id"""
+        query = """
+        SELECT MAX(c.id) AS max_id FROM x_comments c
+        JOIN x_tweets t ON c.tweet_id = t.id
+        JOIN x_tasks x ON t.task_id = x.id
+        WHERE x.keyword = %s AND c.collected_at < NOW() - INTERVAL %s SECOND
+        """
+        result = self.execute_query(query, (keyword, settle_seconds))
+        return result[0]['max_id'] or 0 if result else 0
+
     def get_all_x_keywords(self):
         """获取X平台所有关键字"""
         query = "SELECT DISTINCT keyword FROM x_tasks"
@@ -1325,12 +2585,23 @@ class MySQLDatabase:
         return [result['keyword'] for result in results]
 
     def save_filtered_x_comments(self, filtered_comments):
-        """保存过滤后的X评论到新表"""
+        """
+        保存过滤后的X评论到新表
+
+        按 (keyword, user_id) 去重：用户已有过滤结果时把新评论追加到原评论后面（增量过滤时合并同一用户），
+        likes_count 累加；新评论不是垃圾评论时清除原有的 spam_reason。
+        """
         query = """
         INSERT INTO x_filtered_comments 
         (tweet_id, keyword, user_id, reply_content, reply_time, likes_count, is_pinned, 
-        parent_comment_id, collected_at, collected_by, tweet_url)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        parent_comment_id, collected_at, collected_by, tweet_url, spam_reason)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            reply_content = IF(LOCATE(VALUES(reply_content), reply_content) > 0, reply_content,
+                               CONCAT_WS(' ', reply_content, VALUES(reply_content))),
+            likes_count = COALESCE(likes_count, 0) + COALESCE(VALUES(likes_count), 0),
+            is_pinned = is_pinned OR VALUES(is_pinned),
+            spam_reason = IF(VALUES(spam_reason) IS NULL, NULL, spam_reason)
         """
         values = [(
             comment.get('tweet_id'),
@@ -1343,25 +2614,42 @@ class MySQLDatabase:
             comment.get('parent_comment_id'),
             comment['collected_at'],
             comment['collected_by'],
-            comment['tweet_url']
+            comment['tweet_url'],
+            comment.get('spam_reason')
         ) for comment in filtered_comments]
         
         return self.insert_many(query, values)
 
-    def get_filtered_x_comments_by_keyword(self, keyword, limit=1000):
+    def add_filtered_x_duplicate_counts(self, keyword, duplicate_counts):
+        """累加X过滤结果的近重复计数，duplicate_counts 为 {user_id: 被合并的近重复评论数}"""
+        if not duplicate_counts:
+            return 0
         query = """
-        SELECT * FROM x_filtered_comments
-        WHERE keyword = %s
-        LIMIT %s
+        UPDATE x_filtered_comments SET duplicate_count = duplicate_count + %s
+        WHERE keyword = %s AND user_id = %s
         """
-        return self.execute_query(query, (keyword, limit))
+        return self.insert_many(query, [(count, keyword, user_id) for user_id, count in duplicate_counts.items()])
+
+    def clear_filtered_x_comments_by_keyword(self, keyword):
+        """清空指定关键词的X过滤结果和过滤水位（全量重新过滤时与重新写入在同一事务中调用）"""
+        result = self.execute_update("DELETE FROM x_filtered_comments WHERE keyword = %s", (keyword,))
+        self.execute_update("DELETE FROM filter_watermarks WHERE platform = 'x' AND keyword = %s", (keyword,))
+        return result
+
+    def stream_filtered_x_comment_texts(self, keyword, chunk_size=STREAM_CHUNK_SIZE):
+        """流式获取指定关键词已保存的X过滤结果的 user_id 和 reply_content；参数同 stream_filtered_tiktok_comment_texts"""
+        return self.stream_query(FILTERED_COMMENT_TEXTS_QUERIES['x'], (keyword,), chunk_size=chunk_size)
+
+    def get_filtered_x_comments_by_keyword(self, keyword, limit=1000, include_spam=False):
+        """获取指定关键词的X过滤后评论，默认不含被标记为垃圾评论的行"""
+        return self.execute_query(build_filtered_comments_query('x', include_spam), (keyword, limit))
 
     def get_filtered_x_comments_count(self, keyword):
-        """获取指定关键词的已过滤X评论数量"""
+        """获取指定关键词可用于分析的已过滤X评论数量（不含垃圾评论）"""
         query = """
         SELECT COUNT(*) as count
         FROM x_filtered_comments
-        WHERE keyword = %s
+        WHERE keyword = %s AND spam_reason IS NULL
         """
         result = self.execute_query(query, (keyword,))
         return result[0]['count'] if result else 0
@@ -1370,19 +2658,28 @@ class MySQLDatabase:
         """保存分析后的X评论数据"""
         query = """
         INSERT INTO x_analyzed_comments 
-        (keyword, user_id, reply_content, classification, analysis_reason)
-        VALUES (%s, %s, %s, %s, %s)
+        (keyword, user_id, reply_content, classification, analysis_reason, label_source)
+        VALUES (%s, %s, %s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE
         classification = VALUES(classification),
         analysis_reason = VALUES(analysis_reason),
+        label_source = VALUES(label_source),
         analyzed_at = CURRENT_TIMESTAMP
         """
         values = [
-            (keyword, row['用户ID'], row['评论内容'], row['分类结果'], row['分析理由'])
+            (keyword, row['用户ID'], row['评论内容'], row['分类结果'], row['分析理由'], row.get('标注来源') or 'gpt')
             for _, row in analyzed_data.iterrows()
         ]
         return self.insert_many(query, values)
 
+    def get_x_pre_classifier_training_data(self, keyword):
+        """获取用于训练本地预分类模型的GPT第一轮X分类结果（不含预分类模型自己标注的结果）"""
+        query = """
+        SELECT reply_content, classification FROM x_analyzed_comments
+        WHERE keyword = %s AND label_source = 'gpt'
+        """
+        return self.execute_query(query, (keyword,)) or []
+
     def get_analyzed_x_comments(self, keyword, limit=1000):
         """获取指定关键词的分析后X评论数据"""
         query = """
@@ -1432,13 +2729,7 @@ class MySQLDatabase:
 
     def get_x_potential_customers(self, keyword, limit=1000):
         """获取指定关键词X平台潜在客户评论数据"""
-        query = """
-        SELECT * FROM x_analyzed_comments
-        WHERE keyword = %s AND classification = '潜在客户'
-        ORDER BY analyzed_at DESC
-        LIMIT %s
-        """
-        return self.execute_query(query, (keyword, limit))
+        return self.execute_query(POTENTIAL_CUSTOMERS_QUERIES['x'], (keyword, limit))
 
     def clear_first_round_x_analysis_by_keyword(self, keyword):
         """清空指定关键字的X平台第一轮分析结果"""
@@ -1495,12 +2786,7 @@ class MySQLDatabase:
 
     def get_worker_ip_for_processing_x_messages(self, keyword):
         """获取正在处理指定关键词X平台消息的worker IP"""
-        query = """
-        SELECT DISTINCT worker_ip
-        FROM x_messages
-        WHERE keyword = %s AND status = 'processing' AND worker_ip IS NOT NULL
-        """
-        results = self.execute_query(query, (keyword,))
+        results = self.execute_query(PROCESSING_MESSAGE_WORKERS_QUERIES['x'], (keyword,))
         return [result['worker_ip'] for result in results if result.get('worker_ip')]
 
     def update_x_message_status_and_worker(self, user_id, status, worker_ip):
@@ -1535,9 +2821,30 @@ class MySQLDatabase:
     def clear_tiktok_messages(self, keyword):
         """清空指定关键词的所有TikTok推广消息"""
         query = "DELETE FROM tiktok_messages WHERE keyword = %s"
-        return self.execute_update(query, (keyword,))
+        affected_rows = self.execute_update(query, (keyword,))
+        self.refresh_keyword_stats(keyword, ['messages_sent_count'])
+        return affected_rows
 
 
 # 使用示例
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    # python mysql.py migrate  建表并执行数据库迁移
+    # python mysql.py explain [关键词]  检查主要查询是否全表扫描，有全表扫描时以非0状态退出
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    db = MySQLDatabase()
+    db.connect()
+    try:
+        if command == "migrate":
+            ensure_database_schema()
+        elif command == "explain":
+            problems = db.check_query_plans(*sys.argv[2:3])
+            for name, row in problems:
+                print(f"全表扫描: {name} -> {row}")
+            print("查询计划检查通过" if not problems else f"共 {len(problems)} 个查询存在全表扫描")
+            sys.exit(1 if problems else 0)
+        else:
+            print("用法: python mysql.py [migrate | explain [关键词]]")
+    finally:
+        db.disconnect()
\ No newline at end of file
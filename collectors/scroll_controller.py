@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : scroll_controller.py
+@Software: PyCharm
+@Description: 评论页面的自适应滚动控制，根据每轮新增评论数、页面高度变化和加载耗时决定等待时间和何时停止
+"""
+import os
+import re
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 滚动控制配置
+MAX_SCROLL_ROUNDS = int(os.environ.get('TIKTOK_MAX_SCROLL_ROUNDS', 300))  # 单个视频最多滚动轮数（兜底）
+IDLE_ROUNDS_TO_STOP = int(os.environ.get('TIKTOK_IDLE_ROUNDS_TO_STOP', 3))  # 连续多少轮没有新评论且页面不再增高时停止
+COVERAGE_TARGET = float(os.environ.get('TIKTOK_COMMENT_COVERAGE_TARGET', 0.98))  # 采集数达到页面显示评论数的比例后停止
+MIN_WAIT_SECONDS = 0.3
+MAX_WAIT_SECONDS = 8
+
+
+def parse_count(text):
+    """解析页面上显示的数量，如 '1,234'、'1.2K'、'3M'，无法解析时返回None"""
+    if not text:
+        return None
+    match = re.search(r'([\d.,]+)\s*([KkMmBb万]?)', text)
+    if not match:
+        return None
+    try:
+        number = float(match.group(1).replace(',', ''))
+    except ValueError:
+        return None
+    multiplier = {'k': 1e3, 'm': 1e6, 'b': 1e9, '万': 1e4}.get(match.group(2).lower(), 1)
+    return int(number * multiplier)
+
+
+class ScrollController:
+    """
+    自适应滚动控制器
+
+    - 每轮记录新增评论数、页面高度变化和加载耗时（指数移动平均）
+    - 等待时间和加载超时按观测到的加载耗时调整，而不是固定的随机等待
+    - 连续多轮没有新评论且页面不再增高、采集数达到页面显示的评论数、或达到最大轮数时停止
+    """
+
+    def __init__(self, expected_total=None, max_rounds=MAX_SCROLL_ROUNDS, idle_rounds=IDLE_ROUNDS_TO_STOP,
+                 coverage_target=COVERAGE_TARGET):
+        self.expected_total = expected_total
+        self.max_rounds = max_rounds
+        self.idle_rounds = idle_rounds
+        self.coverage_target = coverage_target
+        self.rounds = 0
+        self.consecutive_idle = 0
+        self.latency = 1.0  # 加载耗时的指数移动平均（秒）
+        self.stop_reason = None
+
+    def update_expected_total(self, total):
+        """更新页面/接口给出的评论总数"""
+        if total is not None and total != self.expected_total:
+            self.expected_total = total
+            logger.info(f"视频显示的评论总数: {total}")
+
+    def record_latency(self, load_latency):
+        """记录一次加载（滚动或展开回复）的耗时"""
+        self.latency = 0.7 * self.latency + 0.3 * load_latency
+
+    def record_round(self, new_comments, height_delta, load_latency):
+        """记录一轮滚动的结果，load_latency 为None表示等待加载超时"""
+        self.rounds += 1
+        if load_latency is not None:
+            self.record_latency(load_latency)
+        if new_comments == 0 and height_delta <= 0:
+            self.consecutive_idle += 1
+        else:
+            self.consecutive_idle = 0
+
+    def should_stop(self, collected):
+        """判断是否停止滚动，停止时把原因记录到 stop_reason"""
+        if self.expected_total == 0:
+            self.stop_reason = "视频没有评论"
+        elif self.expected_total and collected >= self.expected_total * self.coverage_target:
+            self.stop_reason = f"已采集 {collected} 条，达到显示的评论数 {self.expected_total}"
+        elif self.consecutive_idle >= self.idle_rounds:
+            self.stop_reason = f"连续 {self.consecutive_idle} 轮没有新评论且页面不再增高"
+        elif self.rounds >= self.max_rounds:
+            self.stop_reason = f"达到最大滚动轮数 {self.max_rounds}"
+        return self.stop_reason is not None
+
+    def should_jump_to_bottom(self):
+        """连续两轮没有新内容时改为滚到底部再回滚，触发懒加载"""
+        return self.consecutive_idle >= 2
+
+    def scroll_distance(self):
+        """有新评论时步子放大，空转时收小"""
+        base = 1000 if self.consecutive_idle == 0 else 400
+        return random.randint(base, base + 200)
+
+    def load_timeout(self):
+        """等待一次加载的超时时间：观测耗时的4倍，限制在2~10秒"""
+        return min(max(self.latency * 4, 2), 10)
+
+    def reply_idle_timeout(self):
+        """展开回复时连续没有加载成功的最长时间：观测耗时的10倍，限制在5~60秒"""
+        return min(max(self.latency * 10, 5), 60)
+
+    def next_wait(self):
+        """下一轮前的等待时间，按观测耗时加少量随机抖动"""
+        wait = self.latency * random.uniform(0.8, 1.5)
+        return min(max(wait, MIN_WAIT_SECONDS), MAX_WAIT_SECONDS)
+
+    def summary(self, collected):
+        """用于任务日志的停止说明"""
+        coverage = f"，覆盖率 {collected / self.expected_total:.0%}" if self.expected_total else ""
+        return (f"滚动 {self.rounds} 轮后停止（{self.stop_reason}），采集 {collected} 条评论{coverage}，"
+                f"平均加载耗时 {self.latency:.1f} 秒")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : task_scheduler.py
+@Software: PyCharm
+@Description: Worker侧的TikTok采集调度器，按浏览器槽位并发采集视频评论
+"""
+import os
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psutil
+
+from common.mysql import MySQLDatabase
+from tiktok_collect_by_uc import search_task_videos, process_video
+
+logger = logging.getLogger(__name__)
+
+# 槽位配置
+BROWSER_SLOTS = int(os.environ.get('TIKTOK_BROWSER_SLOTS', 0))  # 固定槽位数，0表示按CPU/内存自动计算
+CPU_CORES_PER_BROWSER = float(os.environ.get('TIKTOK_CPU_CORES_PER_BROWSER', 1))  # 每个浏览器预留的CPU核数
+BROWSER_MEMORY_MB = int(os.environ.get('TIKTOK_BROWSER_MEMORY_MB', 1024))  # 每个浏览器预留的内存
+SCHEDULER_POLL_INTERVAL = int(os.environ.get('TIKTOK_SCHEDULER_POLL_INTERVAL', 30))  # 无事件唤醒时的轮询间隔（秒）
+
+
+def compute_browser_slots(max_slots):
+    """根据CPU核数和可用内存计算可同时运行的浏览器数，不超过 max_slots"""
+    if BROWSER_SLOTS > 0:
+        return min(BROWSER_SLOTS, max_slots)
+    cpu_slots = int((psutil.cpu_count() or 1) / CPU_CORES_PER_BROWSER)
+    memory_slots = int(psutil.virtual_memory().available / (BROWSER_MEMORY_MB * 1024 * 1024))
+    return max(1, min(cpu_slots, memory_slots, max_slots))
+
+
+class TikTokTaskScheduler:
+    """
+    Worker侧的TikTok采集调度器
+
+    - 每个槽位同一时间运行一个浏览器，槽位数按CPU/内存计算
+    - 以视频为单位分配槽位（通过 claim_next_video 领取租约），槽位空出后立即补位，
+      同一关键词的多个视频可以在本机或多台worker上并行采集；worker崩溃后租约过期，视频会被重新领取
+    - 新接手的任务先占用一个槽位搜索视频，搜索完成后才开始分发视频
+    - 多个任务同时运行时轮流分配槽位
+    """
+
+    def __init__(self, server_ip, max_slots, poll_interval=SCHEDULER_POLL_INTERVAL):
+        self.server_ip = server_ip
+        self.max_slots = max_slots
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._jobs = {}  # future -> {'type': 'search' | 'video', 'task_id', 'video_id'}
+        self._prepared_tasks = set()  # 已完成视频搜索、可以分发视频的任务
+
+    def start(self):
+        """启动调度线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_slots, thread_name_prefix='browser-slot')
+            self._thread = threading.Thread(target=self._run, name='tiktok-scheduler', daemon=True)
+            self._thread.start()
+        logger.info(f"TikTok采集调度器已启动，浏览器槽位数: {self.max_slots}")
+
+    def stop(self, wait=False):
+        """停止调度，不再分配新的作业"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+        logger.info("TikTok采集调度器已停止")
+
+    def wake(self):
+        """立即触发一次调度（任务触发/恢复后调用）"""
+        self._wake_event.set()
+
+    def free_slots(self):
+        """当前空闲的槽位数"""
+        with self._lock:
+            return self.max_slots - len(self._jobs)
+
+    def status(self):
+        """返回调度器当前状态"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            'max_slots': self.max_slots,
+            'busy_slots': len(jobs),
+            'jobs': jobs,
+            'prepared_tasks': sorted(self._prepared_tasks),
+        }
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._schedule_once()
+            except Exception as e:
+                logger.error(f"调度采集作业时发生错误: {str(e)}", exc_info=True)
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+
+    def _submit(self, job, fn, *args):
+        future = self._executor.submit(fn, *args)
+        with self._lock:
+            self._jobs[future] = job
+        future.add_done_callback(lambda _: self._wake_event.set())
+        logger.info(f"分配槽位: {job}，剩余空闲槽位 {self.free_slots()}")
+
+    def _task_jobs(self, task_id):
+        with self._lock:
+            return [job for job in self._jobs.values() if job['task_id'] == task_id]
+
+    def _reap_finished_jobs(self, db):
+        """回收已结束的作业，处理搜索作业的结果"""
+        with self._lock:
+            finished = [(future, job) for future, job in self._jobs.items() if future.done()]
+            for future, _ in finished:
+                del self._jobs[future]
+
+        for future, job in finished:
+            if job['type'] != 'search':
+                continue
+            task_id = job['task_id']
+            try:
+                video_count = future.result()
+                self._prepared_tasks.add(task_id)
+                logger.info(f"任务 {task_id} 搜索完成，共 {video_count} 个视频")
+            except Exception as e:
+                logger.error(f"任务 {task_id} 搜索视频时发生错误: {str(e)}")
+                db.update_tiktok_task_details(task_id, status='failed', end_time=datetime.now())
+
+    def _finish_task(self, db, task_id):
+        """
+        本机领取不到视频且没有在途作业时调用：数据库中任务已没有待处理或处理中的视频才标记完成，
+        否则（如其他机器仍在处理）保持运行，下一轮调度再检查
+        """
+        unfinished = db.count_unfinished_task_videos(task_id)
+        if unfinished != 0:
+            if unfinished is not None:
+                logger.info(f"任务 {task_id} 还有 {unfinished} 个视频未完成，下一轮再检查")
+            return
+        self._prepared_tasks.discard(task_id)
+        if db.get_tiktok_task_status(task_id) == 'running':
+            db.update_tiktok_task_details(task_id, status='completed', end_time=datetime.now())
+            logger.info(f"任务 {task_id} 完成")
+
+    def _schedule_once(self):
+        db = MySQLDatabase()
+        db.connect()
+        try:
+            self._reap_finished_jobs(db)
+            db.reclaim_expired_video_leases()
+
+            tasks = list(db.get_running_tiktok_task_by_ip(self.server_ip) or [])
+            running_task_ids = {task['id'] for task in tasks}
+
+            # 已暂停/失败的任务：在途作业会自行退出，恢复时重新搜索
+            for task_id in list(self._prepared_tasks):
+                if task_id not in running_task_ids and not self._task_jobs(task_id):
+                    self._prepared_tasks.discard(task_id)
+
+            # 新接手的任务先搜索视频
+            for task in tasks:
+                if self.free_slots() <= 0:
+                    return
+                if task['id'] not in self._prepared_tasks and not self._task_jobs(task['id']):
+                    job = {'type': 'search', 'task_id': task['id'], 'video_id': None}
+                    self._submit(job, search_task_videos, task['id'], task['keyword'], self.server_ip,
+                                 bool(task.get('block_resources', 1)))
+
+            # 按任务轮流领取视频，直到槽位占满或没有可领取的视频
+            dispatchable = [task for task in tasks if task['id'] in self._prepared_tasks]
+            while dispatchable and self.free_slots() > 0:
+                for task in list(dispatchable):
+                    if self.free_slots() <= 0:
+                        break
+                    lease_owner = f"{self.server_ip}:{uuid.uuid4().hex[:12]}"
+                    video = db.claim_next_video(task['id'], lease_owner, self.server_ip)
+                    if not video:
+                        dispatchable.remove(task)
+                        if not self._task_jobs(task['id']):
+                            self._finish_task(db, task['id'])
+                        continue
+                    job = {'type': 'video', 'task_id': task['id'], 'video_id': video['id']}
+                    self._submit(job, process_video, task['id'], task['keyword'],
+                                 video['id'], video['video_url'], self.server_ip, lease_owner,
+                                 bool(task.get('block_resources', 1)))
+        finally:
+            db.disconnect()
@@ -27,7 +27,9 @@ from selenium.webdriver.support.ui import WebDriverWait
 import undetected_chromedriver as uc
 from selenium.common.exceptions import TimeoutException
 
-from common.mysql import MySQLDatabase
+from common.mysql import MySQLDatabase, VIDEO_LEASE_SECONDS
+from browser_pool import BrowserPool, BrowserLoginError
+from scroll_controller import ScrollController, parse_count
 
 CHROME_DRIVER = '/usr/local/bin/chromedriver'
 
@@ -49,6 +51,9 @@ from selenium.webdriver.common.keys import Keys
 import atexit
 import signal
 import subprocess
+import threading
+import uuid
+import base64
 
 
 # 预处理评论数据
@@ -64,6 +69,19 @@ def preprocess_comment(comment):
 # 存储所有Chrome相关进程
 chrome_processes = []
 
+# undetected_chromedriver 启动时会改写驱动文件，多个槽位并发启动浏览器时需要串行化
+driver_setup_lock = threading.Lock()
+
+# 评论采集引擎：html 解析页面渲染的评论节点，network 从performance日志中捕获评论接口的JSON响应
+COMMENT_ENGINE = os.environ.get('TIKTOK_COMMENT_ENGINE', 'html')
+
+# 快速采集模式下屏蔽的请求（视频流、图片、字体），评论只依赖页面文本
+BLOCKED_RESOURCE_PATTERNS = [
+    '*.mp4*', '*.webm*', '*.m3u8*', '*.m4s*', '*mime_type=video*',
+    '*.jpg*', '*.jpeg*', '*.png*', '*.gif*', '*.webp*', '*.avif*', '*.heic*', '*.image?*',
+    '*.woff*', '*.ttf*', '*.otf*',
+]
+
 def cleanup_chrome_processes():
     """
     清理所有Chrome相关进程。
@@ -105,7 +123,7 @@ def setup_driver():
     设置并返回一个Selenium WebDriver实例。
     这个函数会根据当前操作系统设置适当的选项,
     然后创建一个Chrome WebDriver实例。
-    如果创建失败,会清理所有Chrome进程并抛出异常。
+    如果创建失败,会关闭本次创建的浏览器并抛出异常（不影响其他槽位的浏览器）。
     """
     options = uc.ChromeOptions()
     
@@ -145,11 +163,22 @@ def setup_driver():
     # 添加更浏览器特征
     options.add_argument('--window-size=1920,1080')
     options.add_argument('--start-maximized')
+
+    # 采集不需要播放视频和声音
+    options.add_argument('--autoplay-policy=user-gesture-required')
+    options.add_argument('--mute-audio')
+
+    # network 采集引擎需要读取浏览器的网络日志
+    if COMMENT_ENGINE == 'network':
+        options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
     
     logger.info("正在设置WebDriver选项")
     
+    driver = None
     try:
-        driver = uc.Chrome(driver_executable_path=CHROME_DRIVER, options=options)
+        with driver_setup_lock:
+            driver = uc.Chrome(driver_executable_path=CHROME_DRIVER, options=options)
         chrome_processes.append(driver.service.process)
         logger.info(f"WebDriver已设置成功，使用驱动程序路径: {CHROME_DRIVER}")
         
@@ -160,9 +189,26 @@ def setup_driver():
         return driver
     except Exception as e:
         logger.error(f"设置WebDriver时发生错误: {str(e)}")
-        cleanup_chrome_processes()
+        if driver:
+            try:
+                driver.quit()
+            except Exception as quit_error:
+                logger.error(f"关闭启动失败的WebDriver时发生错误: {str(quit_error)}")
         raise
 
+def set_resource_blocking(driver, enabled):
+    """通过DevTools开启或关闭对视频、图片和字体请求的屏蔽（对浏览器会话生效，可随时切换）"""
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_RESOURCE_PATTERNS if enabled else []})
+    logger.info(f"资源屏蔽已{'开启' if enabled else '关闭'}")
+
+def reset_browser_state(driver):
+    """浏览器归还到池中前恢复会话级设置"""
+    set_resource_blocking(driver, False)
+    if COMMENT_ENGINE == 'network':
+        # 丢弃未读取的网络日志，避免在chromedriver中持续堆积
+        driver.get_log('performance')
+
 def init_browser_features(driver):
     """初始化浏览器特征"""
     try:
@@ -467,6 +513,10 @@ def login_by_local_cookies(driver, username=None):
     logger.error(error_message)
     raise Exception(error_message)
 
+# 复用已登录浏览器的池，按账号（None表示任意可用cookies）分组
+tiktok_browser_pool = BrowserPool('tiktok', setup_driver, login_by_local_cookies, session_cookie='sessionid',
+                                  reset=reset_browser_state)
+
 def search_tiktok_videos(driver, keyword):
     """在TikTok上搜索关键字并返视频链接列表。"""
     logger.info(f"开始搜索关键词: {keyword}")
@@ -780,9 +830,300 @@ def visit_video_page(driver, video_url):
     return False
 
 
-def collect_comments(driver, video_url, video_id, keyword, db, collected_by, task_id):
-    """收集给定视频URL下的评论。"""
+# 在页面内提取尚未处理过的评论节点（一级评论和已展开的回复），返回结构化数据并给节点打上已处理标记，
+# 这样每轮滚动只传输新渲染的评论，开销不随已加载评论数增长
+EXTRACT_NEW_COMMENTS_JS = """
+const SEEN_ATTR = 'data-xw-seen';
+const records = [];
+document.querySelectorAll('div[class*="DivCommentItemWrapper"]:not([' + SEEN_ATTR + '])').forEach(node => {
+    // 内容还没渲染出来的节点不标记，下一轮再提取
+    const contentSpan = node.querySelector('span[data-e2e="comment-level-1"], span[data-e2e="comment-level-2"]');
+    if (!contentSpan) {
+        return;
+    }
+    const userLink = node.querySelector('a[href^="/@"]');
+    const timeSpan = node.querySelector('div[class*="DivCommentSubContentWrapper"] span');
+    node.setAttribute(SEEN_ATTR, '1');
+    records.push({
+        user_id: userLink ? userLink.getAttribute('href').replace('/@', '') : '',
+        content: contentSpan.textContent.trim(),
+        time: timeSpan ? timeSpan.textContent.trim() : ''
+    });
+});
+return records;
+"""
+
+
+def extract_new_comments(driver):
+    """
+    通过页面内脚本增量提取新渲染的评论（一级评论和已展开的回复）
+
+    Returns:
+        list: [{'user_id', 'content', 'time'}]，只包含上次调用之后新出现的评论
+    """
+    return driver.execute_script(EXTRACT_NEW_COMMENTS_JS) or []
+
+
+# 评论列表和回复列表接口
+COMMENT_API_PATHS = ('/api/comment/list/reply/', '/api/comment/list/')
+
+
+def parse_comment_api_comment(comment):
+    """把接口返回的单条评论转换为与页面提取一致的记录，附带平台评论ID、父评论ID和点赞数"""
+    user = comment.get('user') or {}
+    create_time = comment.get('create_time')
+    parent_id = comment.get('reply_id')
+    return {
+        'user_id': user.get('unique_id') or '',
+        'content': comment.get('text') or '',
+        'time': datetime.fromtimestamp(int(create_time)).strftime('%Y-%m-%d %H:%M:%S') if create_time else '',
+        'platform_comment_id': str(comment['cid']) if comment.get('cid') else None,
+        'platform_parent_id': str(parent_id) if parent_id and str(parent_id) != '0' else None,
+        'likes_count': comment.get('digg_count'),
+        'is_pinned': bool(comment.get('stick_position')),
+    }
+
+
+def parse_comment_api_payload(payload):
+    """解析评论列表/回复列表接口的响应，一级评论中附带的回复预览也一并返回"""
+    records = []
+    for comment in payload.get('comments') or []:
+        records.append(parse_comment_api_comment(comment))
+        for reply in comment.get('reply_comment') or []:
+            records.append(parse_comment_api_comment(reply))
+    return records
+
+
+class CommentNetworkCapture:
+    """
+    从浏览器的performance日志中捕获评论接口的响应
+
+    页面滚动和展开回复时会自行请求评论接口，这里只记录匹配的请求，
+    等响应加载完成后通过 Network.getResponseBody 取回JSON，不需要解析页面。
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.responses = 0
+        self.total = None  # 评论列表接口返回的评论总数
+        self._pending = {}  # requestId -> url，响应头已收到、body尚未加载完成
+
+    def drain(self):
+        """丢弃之前积累的网络日志"""
+        self.driver.get_log('performance')
+        self._pending.clear()
+
+    def poll(self):
+        """读取新的网络日志，返回这段时间内加载完成的评论接口中的评论记录"""
+        finished = []
+        for entry in self.driver.get_log('performance'):
+            try:
+                message = json.loads(entry['message'])['message']
+            except (KeyError, ValueError):
+                continue
+            method = message.get('method')
+            params = message.get('params') or {}
+            if method == 'Network.responseReceived':
+                url = (params.get('response') or {}).get('url', '')
+                if any(path in url for path in COMMENT_API_PATHS):
+                    self._pending[params.get('requestId')] = url
+            elif method == 'Network.loadingFinished' and params.get('requestId') in self._pending:
+                finished.append(params['requestId'])
+
+        records = []
+        for request_id in finished:
+            url = self._pending.pop(request_id)
+            try:
+                body = self.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+                text = body.get('body', '')
+                if body.get('base64Encoded'):
+                    text = base64.b64decode(text).decode('utf-8', errors='ignore')
+                payload = json.loads(text)
+            except Exception as e:
+                logger.warning(f"读取评论接口响应失败: {url}, {str(e)}")
+                continue
+            self.responses += 1
+            if '/api/comment/list/reply/' not in url and payload.get('total') is not None:
+                self.total = payload['total']
+            records.extend(parse_comment_api_payload(payload))
+        return records
+
+
+# 一次点击页面上所有可见的"查看回复"按钮，用MutationObserver等待这一批回复渲染完成：
+# 出现新的评论节点后安静 quietMs 毫秒即返回，最长等待 timeoutMs 毫秒
+EXPAND_REPLIES_JS = """
+const timeoutMs = arguments[0];
+const quietMs = arguments[1];
+const done = arguments[arguments.length - 1];
+const ITEM_SELECTOR = 'div[class*="DivCommentItemWrapper"]';
+const isViewText = text => /View|查看/.test(text) && !/Hide|隐藏/.test(text);
+const buttons = Array.from(document.querySelectorAll('div[class*="DivViewRepliesContainer"] span')).filter(span =>
+    Array.from(span.childNodes).some(node => node.nodeType === Node.TEXT_NODE && isViewText(node.textContent)));
+if (buttons.length === 0) {
+    done({clicked: 0, added: 0, elapsed: 0});
+    return;
+}
+const start = performance.now();
+let added = 0;
+let quietTimer = null;
+let hardTimer = null;
+const observer = new MutationObserver(mutations => {
+    for (const mutation of mutations) {
+        for (const node of mutation.addedNodes) {
+            if (node.nodeType !== Node.ELEMENT_NODE) {
+                continue;
+            }
+            if (node.matches(ITEM_SELECTOR)) {
+                added += 1;
+            }
+            added += node.querySelectorAll(ITEM_SELECTOR).length;
+        }
+    }
+    if (added > 0) {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(finish, quietMs);
+    }
+});
+function finish() {
+    observer.disconnect();
+    clearTimeout(quietTimer);
+    clearTimeout(hardTimer);
+    done({clicked: buttons.length, added: added, elapsed: performance.now() - start});
+}
+observer.observe(document.body, {childList: true, subtree: true});
+hardTimer = setTimeout(finish, timeoutMs);
+buttons.forEach(button => button.click());
+"""
+
+
+def expand_visible_replies(driver, timeout, quiet=0.5):
+    """
+    批量展开页面上所有可见的回复
+
+    Returns:
+        dict: {'clicked': 点击的按钮数, 'added': 新渲染的评论节点数, 'elapsed': 加载耗时（秒）}
+    """
+    driver.set_script_timeout(timeout + 5)
+    result = driver.execute_async_script(EXPAND_REPLIES_JS, int(timeout * 1000), int(quiet * 1000)) or {}
+    added = result.get('added', 0)
+    elapsed = result.get('elapsed', 0) / 1000
+    return {
+        'clicked': result.get('clicked', 0),
+        'added': added,
+        # 有新内容时脚本在最后一次变化后又等待了 quiet 秒，不计入加载耗时
+        'elapsed': max(elapsed - quiet, 0) if added else elapsed,
+    }
+
+
+def get_advertised_comment_count(driver):
+    """读取视频页面上显示的评论数，读取失败时返回None"""
+    for selector in ('strong[data-e2e="comment-count"]', 'span[data-e2e="comment-count"]',
+                     'strong[data-e2e="browse-comment-count"]'):
+        try:
+            count = parse_count(driver.find_element(By.CSS_SELECTOR, selector).text)
+            if count is not None:
+                return count
+        except Exception:
+            continue
+    return None
+
+
+def extract_all_comments(driver):
+    """解析完整的 page_source 提取页面上所有评论和已展开的回复（全量模式）"""
+    records = []
+    soup = BeautifulSoup(driver.page_source, 'html.parser')
+    for comment_div in soup.select('div[class*="DivCommentItemWrapper"]'):
+        user_link = comment_div.select_one('a[href^="/@"]')
+        user_id = user_link.get('href', '').replace('/@', '') if user_link else ''
+
+        reply_content_span = comment_div.select_one(
+            'span[data-e2e="comment-level-1"], span[data-e2e="comment-level-2"]')
+        reply_content = reply_content_span.get_text(strip=True) if reply_content_span else ''
+
+        reply_time = ''
+        time_span = comment_div.select_one('div.css-2c97me-DivCommentSubContentWrapper span')
+        if time_span:
+            reply_time = time_span.get_text(strip=True)
+
+        records.append({'user_id': user_id, 'content': reply_content, 'time': reply_time})
+    return records
+
+
+class CollectionStopped(Exception):
+    """任务已暂停/停止，采集中途退出（视频应放回待处理，不计入任务进度）"""
+
+    def __init__(self, collected):
+        super().__init__(f"任务已停止，已收集 {collected} 条评论")
+        self.collected = collected
+
+
+class VideoLeaseKeeper:
+    """
+    在后台线程中定期续租视频，覆盖浏览器领取/登录、访问视频页、滚动采集和最后写入的全过程
+
+    续租使用独立的数据库连接，租约被其他worker回收后 lost 置为True，采集循环据此停止。
+    """
+
+    def __init__(self, video_id, lease_owner, interval=None):
+        self.video_id = video_id
+        self.lease_owner = lease_owner
+        self.interval = interval or VIDEO_LEASE_SECONDS / 3
+        self.lost = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f'video-lease-{self.video_id}', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop_event.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        db = MySQLDatabase()
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    db.is_connected() or db.connect()
+                    if not db.extend_video_lease(self.video_id, self.lease_owner):
+                        logger.warning(f"视频 {self.video_id} 的租约已失效")
+                        self.lost = True
+                        return
+                except Exception as e:
+                    # 连接数据库失败时不放弃租约，下一轮重试
+                    logger.error(f"视频 {self.video_id} 续租失败: {str(e)}")
+        finally:
+            db.disconnect()
+
+
+def collect_comments(driver, video_url, video_id, keyword, db, collected_by, task_id, incremental=True,
+                     lease=None, engine=None):
+    """
+    收集给定视频URL下的评论。
+
+    Args:
+        incremental: 为True时每轮只通过页面脚本提取新渲染的评论节点，
+            为False时每轮重新解析完整的page_source（旧模式，脚本提取失败时也会自动回退）
+        lease: 视频租约（VideoLeaseKeeper），租约被回收后停止采集
+        engine: 采集引擎，默认取 TIKTOK_COMMENT_ENGINE。network 引擎从评论接口响应中获取评论，
+            可以拿到点赞数和回复关系；前两轮没有捕获到接口响应时回退到html引擎
+
+    Raises:
+        CollectionStopped: 任务已暂停/停止，写入评论时被拒绝
+    """
     logger.info(f"开始收集视频评论: {video_url}")
+
+    capture = None
+    if (engine or COMMENT_ENGINE) == 'network':
+        try:
+            capture = CommentNetworkCapture(driver)
+            capture.drain()
+        except Exception as e:
+            logger.warning(f"无法读取浏览器网络日志，使用html引擎: {str(e)}")
+            capture = None
     
     # 访问视频页
     if not visit_video_page(driver, video_url):
@@ -815,397 +1156,186 @@ def collect_comments(driver, video_url, video_id, keyword, db, collected_by, tas
     comments_data = []
     comments_batch = []
     total_scroll_attempts = 0
-    scroll_attempts = 0
-    max_scroll_attempts = 10  # 最大滚动尝试次数
-    consecutive_no_new_comments = 0
-    max_consecutive_no_new = 5  # 连续无新评的最大次数
-    clicked_buttons = set()  # 移到这里，用于记录所有已点击过的按钮
 
     last_comments_count = 0
     seen_comments = set()
 
-    # 动态调整滚动距离
-    min_scroll_distance = 300
-    max_scroll_distance = 1000
-    current_scroll_distance = min_scroll_distance
+    def add_record(record):
+        """把一条提取到的评论加入结果和待写入批次，返回是否为新评论"""
+        reply_content = preprocess_comment(record['content'])
+        comment_key = f"{record['user_id']}:{reply_content}"
+        if not reply_content or comment_key in seen_comments:
+            return False
+        seen_comments.add(comment_key)
+        comments_data.append({
+            'user_id': record['user_id'],
+            'reply_content': reply_content,
+            'reply_time': record['time'],
+            'reply_video_url': video_url
+        })
+        comments_batch.append({
+            'video_id': video_id,
+            'user_id': record['user_id'],
+            'reply_content': reply_content,
+            'reply_time': record['time'],
+            'keyword': keyword,
+            'collected_by': collected_by,
+            'video_url': video_url,
+            'platform_comment_id': record.get('platform_comment_id'),
+            'platform_parent_id': record.get('platform_parent_id'),
+            'likes_count': record.get('likes_count'),
+            'is_pinned': record.get('is_pinned', False)
+        })
+        return True
 
-    # 指数退避策略
-    backoff_factor = 1.5
-    max_backoff_time = 20
-
-    # 在函数开始处添加统计变量
-    button_stats = {
-        'total_buttons_found': 0,    # 找到的总按钮数
-        'click_success': 0,          # 点击成功次数
-        'click_failed': 0,           # 点击失败次数
-        'load_success': 0,           # 加载成功次数
-        'load_timeout': 0,           # 加载超时次数
-        'child_comments_found': 0,   # 找到的子评论总数
-        'child_comments_saved': 0    # 成功保存的子评论数
+    flush_size = 50  # 缓存达到该条数时写入数据库，写入失败后再积累50条重试
+
+    def add_records(records):
+        """加入一批提取到的评论，批次达到50条时写入数据库；任务已停止时抛出 CollectionStopped"""
+        nonlocal flush_size
+        for record in records:
+            if add_record(record) and len(comments_batch) >= flush_size:
+                inserted_count = batch_store_comments(comments_batch, db, task_id)
+                if inserted_count == -1:  # 任务已停止
+                    raise CollectionStopped(len(comments_data))
+                if inserted_count is None:  # 写入失败，保留缓存
+                    flush_size = len(comments_batch) + 50
+                    continue
+                comments_batch.clear()  # 清空缓存
+                flush_size = 50
+
+    # 自适应滚动：按新增评论数、页面高度变化和加载耗时决定等待时间和停止时机
+    controller = ScrollController(expected_total=get_advertised_comment_count(driver))
+    height_delta, load_latency = 0, None
+    db.add_tiktok_task_log(task_id, 'info', f"开始采集视频 {video_id}，页面显示评论数: "
+                                            f"{controller.expected_total if controller.expected_total is not None else '未知'}")
+
+    # 回复展开统计
+    reply_stats = {
+        'rounds': 0,            # 批量展开的轮数
+        'buttons_clicked': 0,   # 点击的按钮总数
+        'replies_loaded': 0,    # 新渲染的评论节点数
     }
 
-    while scroll_attempts < max_scroll_attempts:
-        scroll_attempts += 1
+    while True:
         total_scroll_attempts += 1
-        logger.info(f"滚动尝试次数: {scroll_attempts}/{max_scroll_attempts}")
+        logger.info(f"滚动轮次: {total_scroll_attempts}")
 
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
-        
-        # 查找所有评论容器
-        for comment_div in soup.select('div[class*="DivCommentItemWrapper"]'):
-            user_link = comment_div.select_one('a[href^="/@"]')
-            user_id = user_link.get('href', '').replace('/@', '') if user_link else ''
-            
-            reply_content_span = comment_div.select_one('span[data-e2e="comment-level-1"]')
-            reply_content = reply_content_span.get_text(strip=True) if reply_content_span else ''
-            
-            # 预处理评论内容
-            reply_content = preprocess_comment(reply_content)
-            
-            reply_time = ''
-            time_span = comment_div.select_one('div.css-2c97me-DivCommentSubContentWrapper span')
-            if time_span:
-                reply_time = time_span.get_text(strip=True)
-            
-            comment_key = f"{user_id}:{reply_content}"
-            if reply_content and comment_key not in seen_comments:
-                comments_data.append({
-                    'user_id': user_id,
-                    'reply_content': reply_content,
-                    'reply_time': reply_time,
-                    'reply_video_url': video_url
-                })
-                seen_comments.add(comment_key)
-                
-                # 将新收集的评论添加到缓存批次
-                comments_batch.append({
-                    'video_id': video_id,
-                    'user_id': user_id,
-                    'reply_content': reply_content,
-                    'reply_time': reply_time,
-                    'keyword': keyword,
-                    'collected_by': collected_by,
-                    'video_url': video_url
-                })
-                
-                # 如果缓存批次达到50条，尝试存储到数据库
-                if len(comments_batch) >= 50:
-                    inserted_count = batch_store_comments(comments_batch, db, task_id)
-                    if inserted_count == -1:  # 任务已停止
-                        return comments_data
-                    comments_batch.clear()  # 清空缓存
-
-        # 处理子评论加载按钮
-        try:
-            # 初始化超时计时器
-            start_time = time.time()
-            timeout_seconds = 60  # 设置60秒超时
-            
-            # 对每个评论容器，循环点击加载更多按钮直到没有更多子评论或超时
-            while True:
-                if time.time() - start_time > timeout_seconds:
-                    logger.info("子评论加载超过60秒，退出加载循环")
-                    logger.info(f"子评论加载统计 - 总按钮数: {button_stats['total_buttons_found']}, "
-                                f"点击成功: {button_stats['click_success']}, "
-                                f"点击失败: {button_stats['click_failed']}, "
-                                f"加载成功: {button_stats['load_success']}, "
-                                f"加载超时: {button_stats['load_timeout']}")
-                    break
-                
-                # 刷新页面上所有的加载按钮
-                view_buttons = driver.find_elements(
-                    By.XPATH,
-                    ".//div[contains(@class, 'DivViewRepliesContainer')]//span[contains(text(), 'View') or contains(text(), '查看')]"
-                )
-                
-                if not view_buttons:
-                    logger.info("没有更多子评论加载按钮")
-                    logger.info(f"最终子评论加载统计 - 总按钮数: {button_stats['total_buttons_found']}, "
-                                f"点击成功: {button_stats['click_success']}, "
-                                f"点击失败: {button_stats['click_failed']}, "
-                                f"加载成功: {button_stats['load_success']}, "
-                                f"加载超时: {button_stats['load_timeout']}")
-                    break
-                
-                button_stats['total_buttons_found'] += len(view_buttons)
-                found_loadable_button = False
-                logger.info(f"发现 {len(view_buttons)} 个加载更多回复按钮, 已点击按钮数: {len(clicked_buttons)}, "
-                            f"点击成功率: {(button_stats['click_success'] / button_stats['total_buttons_found'] * 100):.1f}%, "
-                            f"加载成功率: {(button_stats['load_success'] / max(button_stats['click_success'], 1) * 100):.1f}%")
-                logger.info(f"已找到 {button_stats['child_comments_found']} 个子评论, 已保存 {button_stats['child_comments_saved']} 个子评论")
-                
-                for view_button in view_buttons:
-                    try:
-                        # 获取按钮的唯一标识
-                        button_text = view_button.text.strip()
-                        button_location = view_button.location['y']
-                        # 组合多个特征生成唯一ID
-                        button_id = f"{button_text}_{button_location}"
-                        
-                        # 如果按钮已经点击过，跳过
-                        if button_id in clicked_buttons:
-                            continue
-                        
-                        if "Hide" in button_text or "隐藏" in button_text:
-                            clicked_buttons.add(button_id)  # 标记已展开的按钮
-                            continue
-                            
-                        if "View" in button_text or "查看" in button_text:
-                            found_loadable_button = True
-                            logger.info(f"发现新的加载更多回复按钮: {button_text}, 位置: {button_location}")
-                            
-                            # 记录当前评论数
-                            current_comments = len(driver.find_elements(By.CSS_SELECTOR, 'div[class*="DivCommentItemWrapper"]'))
-                            
-                            try:
-                                # 确保按钮在视图中并可点击
-                                driver.execute_script("arguments[0].scrollIntoView({behavior: 'smooth', block: 'center'});", view_button)
-                                random_wait(1, 2)
-                                
-                                # 尝试点击按钮
-                                driver.execute_script("arguments[0].click();", view_button)
-                                button_stats['click_success'] += 1
-                                logger.info(f"已点击加载更多回复按钮 ID: {button_id}")
-                                
-                                # 标记按钮为已点击
-                                clicked_buttons.add(button_id)
-                                
-                                # 等待新回复加载
-                                try:
-                                    WebDriverWait(driver, 10).until(
-                                        lambda d: len(d.find_elements(By.CSS_SELECTOR, 'div[class*="DivCommentItemWrapper"]')) > current_comments
-                                    )
-                                    button_stats['load_success'] += 1
-                                    logger.info("新的子评论已加载")
-                                    
-                                    # 重要：成功加载新评论时重置计时器
-                                    start_time = time.time()
-                                    logger.info("重置60秒计时器")
-                                    
-                                    # 给页面一点时间完全加载
-                                    random_wait(1, 2)
-                                    
-                                    # 重新获取子评论容器
-                                    reply_container = WebDriverWait(driver, 5).until(
-                                        EC.presence_of_element_located((By.CSS_SELECTOR, 'div[class*="DivReplyContainer"]'))
-                                    )
-                                    
-                                    # 在容器内查找子评论
-                                    child_comments = reply_container.find_elements(By.CSS_SELECTOR, 'div[class*="DivCommentItemWrapper"]')
-                                    button_stats['child_comments_found'] += len(child_comments)  # 增加找到的子评论计数
-                                    logger.info(f"找到 {len(child_comments)} 个子评论")
-                                    
-                                    if child_comments:
-                                        logger.info("子评论元素示例:")
-                                        sample_comment = child_comments[0]
-                                        logger.info(f"元素类名: {sample_comment.get_attribute('class')}")
-                                        logger.info(f"元素HTML: {sample_comment.get_attribute('outerHTML')}")
-                                        
-                                        # 处理每个子评论
-                                        for child_comment in child_comments:
-                                            try:
-                                                # 在每次访问元素前重新获取最新的引用
-                                                comment_id = child_comment.get_attribute('id') or child_comment.get_attribute('data-e2e') or child_comment.location['y']
-                                                fresh_comment = WebDriverWait(driver, 5).until(
-                                                    EC.presence_of_element_located((By.CSS_SELECTOR, f'div[class*="DivCommentItemWrapper"]'))
-                                                )
-                                                
-                                                # 获取用户链接
-                                                user_link = fresh_comment.find_element(By.CSS_SELECTOR, 'a[href^="/@"]')
-                                                user_id = user_link.get_attribute('href').replace('https://www.tiktok.com/@', '')
-                                                
-                                                # 获取评论内容
-                                                try:
-                                                    # 首先尝试获取完整的评论内容元素
-                                                    content_element = fresh_comment.find_element(By.CSS_SELECTOR, 'span[data-e2e="comment-level-2"]')
-                                                    # 然后获取其中的文本内容
-                                                    reply_content = content_element.find_element(By.CSS_SELECTOR, 'span[class*="weight-normal"]').text
-                                                except:
-                                                    try:
-                                                        # 备用选择器1：直接查找带有评论内容的span
-                                                        content_element = fresh_comment.find_element(By.CSS_SELECTOR, 'span[class*="TUXText"][class*="weight-normal"]')
-                                                        reply_content = content_element.text
-                                                    except:
-                                                        try:
-                                                            # 备用选择器2：查找评论容器内的所有normal weight文本
-                                                            content_elements = fresh_comment.find_elements(By.CSS_SELECTOR, 'span[class*="weight-normal"]')
-                                                            reply_content = next((el.text for el in content_elements if el.text.strip()), None)
-                                                        except:
-                                                            reply_content = None
-                                                
-                                                if not reply_content:
-                                                    logger.warning(f"无法获取子评论内容，跳过此评论")
-                                                    continue
-                                                
-                                                # 获取评论时间
-                                                try:
-                                                    time_span = fresh_comment.find_element(By.CSS_SELECTOR, 'div[class*="CommentSubContentWrapper"] span')
-                                                    reply_time = time_span.text
-                                                except:
-                                                    reply_time = ''
-                                                
-                                                # 添加到评论集合
-                                                comment_key = f"{user_id}:{reply_content}"
-                                                if reply_content and comment_key not in seen_comments:
-                                                    comments_data.append({
-                                                        'user_id': user_id,
-                                                        'reply_content': reply_content,
-                                                        'reply_time': reply_time,
-                                                        'reply_video_url': video_url
-                                                    })
-                                                    seen_comments.add(comment_key)
-                                                    
-                                                    comments_batch.append({
-                                                        'video_id': video_id,
-                                                        'user_id': user_id,
-                                                        'reply_content': reply_content,
-                                                        'reply_time': reply_time,
-                                                        'keyword': keyword,
-                                                        'collected_by': collected_by,
-                                                        'video_url': video_url
-                                                    })
-                                                    button_stats['child_comments_saved'] += 1  # 增加成功保存的子评论计数
-
-                                                    # 如果缓存批次达到50条，尝试存储到数据库
-                                                    if len(comments_batch) >= 50:
-                                                        inserted_count = batch_store_comments(comments_batch, db, task_id)
-                                                        if inserted_count == -1:  # 任务已停止
-                                                            return comments_data
-                                                        comments_batch.clear()  # 清空缓存
-                                                    
-                                            except Exception as e:
-                                                logger.error(f"处理子评论时发生错误: {str(e)}")
-                                                continue
-                                        
-                                        # 添加一个小幅度的向下滚动
-                                        scroll_amount = random.randint(100, 200)
-                                        driver.execute_script(f"window.scrollBy(0, {scroll_amount});")
-                                        logger.info(f"子评论加载后向下滚动 {scroll_amount} 像素")
-                                        
-                                        # 给一些时间让动画完成
-                                        random_wait(1, 2)
-                                        
-                                except TimeoutException:
-                                    button_stats['load_timeout'] += 1
-                                    logger.warning(f"等待子评论加载超时，按钮 ID: {button_id}")
-                                    continue
-                                
-                            except Exception as e:
-                                button_stats['click_failed'] += 1
-                                logger.error(f"点击加载按钮时发生错误: {str(e)}, 按钮 ID: {button_id}")
-                                continue
-                    
-                    except Exception as e:
-                        button_stats['click_failed'] += 1
-                        logger.error(f"处理按钮时发生错误: {str(e)}")
-                        continue
-                
-                # 如果没有找到可以加载的按钮，退出循环
-                if not found_loadable_button:
-                    logger.info("没有找到更多可加载的子评论按钮")
+        # 租约已被其他worker回收时停止采集
+        if lease and lease.lost:
+            logger.warning(f"视频 {video_id} 的租约已失效，停止采集")
+            controller.stop_reason = "视频租约已失效"
+            break
+
+        # 提取评论：network引擎读取评论接口响应，增量模式只返回新渲染的评论节点
+        comment_records = None
+        if capture:
+            comment_records = capture.poll()
+            controller.update_expected_total(capture.total)
+            logger.info(f"本轮解析出 {len(comment_records)} 条评论记录（累计 {capture.responses} 个评论接口响应）")
+            if capture.responses == 0 and total_scroll_attempts >= 2:
+                logger.warning("未捕获到评论接口响应，回退到html引擎")
+                capture = None
+                comment_records = None
+        if comment_records is None and incremental:
+            try:
+                comment_records = extract_new_comments(driver)
+            except Exception as e:
+                logger.warning(f"增量提取评论失败，回退到全量解析: {str(e)}")
+                incremental = False
+        if comment_records is None:
+            comment_records = extract_all_comments(driver)
+        if capture is None:
+            logger.info(f"本轮提取到 {len(comment_records)} 个评论节点（{'增量' if incremental else '全量'}模式）")
+
+        # 将新收集的评论添加到缓存批次，达到50条时尝试存储到数据库
+        add_records(comment_records)
+
+        # 批量展开回复：每一批点击所有可见按钮后只等待一次，直到没有按钮或没有新内容
+        expand_deadline = time.time() + controller.reply_idle_timeout()
+        while time.time() < expand_deadline:
+            try:
+                result = expand_visible_replies(driver, controller.load_timeout())
+            except Exception as e:
+                logger.warning(f"批量展开回复时发生错误: {str(e)}")
+                break
+            if result['clicked'] == 0:
+                break
+            reply_stats['rounds'] += 1
+            reply_stats['buttons_clicked'] += result['clicked']
+            reply_stats['replies_loaded'] += result['added']
+            logger.info(f"批量点击 {result['clicked']} 个回复按钮，{result['elapsed']:.1f} 秒内加载 {result['added']} 个评论节点")
+            if result['added'] == 0:
+                break
+            controller.record_latency(result['elapsed'])
+
+            # network引擎下回复由接口响应提供，下一轮统一读取
+            if capture is None:
+                try:
+                    new_replies = extract_new_comments(driver) if incremental else extract_all_comments(driver)
+                except Exception as e:
+                    logger.warning(f"提取回复失败: {str(e)}")
                     break
-                
-                # 检查是否需要暂停来防止频繁请求
-                random_wait(1, 3)
+                add_records(new_replies)
 
-        except Exception as e:
-            logger.error(f"处理评论的子评论加载按钮时发生错误: {str(e)}")
-            # 继续处理其他评论，不中断整个流程
+        # 记录本轮结果（新增评论来自上一轮滚动），由控制器判断是否继续
+        new_comments = len(comments_data) - last_comments_count
+        last_comments_count = len(comments_data)
+        logger.info(f"本轮新收集到 {new_comments} 条评论，累计收集 {len(comments_data)} 条评论")
+        controller.record_round(new_comments, height_delta, load_latency)
+        if controller.should_stop(len(comments_data)):
+            break
 
-        # 优化的滚动策略
-        if consecutive_no_new_comments >= max_consecutive_no_new:
-            logger.info("连续多次未加载新评论，尝试更激进的滚动策略")
-            
-            # 执行滚动到底部并回滚的操作
-            reached_bottom, scroll_distance = scroll_to_bottom_and_up(driver)
-            
-            if reached_bottom:
-                logger.info("已确认到达页面底部")
-                break
-                
-            consecutive_no_new_comments = 0
-            current_scroll_distance = min_scroll_distance
-            
-            # 给页面一些时间加载
-            random_sleep(2, 4)
+        if is_captcha_present(driver):
+            solve_captcha(driver)
+
+        last_height = driver.execute_script("return document.body.scrollHeight")
+        if controller.should_jump_to_bottom():
+            logger.info("连续多轮未加载新内容，滚动到底部再回滚以触发加载")
+            _, scroll_distance = scroll_to_bottom_and_up(driver)
         else:
-            # 动态调整滚动距离
-            scroll_distance = random.randint(current_scroll_distance, current_scroll_distance + 200)
+            scroll_distance = controller.scroll_distance()
             driver.execute_script(f"window.scrollBy(0, {scroll_distance});")
-            current_scroll_distance = min(current_scroll_distance + 50, max_scroll_distance)
-        
         logger.info(f"页面滚动完成，滚动距离: {scroll_distance} 像素")
-        
-        # 指数退避等待
-        wait_time = min(0.5 * (backoff_factor ** consecutive_no_new_comments), max_backoff_time)
-        random_sleep(wait_time, wait_time + 2)
-        
-        # 检测是否到达页面底部
-        last_height = driver.execute_script("return document.body.scrollHeight")
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        random_sleep(1, 2)
-        new_height = driver.execute_script("return document.body.scrollHeight")
-        
-        if new_height == last_height:
-            logger.info("已到达页面底部")
-            break
-        
-        if len(comments_data) > last_comments_count:
-            new_comments = comments_data[last_comments_count:]
-            logger.info(f"本轮新收集到 {len(new_comments)} 条评论，累计收集 {len(comments_data)} 条评论")
-            consecutive_no_new_comments = 0
-            scroll_attempts = 0
-            current_scroll_distance = min_scroll_distance  # 重置滚动距离
-        else:
-            consecutive_no_new_comments += 1
-            logger.info(f"未加载新评论，连续未加载次数: {consecutive_no_new_comments}")
-        
-        last_comments_count = len(comments_data)
 
-        if is_captcha_present(driver):
-            solve_captcha(driver)
+        # 等待新内容渲染并记录加载耗时，再按耗时决定下一轮前的等待
+        load_latency, new_height = wait_for_page_growth(driver, last_height, controller.load_timeout())
+        height_delta = new_height - last_height
+        time.sleep(controller.next_wait())
 
-        # 随机暂停
-        if random.random() < 0.2:
-            pause_time = random.uniform(3, 10)
-            logger.info(f"随机暂停 {pause_time:.2f} 秒")
-            time.sleep(pause_time)
+    summary = controller.summary(len(comments_data))
+    logger.info(summary)
+    db.is_connected() or db.connect()
+    db.add_tiktok_task_log(task_id, 'info', f"视频 {video_id}: {summary}")
 
-    logger.info(f"动结束，原因: {'达到最大滚动次数' if scroll_attempts >= max_scroll_attempts else '到达页面底部'}")
+    # network引擎：补充最后一轮滚动和展开回复触发的接口响应
+    if capture:
+        try:
+            for record in capture.poll():
+                add_record(record)
+        except Exception as e:
+            logger.warning(f"读取最后一轮评论接口响应失败: {str(e)}")
 
     # 循环结束后，存储剩余的评论
     if comments_batch:
         try:
-            inserted_count = 0
-            for batch_comment in comments_batch:
-                result = db.add_tiktok_comment(
-                    video_id=batch_comment['video_id'],
-                    user_id=batch_comment['user_id'],
-                    reply_content=batch_comment['reply_content'],
-                    reply_time=batch_comment['reply_time'],
-                    keyword=batch_comment['keyword'],
-                    collected_by=batch_comment['collected_by'],
-                    video_url=batch_comment['video_url']
-                )
-                if result > 0:
-                    inserted_count += 1
-            logger.info(f"尝试储剩余的 {len(comments_batch)} 条评论到数据库,成功插入 {inserted_count} 条新评论,忽略 {len(comments_batch) - inserted_count} 条重复评论")
+            result = store_comments(comments_batch, db)
         except Exception as e:
             logger.error(f"存储剩余评论到数据库时发生错误: {str(e)}")
+            result = None
+        if result is not None:
+            logger.info(f"尝试储存剩余的 {len(comments_batch)} 条评论到数据库,成功插入 {result['inserted']} 条新评论,忽略 {result['duplicates']} 条重复评论")
+        else:
+            logger.error(f"剩余的 {len(comments_batch)} 条评论写入失败，已丢弃")
+
+    if capture:
+        # 按平台评论ID回填回复的 parent_comment_id
+        db.is_connected() or db.connect()
+        linked = db.link_tiktok_comment_parents(video_id)
+        logger.info(f"关联了 {linked} 条回复的父评论")
 
-    logger.info(f"评论收集完成，子评论加载统计:")
-    logger.info(f"- 总计发现按钮数: {button_stats['total_buttons_found']}")
-    logger.info(f"- 点击成功次数: {button_stats['click_success']}")
-    logger.info(f"- 点击失败次数: {button_stats['click_failed']}")
-    logger.info(f"- 加载成功次数: {button_stats['load_success']}")
-    logger.info(f"- 加载超时次数: {button_stats['load_timeout']}")
-    logger.info(f"- 找到的子评论数: {button_stats['child_comments_found']}")
-    logger.info(f"- 保存的子评论数: {button_stats['child_comments_saved']}")
-    if button_stats['total_buttons_found'] > 0:
-        logger.info(f"- 点击成功率: {(button_stats['click_success'] / button_stats['total_buttons_found'] * 100):.1f}%")
-        logger.info(f"- 加载成功率: {(button_stats['load_success'] / max(button_stats['click_success'], 1) * 100):.1f}%")
-    if button_stats['child_comments_found'] > 0:
-        logger.info(f"- 子评论保存率: {(button_stats['child_comments_saved'] / button_stats['child_comments_found'] * 100):.1f}%")
+    logger.info(f"回复展开统计: 批量展开 {reply_stats['rounds']} 轮，点击 {reply_stats['buttons_clicked']} 个按钮，"
+                f"加载 {reply_stats['replies_loaded']} 个评论节点")
 
     logger.info(f"评论收集完成，共收集 {len(comments_data)} 条评论")
     return comments_data
@@ -1240,113 +1370,116 @@ def get_public_ip():
         logger.error(f"获取公网IP失败: {str(e)}")
         return None
 
-def process_task(task_id, keyword, server_ip):
+def search_task_videos(task_id, keyword, server_ip, block_resources=True):
+    """
+    搜索任务关键词下的视频并写入数据库（由调度器在一个浏览器槽位中执行）
+
+    Returns:
+        int: 搜索到的视频链接数
+    """
     db = MySQLDatabase()
     db.connect()
-    driver = None
+    browser = None
+    discard_browser = False  # 出错时浏览器状态不可信，不放回池中
     try:
-        cleanup_zombie_processes()  # 在开始任务前清理僵尸进程
-        logger.info(f"开始处理任务 ID: {task_id}, 关键词: {keyword}, 服务器IP: {server_ip}")
+        cleanup_zombie_processes()
+        logger.info(f"开始搜索任务 ID: {task_id}, 关键词: {keyword}, 服务器IP: {server_ip}")
         db.update_tiktok_task_details(task_id, status='running', start_time=datetime.now())
         db.add_tiktok_task_log(task_id, 'info', f"开始处理TikTok任务: {keyword}")
 
-        driver = setup_driver()
+        browser = tiktok_browser_pool.checkout()
+        set_resource_blocking(browser.driver, block_resources)
+        video_links = search_tiktok_video_links(browser.driver, keyword)
+        db.is_connected() or db.connect()
+        db.add_tiktok_videos_batch(task_id, video_links, keyword)
+        logger.info(f"为任务 {task_id} 添加了 {len(video_links)} 个视频")
+        return len(video_links)
+    except Exception:
+        discard_browser = True
+        raise
+    finally:
+        if browser:
+            tiktok_browser_pool.checkin(browser, discard=discard_browser)
+        db.disconnect()
 
-        # 尝试使用本地cookies登录
-        user_id = login_by_local_cookies(driver)
-        logger.info(f"成功登录，用户ID: {user_id}")
 
-        # 搜索视频并添加到数据库
-        video_links = search_tiktok_video_links(driver, keyword)
-        db.add_tiktok_videos_batch(task_id, video_links, keyword)
-        logger.info(f"为务 {task_id} 添加了 {len(video_links)} 个视频")
+def process_video(task_id, keyword, video_id, video_url, server_ip, lease_owner, block_resources=True):
+    """
+    在独立的浏览器中采集单个视频的评论（由调度器在一个浏览器槽位中执行）
 
-        video_count = 0
-        while True:
-            # 检查数据库连接
-            db.is_connected() or db.connect()
-            
-            # 获取任务状态
-            task_status = db.get_tiktok_task_status(task_id)
-            
-            if task_status == 'running':
-                logger.info(f"正在获取任务 {task_id} 的下一个待处理视频")
-                next_video = db.get_next_pending_video(task_id, server_ip)
-                if not next_video:
-                    logger.info(f"任务 {task_id} 没有更多待处理的视频，退出循环")
-                    break  # 没有更多待处理的视频
-
-                video_id, video_url, status = next_video['id'], next_video['video_url'], next_video['status']
-                if status == 'processing':
-                    logger.info(f"继续处理之前未完成的视频ID {video_id}, URL {video_url}")
-                else:
-                    logger.info(f"开始处理新视频：ID {video_id}, URL {video_url}")
-                try:
-                    comments = collect_comments(driver, video_url, video_id, keyword, db, user_id, task_id)
-                    logger.info(f"任务 {task_id} 收集到 {len(comments)} 条来自 {video_url} 的评论")
+    视频需已通过 claim_next_video 以 lease_owner 领取，从领取浏览器到写入完成期间在后台定期续租，
+    完成后标记为completed，出错时标记为failed，任务已暂停/停止时放回pending且不计入进度；
+    租约已被回收时不再更新视频状态和任务进度。
+    block_resources 为True时屏蔽视频、图片和字体请求。
 
-                    db.is_connected() or db.connect()
+    Returns:
+        int: 收集到的评论数
+    """
+    db = MySQLDatabase()
+    db.connect()
+    browser = None
+    discard_browser = False  # 出错时浏览器状态不可信，不放回池中
+    try:
+        logger.info(f"开始处理视频：任务 {task_id}, 视频ID {video_id}, URL {video_url}, 服务器IP: {server_ip}")
+        with VideoLeaseKeeper(video_id, lease_owner) as lease:
+            browser = tiktok_browser_pool.checkout()
+            set_resource_blocking(browser.driver, block_resources)
 
-                    db.mark_video_completed(video_id)
-                    video_count += 1
-                    db.update_task_progress(task_id, 1)
-                except Exception as e:
-                    logger.error(f"处理视频 {video_url} 时出错: {str(e)}")
-                    try:
-                        db.update_tiktok_video_status(video_id, 'failed')
-                    except Exception as e:
-                        logger.error(f"更新视频 {video_url} 状态为failed时发生错误: {str(e)}")
-            else:
-                logger.info(f"任务 {task_id} 状态为 {task_status}, 退出浏览器...")
-                break
-        
-        # 检查数据库连接
-        db.is_connected() or db.connect()
+            comments = collect_comments(browser.driver, video_url, video_id, keyword, db, browser.user_id, task_id,
+                                        lease=lease)
+        logger.info(f"任务 {task_id} 收集到 {len(comments)} 条来自 {video_url} 的评论")
 
-        logger.info(f"任务 {task_id} 完成，处理了 {video_count} 个视频")
-        if task_status == 'running':
-            # 任务状态running，更新为completed
-            db.update_tiktok_task_details(task_id, status='completed', end_time=datetime.now())
-        elif task_status == 'paused':
-            # 任务态为paused，更新为paused
-            db.update_tiktok_task_details(task_id, status='paused', end_time=datetime.now())
-        elif task_status == 'failed':
-            # 任状态为failed，更新为failed
-            db.update_tiktok_task_details(task_id, status='failed', end_time=datetime.now())
+        db.is_connected() or db.connect()
+        if db.release_video_lease(video_id, lease_owner, 'completed'):
+            db.update_task_progress(task_id, 1)
+        else:
+            logger.warning(f"视频 {video_id} 的租约已被回收，不更新任务进度")
+        return len(comments)
+    except CollectionStopped as e:
+        logger.info(f"任务 {task_id} 已停止，视频 {video_id} 放回待处理: {str(e)}")
+        try:
+            db.is_connected() or db.connect()
+            db.release_video_lease(video_id, lease_owner, 'pending')
+        except Exception as release_error:
+            logger.error(f"更新视频 {video_url} 状态为pending时发生错误: {str(release_error)}")
+        return e.collected
     except Exception as e:
-        logger.error(f"处理任务时发生错误: {str(e)}")
-        db.is_connected or db.connect()
-        db.update_tiktok_task_details(task_id, status='failed', end_time=datetime.now())
+        logger.error(f"处理视频 {video_url} 时出错: {str(e)}")
+        discard_browser = True
+        try:
+            db.is_connected() or db.connect()
+            db.release_video_lease(video_id, lease_owner, 'failed')
+        except Exception as e:
+            logger.error(f"更新视频 {video_url} 状态为failed时发生错误: {str(e)}")
+        return 0
     finally:
-        if driver:
-            try:
-                driver.quit()
-            except Exception as e:
-                logger.error(f"关闭WebDriver时发生错误: {str(e)}")
+        if browser:
+            tiktok_browser_pool.checkin(browser, discard=discard_browser)
         db.disconnect()
-        cleanup_chrome_processes()  # 确保在任务结束时清理所有Chrome进程
 
 def check_account_status(account_id, username, email):
     db = MySQLDatabase()
     db.connect()
     driver = None
     try:
-        driver = setup_driver()
-        
-        # 尝试使用本地cookies登录，指定用户名
+        # 尝试从浏览器池取出使用该账号本地cookies登录的浏览器；池中复用的浏览器只检查过cookie是否存在，
+        # 需要打开页面确认登录态仍然有效后才标记为active
         try:
-            user_id = login_by_local_cookies(driver, username)
-            if user_id:
-                # 登录成功，更新账号状态
+            browser = tiktok_browser_pool.checkout(username)
+            if check_login_status(browser.driver):
+                tiktok_browser_pool.checkin(browser)
                 db.update_tiktok_account_status(account_id, 'active')
                 logger.info(f"账号 {username} 使用本地cookies登录成功，状态更新为active")
                 return  # 登录成功，直接返回
-        except Exception as e:
+            tiktok_browser_pool.checkin(browser, discard=True)
+            logger.error(f"账号 {username} 的浏览器登录态已失效")
+        except BrowserLoginError as e:
             logger.error(f"使用本地cookies登录失败: {str(e)}")
-            # 继续执行手动登录逻辑
+        # 继续执行手动登录逻辑
         
-        # 登录失或发生异常，尝试手动登录
+        # 登录失或发生异常，尝试手动登录（人工操作的浏览器不放入池中）
         logger.info(f"尝试手动登录账号 {username}")
+        driver = setup_driver()
         
         # 导航到TikTok登录页面
         driver.get("https://www.tiktok.com/login/phone-or-email/email")
@@ -1414,20 +1547,20 @@ def check_account_status(account_id, username, email):
 def send_promotion_messages(user_messages, account_id, batch_size=5, wait_time=60, keyword=None):
     db = MySQLDatabase()
     db.connect()
-    driver = None
+    browser = None
     results = []
     try:
-        driver = setup_driver()
-        
         # 获取账号信
         account = db.get_tiktok_account_by_id(account_id)
         if not account:
             return [{"success": False, "message": "账号不存在", "action": "none", "user_id": user_msg['user_id']} for user_msg in user_messages]
         
-        # 使用账号登录
-        login_success = login_by_local_cookies(driver)
-        if not login_success:
+        # 从浏览器池取出已登录的浏览器
+        try:
+            browser = tiktok_browser_pool.checkout()
+        except BrowserLoginError:
             return [{"success": False, "message": "登录失败", "action": "none", "user_id": user_msg['user_id']} for user_msg in user_messages]
+        driver = browser.driver
         
         # 分批处理用户
         for i in range(0, len(user_messages), batch_size):
@@ -1453,8 +1586,8 @@ def send_promotion_messages(user_messages, account_id, batch_size=5, wait_time=6
         logger.error(f"批量发送推广消息时发生错误: {str(e)}")
         return results + [{"success": False, "message": f"发生错误: {str(e)}", "action": "none", "user_id": user_msg['user_id']} for user_msg in user_messages[len(results):]]
     finally:
-        if driver:
-            driver.quit()
+        if browser:
+            tiktok_browser_pool.checkin(browser, pages=max(len(results), 1))
         db.disconnect()
 
 def random_wait(min_time=1, max_time=5):
@@ -1839,6 +1972,44 @@ def send_single_promotion_message(driver, user_id, message, keyword, db, account
         logger.error(f"发送推广消息失败的详细错误: {traceback.format_exc()}")
         return {"success": False, "message": f"发生错误: {str(e)}", "action": "none", "user_id": user_id}
 
+def store_comments(comments_batch, db: MySQLDatabase, task_id=None):
+    """
+    写入一批评论，整批插入失败时逐条重试，只丢弃仍然写入失败的评论
+
+    Args:
+        comments_batch: 待存储的评论列表
+        db: 数据库连接对象
+        task_id: 可选，传入时同时返回任务状态
+
+    Returns:
+        dict: add_tiktok_comments_batch 的结果，另含 dropped（逐条重试后仍失败而丢弃的条数）；
+            一条都没有写入成功（如数据库不可用）时返回None，由调用方保留评论稍后重试
+    """
+    db.is_connected() or db.connect()
+    result = db.add_tiktok_comments_batch(comments_batch, task_id=task_id)
+    if result is not None:
+        result['dropped'] = 0
+        return result
+
+    logger.warning(f"整批写入 {len(comments_batch)} 条评论失败，改为逐条写入")
+    result = {'inserted': 0, 'duplicates': 0, 'dropped': 0, 'task_status': None}
+    for comment in comments_batch:
+        db.is_connected() or db.connect()
+        row_result = db.add_tiktok_comments_batch([comment], task_id=task_id)
+        if row_result is None:
+            result['dropped'] += 1
+            continue
+        result['inserted'] += row_result['inserted']
+        result['duplicates'] += row_result['duplicates']
+        result['task_status'] = row_result['task_status']
+
+    if result['dropped'] == len(comments_batch):
+        return None
+    if result['dropped']:
+        logger.error(f"逐条写入后仍有 {result['dropped']} 条评论写入失败，已丢弃")
+    return result
+
+
 def batch_store_comments(comments_batch, db: MySQLDatabase, task_id):
     """
     批量存储评论到数据库
@@ -1849,39 +2020,48 @@ def batch_store_comments(comments_batch, db: MySQLDatabase, task_id):
         task_id: 任务ID
 
     Returns:
-        inserted_count: 成功插入的评论数量
+        inserted_count: 成功插入的评论数量；任务已停止时返回-1；
+            写入失败时返回None，调用方应保留这批评论稍后重试
     """
     try:
-        db.is_connected() or db.connect()
-        inserted_count = 0
-        for batch_comment in comments_batch:
-            result = db.add_tiktok_comment(
-                video_id=batch_comment['video_id'],
-                user_id=batch_comment['user_id'],
-                reply_content=batch_comment['reply_content'],
-                reply_time=batch_comment['reply_time'],
-                keyword=batch_comment['keyword'],
-                collected_by=batch_comment['collected_by'],
-                video_url=batch_comment['video_url']
-            )
-            if result > 0:
-                inserted_count += 1
-        
-        logger.info(f"尝试储存{len(comments_batch)}条评论到数据库,成功插入 {inserted_count} 条新评论,忽略 {len(comments_batch) - inserted_count} 条重复评论")
-        
-        # 检查任务状态
-        task_status = db.get_tiktok_task_status(task_id)
-        if task_status != 'running':
-            logger.info(f"任务状态为 {task_status}，停止收集评论")
-            return -1  # 返回特殊值表示任务已停止
-            
-        return inserted_count
-        
+        # 整批写入并在同一事务内获取任务状态
+        result = store_comments(comments_batch, db, task_id)
     except Exception as e:
         logger.error(f"存储评论到数据库时发生错误: {str(e)}")
-        return 0
+        result = None
+    if result is None:
+        logger.error(f"{len(comments_batch)} 条评论写入失败，保留在缓存中稍后重试")
+        return None
+
+    inserted_count = result['inserted']
+    logger.info(f"尝试储存{len(comments_batch)}条评论到数据库,成功插入 {inserted_count} 条新评论,忽略 {result['duplicates']} 条重复评论")
+
+    # 检查任务状态
+    task_status = result['task_status']
+    if task_status != 'running':
+        logger.info(f"任务状态为 {task_status}，停止收集评论")
+        return -1  # 返回特殊值表示任务已停止
+
+    return inserted_count
 
     
+def wait_for_page_growth(driver, last_height, timeout):
+    """
+    等待页面高度超过 last_height（新评论已渲染）
+
+    Returns:
+        tuple: (加载耗时，超时未增高时为None, 当前页面高度)
+    """
+    start_time = time.time()
+    height = last_height
+    while time.time() - start_time < timeout:
+        height = driver.execute_script("return document.body.scrollHeight")
+        if height > last_height:
+            return time.time() - start_time, height
+        time.sleep(0.2)
+    return None, height
+
+
 def scroll_to_bottom_and_up(driver):
     """
     快速滚动到页面底部，然后往上翻滚一些距离
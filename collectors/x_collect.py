@@ -29,6 +29,7 @@ from bs4 import BeautifulSoup
 import undetected_chromedriver as uc
 
 from common.mysql import MySQLDatabase
+from browser_pool import BrowserPool, BrowserLoginError
 
 
 # 配置日志记录到文件
@@ -112,8 +113,8 @@ def check_login_status(driver):
         driver.get("https://x.com/home")
         WebDriverWait(driver, 10).until(lambda d: d.execute_script('return document.readyState') == 'complete')
         
-        # 检查是否在主页
-        if "twitter.com/home" in driver.current_url:
+        # 检查是否在主页（x.com 或旧域名 twitter.com）
+        if re.search(r'(x|twitter)\.com/home', driver.current_url):
             logger.info("检测到主页URL，登录状态有效")
             return True
         else:
@@ -136,21 +137,31 @@ def login_by_local_cookies(driver, username):
     logger.info(f"使用本地cookies登录账号 {username} 失败")
     return False
 
+# 复用已登录浏览器的池，按账号分组
+x_browser_pool = BrowserPool('x', setup_driver, login_by_local_cookies, session_cookie='auth_token')
+
 def check_x_account_status(account_id, username, email, password):
     db = MySQLDatabase()
     db.connect()
     driver = None
     try:
         logger.info(f"开始检查账号 {username} 的状态")
+        # 池中复用的浏览器只检查过cookie是否存在，需要打开页面确认登录态仍然有效后才标记为active
+        try:
+            browser = x_browser_pool.checkout(username)
+            if check_login_status(browser.driver):
+                x_browser_pool.checkin(browser)
+                db.update_x_account_status(account_id, 'active')
+                logger.info(f"账号 {username} 使用本地cookies登录成功，状态更新为active")
+                return
+            x_browser_pool.checkin(browser, discard=True)
+            logger.info(f"账号 {username} 的浏览器登录态已失效，尝试手动登录")
+        except BrowserLoginError as e:
+            logger.info(f"{str(e)}，尝试手动登录账号 {username}")
+
+        # 手动登录使用独立的浏览器，不放入池中
         driver = setup_driver()
         logger.info(f"WebDriver 已设置完成")
-        
-        if login_by_local_cookies(driver, username):
-            db.update_x_account_status(account_id, 'active')
-            logger.info(f"账号 {username} 使用本地cookies登录成功，状态更新为active")
-            return
-        
-        logger.info(f"本地cookies登录失败，尝试手动登录账号 {username}")
         driver.get("https://x.com/i/flow/login")
         logger.info(f"已打开登录页面")
         
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : analysis_jobs.py
+@Software: PyCharm
+@Description: 评论两轮分析的执行逻辑和后台分析任务调度器。分析以任务形式保存在 analysis_jobs 表中，
+              由后台线程按租约领取执行，页面刷新或断开不影响运行，worker崩溃后租约过期由其他worker续跑
+"""
+import os
+import socket
+import argparse
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from common.log_config import setup_logger
+from common.openai import (iter_structured_gpt_batches, pack_comment_batches, get_prompt_template_hash,
+                           get_cached_gpt_results, save_gpt_results_to_cache)
+from common.pre_classifier import NEGATIVE_LABEL, PreClassifier, PreClassifierError
+from collectors.common.mysql import MySQLDatabase, ANALYSIS_JOB_LEASE_SECONDS
+
+# 配置日志
+logger = setup_logger(__name__)
+
+# 调度配置
+ANALYSIS_WORKER_SLOTS = int(os.environ.get('ANALYSIS_WORKER_SLOTS', 2))  # 每个进程同时执行的分析任务数
+ANALYSIS_EMBEDDED_WORKERS = os.environ.get('ANALYSIS_EMBEDDED_WORKERS', '1') == '1'  # Streamlit进程内是否运行调度器
+ANALYSIS_POLL_INTERVAL = int(os.environ.get('ANALYSIS_POLL_INTERVAL', 5))  # 无事件唤醒时的轮询间隔（秒）
+
+# 两轮分析结构化输出的字段（除序号和用户ID外）及允许的取值
+FIRST_ROUND_FIELDS = {"分类结果": ["潜在客户", "非目标客户"], "分析理由": None}
+SECOND_ROUND_FIELDS = {"第二轮分类结果": ["高意向客户", "中等意向客户", "低意向客户"], "分析理由": None}
+
+# 各平台读取和保存分析数据的方法
+ANALYSIS_PLATFORMS = {
+    'tiktok': {
+        'get_filtered': 'get_filtered_tiktok_comments_by_keyword',
+        'get_potential': 'get_potential_customers',
+        'save_first': 'save_analyzed_comments',
+        'save_second': 'save_second_round_analyzed_comments',
+    },
+    'x': {
+        'get_filtered': 'get_filtered_x_comments_by_keyword',
+        'get_potential': 'get_x_potential_customers',
+        'save_first': 'save_analyzed_x_comments',
+        'save_second': 'save_second_round_analyzed_x_comments',
+    },
+}
+
+# 任务阶段：first_round 完成后记录为 second_round，续跑时从记录的阶段开始
+STAGE_FIRST_ROUND = 'first_round'
+STAGE_SECOND_ROUND = 'second_round'
+STAGE_DONE = 'done'
+
+
+class AnalysisJobStopped(Exception):
+    """任务已被取消或租约已被其他worker回收"""
+
+
+def remove_punctuation(text):
+    """移除字符串开头和结尾的标点符号"""
+    return text.strip('.,;:!?"\' ')
+
+
+def build_result_row(analysis_round: int, comment: dict, result: dict) -> dict:
+    """一条评论的分析结果行（保存方法和结果缓存使用的格式）"""
+    if analysis_round == 1:
+        return {"用户ID": comment['user_id'], "评论内容": comment['reply_content'],
+                "分类结果": result['分类结果'], "分析理由": remove_punctuation(result['分析理由'])}
+    return {"用户ID": comment['user_id'], "评论内容": comment['reply_content'], "第一轮分类结果": "潜在客户",
+            "第二轮分类结果": result['第二轮分类结果'], "分析理由": remove_punctuation(result['分析理由'])}
+
+
+def save_result_rows(db, platform: str, analysis_round: int, keyword: str, rows: list, model: str = None,
+                     template_hash: str = None):
+    """保存分析结果行，传入 model 和 template_hash 时同时写入GPT结果缓存"""
+    if not rows:
+        return 0
+    save = getattr(db, ANALYSIS_PLATFORMS[platform]['save_first' if analysis_round == 1 else 'save_second'])
+    saved = save(keyword, pd.DataFrame(rows))
+    if model and template_hash:
+        save_gpt_results_to_cache(db, model, template_hash, [
+            (row['评论内容'], {name: value for name, value in row.items() if name not in ('用户ID', '评论内容')})
+            for row in rows
+        ])
+    return saved
+
+
+def serialize_pre_classifier(model) -> bytes:
+    """本地预分类模型的参数（权重、idf）以 npz 数组随任务保存，阈值保存在任务的 pre_threshold 列"""
+    return model.to_bytes() if model is not None else None
+
+
+def deserialize_pre_classifier(data):
+    """读取任务保存的预分类模型，无法读取时不使用预分类（评论全部发送给GPT）"""
+    if not data:
+        return None
+    try:
+        return PreClassifier.from_bytes(data)
+    except PreClassifierError as e:
+        logger.warning(f"{e}，本次分析不使用本地预分类")
+        return None
+
+
+def prepare_first_round(db, platform: str, keyword: str, model: str, comments: list, prompt_template: str,
+                        pre_classifier=None, pre_threshold=None) -> dict:
+    """
+    第一轮分析前查询结果缓存并执行本地预分类，命中缓存和预分类标注的结果直接保存。
+
+    :return: {'cached': 命中缓存数, 'pre_labeled': 预分类标注数, 'uncached': 需要GPT分析的评论}。
+    """
+    template_hash = get_prompt_template_hash(prompt_template)
+    cached_results = get_cached_gpt_results(db, model, template_hash, comments)
+    cached_rows = [
+        {"用户ID": comment['user_id'], "评论内容": comment['reply_content'], **cached}
+        for comment, cached in zip(comments, cached_results) if cached
+    ]
+    uncached = [comment for comment, cached in zip(comments, cached_results) if not cached]
+    save_result_rows(db, platform, 1, keyword, cached_rows)
+
+    # 本地预分类：高置信度的非目标客户直接标注，不发送给GPT（也不写入GPT结果缓存）
+    pre_rows = []
+    if pre_classifier is not None and uncached:
+        negative_proba = pre_classifier.predict_negative_proba([comment['reply_content'] for comment in uncached])
+        pre_rows = [
+            {"用户ID": comment['user_id'], "评论内容": comment['reply_content'], "分类结果": NEGATIVE_LABEL,
+             "分析理由": f"本地预分类（置信度 {probability:.2f}）", "标注来源": "pre_classifier"}
+            for comment, probability in zip(uncached, negative_proba) if probability >= pre_threshold
+        ]
+        save_result_rows(db, platform, 1, keyword, pre_rows)
+        uncached = [comment for comment, probability in zip(uncached, negative_proba) if probability < pre_threshold]
+    return {'cached': len(cached_rows), 'pre_labeled': len(pre_rows), 'uncached': uncached}
+
+
+def prepare_second_round(db, platform: str, keyword: str, model: str, comments: list, prompt_template: str) -> dict:
+    """
+    第二轮分析前查询结果缓存，命中的结果直接保存。
+
+    :return: {'cached': 命中缓存数, 'uncached': 需要GPT分析的评论}。
+    """
+    template_hash = get_prompt_template_hash(prompt_template)
+    cached_results = get_cached_gpt_results(db, model, template_hash, comments)
+    cached_rows = [
+        {"用户ID": comment['user_id'], "评论内容": comment['reply_content'], **cached}
+        for comment, cached in zip(comments, cached_results) if cached
+    ]
+    save_result_rows(db, platform, 2, keyword, cached_rows)
+    return {'cached': len(cached_rows), 'uncached': [comment for comment, cached in zip(comments, cached_results)
+                                                     if not cached]}
+
+
+def run_round(db, platform: str, analysis_round: int, keyword: str, model: str, batch_size: int, comments: list,
+              prompt_template: str, on_progress=None) -> dict:
+    """
+    用GPT分析一轮评论，每得到一部分结果就保存并写入结果缓存（即检查点：中断后重新执行时这些评论命中缓存）。
+
+    :param on_progress: 每次保存后调用 on_progress(已处理数, 已保存数, 放弃数)，可以抛出异常中止。
+    :return: {'saved': 保存数, 'ignored': 补请求后仍没有有效结果的评论数}。
+    """
+    fields = FIRST_ROUND_FIELDS if analysis_round == 1 else SECOND_ROUND_FIELDS
+    template_hash = get_prompt_template_hash(prompt_template)
+    # 按token预算打包批次（batch_size 为每批最多条数），以结构化输出并发发送给GPT，缺失的行自动补请求
+    packed_batches = pack_comment_batches(comments, prompt_template, model, max_rows=batch_size, echo_text=False)
+
+    processed, saved, ignored = 0, 0, 0
+    for result in iter_structured_gpt_batches(model, prompt_template, packed_batches, fields):
+        if result.error:
+            logger.error(f"[{keyword}] 第{analysis_round}轮批次 {result.batch_index + 1} 处理失败: {result.error}")
+        rows = [build_result_row(analysis_round, comment, row) for comment, row in result.rows]
+        save_result_rows(db, platform, analysis_round, keyword, rows, model, template_hash)
+        saved += len(rows)
+        if result.missing:
+            ignored += len(result.missing)
+            logger.warning(f"[{keyword}] 第{analysis_round}轮批次 {result.batch_index + 1} 有 {len(result.missing)} "
+                           f"条评论补请求后仍没有有效结果，示例: {result.missing[:3]}")
+        # 流式输出时同一批次会分多次产出，按本次得到结果和最终放弃的评论数累计进度
+        processed += len(result.rows) + len(result.missing)
+        if on_progress:
+            on_progress(processed, saved, ignored)
+    return {'saved': saved, 'ignored': ignored}
+
+
+def run_analysis_job(db, job: dict, checkpoint):
+    """
+    执行分析任务的两轮分析，从任务记录的阶段开始。
+
+    :param checkpoint: checkpoint(**进度字段) 记录阶段和进度并续租，任务被取消或租约丢失时抛出 AnalysisJobStopped。
+    """
+    platform, keyword, model = job['platform'], job['keyword'], job['model']
+    methods = ANALYSIS_PLATFORMS[platform]
+    # 从第二轮续跑时保留第一轮放弃的评论数，第一轮重新执行时重新计数
+    ignored = (job.get('ignored_count') or 0) if job['stage'] != STAGE_FIRST_ROUND else 0
+
+    if job['stage'] == STAGE_FIRST_ROUND:
+        comments = getattr(db, methods['get_filtered'])(keyword, limit=job['total_comments']) or []
+        prepared = prepare_first_round(db, platform, keyword, model, comments, job['prompt_template_first'],
+                                       deserialize_pre_classifier(job.get('pre_classifier')), job.get('pre_threshold'))
+        done = len(comments) - len(prepared['uncached'])
+        checkpoint(progress_total=len(comments), progress_done=done, cached_count=prepared['cached'],
+                   pre_labeled_count=prepared['pre_labeled'])
+        stats = run_round(db, platform, 1, keyword, model, job['batch_size'], prepared['uncached'],
+                          job['prompt_template_first'],
+                          lambda processed, saved, round_ignored: checkpoint(
+                              progress_done=done + processed, first_round_saved=saved,
+                              ignored_count=ignored + round_ignored))
+        ignored += stats['ignored']
+        checkpoint(stage=STAGE_SECOND_ROUND, progress_done=0, progress_total=0, ignored_count=ignored)
+        logger.info(f"[{keyword}] 第一轮分析完成，保存 {stats['saved']} 条")
+
+    potential_customers = getattr(db, methods['get_potential'])(keyword) or []
+    if potential_customers:
+        prepared = prepare_second_round(db, platform, keyword, model, potential_customers,
+                                        job['prompt_template_second'])
+        done = len(potential_customers) - len(prepared['uncached'])
+        checkpoint(progress_total=len(potential_customers), progress_done=done)
+        stats = run_round(db, platform, 2, keyword, model, job['batch_size'], prepared['uncached'],
+                          job['prompt_template_second'],
+                          lambda processed, saved, round_ignored: checkpoint(
+                              progress_done=done + processed, second_round_saved=saved,
+                              ignored_count=ignored + round_ignored))
+        ignored += stats['ignored']
+        logger.info(f"[{keyword}] 第二轮分析完成，保存 {stats['saved']} 条")
+    else:
+        logger.info(f"[{keyword}] 未发现潜在客户，跳过第二轮分析")
+    checkpoint(stage=STAGE_DONE, ignored_count=ignored)
+
+
+def execute_analysis_job(job: dict, lease_owner: str):
+    """在worker线程中执行已领取的任务，使用独立的数据库连接"""
+    db = MySQLDatabase()
+    db.connect()
+    try:
+        def checkpoint(**progress):
+            if not db.update_analysis_job_progress(job['id'], lease_owner, ANALYSIS_JOB_LEASE_SECONDS, **progress):
+                raise AnalysisJobStopped(f"分析任务 {job['id']} 已取消或租约已被回收")
+
+        try:
+            run_analysis_job(db, job, checkpoint)
+            db.finish_analysis_job(job['id'], lease_owner, 'completed')
+            logger.info(f"分析任务 {job['id']}（{job['keyword']}）完成")
+        except AnalysisJobStopped as e:
+            logger.info(str(e))
+        except Exception as e:
+            logger.error(f"分析任务 {job['id']}（{job['keyword']}）失败: {str(e)}", exc_info=True)
+            db.finish_analysis_job(job['id'], lease_owner, 'failed', str(e))
+    finally:
+        db.disconnect()
+
+
+class AnalysisJobScheduler:
+    """
+    后台分析任务调度器
+
+    - 每个槽位同一时间执行一个任务（通过 claim_analysis_job 领取租约），不同关键词的任务并行执行
+    - 执行中每保存一部分结果就记录进度并续租；进程退出后租约过期，任务由其他调度器从记录的阶段续跑
+    - 多个进程（Streamlit 进程内嵌的调度器、独立的 worker 进程）可以同时运行，按租约互斥
+    """
+
+    def __init__(self, worker_id, max_slots=ANALYSIS_WORKER_SLOTS, poll_interval=ANALYSIS_POLL_INTERVAL):
+        self.worker_id = worker_id
+        self.max_slots = max_slots
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._jobs = {}  # future -> 任务ID
+
+    def start(self):
+        """启动调度线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_slots, thread_name_prefix='analysis-slot')
+            self._thread = threading.Thread(target=self._run, name='analysis-scheduler', daemon=True)
+            self._thread.start()
+        logger.info(f"分析任务调度器已启动（{self.worker_id}），槽位数: {self.max_slots}")
+
+    def stop(self, wait=False):
+        """停止调度，不再领取新的任务"""
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+        logger.info("分析任务调度器已停止")
+
+    def wake(self):
+        """立即触发一次调度（提交任务后调用）"""
+        self._wake_event.set()
+
+    def free_slots(self):
+        with self._lock:
+            return self.max_slots - len(self._jobs)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._schedule_once()
+            except Exception as e:
+                logger.error(f"调度分析任务时发生错误: {str(e)}", exc_info=True)
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+
+    def _reap_finished_jobs(self):
+        with self._lock:
+            for future in [future for future in self._jobs if future.done()]:
+                del self._jobs[future]
+
+    def _schedule_once(self):
+        self._reap_finished_jobs()
+        if self.free_slots() <= 0:
+            return
+        db = MySQLDatabase()
+        db.connect()
+        try:
+            db.fail_exhausted_analysis_jobs()
+            while self.free_slots() > 0 and not self._stop_event.is_set():
+                lease_owner = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"
+                job = db.claim_analysis_job(lease_owner)
+                if not job:
+                    break
+                future = self._executor.submit(execute_analysis_job, job, lease_owner)
+                with self._lock:
+                    self._jobs[future] = job['id']
+                future.add_done_callback(lambda _: self._wake_event.set())
+        finally:
+            db.disconnect()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_analysis_scheduler():
+    """返回进程内共享的调度器并确保已启动（ANALYSIS_EMBEDDED_WORKERS=0 时返回None，由独立的 worker 进程执行任务）"""
+    global _scheduler
+    if not ANALYSIS_EMBEDDED_WORKERS:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = AnalysisJobScheduler(f"{socket.gethostname()}:{os.getpid()}")
+        _scheduler.start()
+        return _scheduler
+
+
+if __name__ == "__main__":
+    # python -m common.analysis_jobs --slots 4  在独立进程中执行分析任务（可与 Streamlit 内嵌的调度器同时运行）
+    parser = argparse.ArgumentParser(description="后台分析任务 worker")
+    parser.add_argument('--slots', type=int, default=ANALYSIS_WORKER_SLOTS, help="同时执行的任务数")
+    args = parser.parse_args()
+
+    scheduler = AnalysisJobScheduler(f"{socket.gethostname()}:{os.getpid()}", max_slots=args.slots)
+    scheduler.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : comment_filter.py
+@Software: PyCharm
+@Description: TikTok/X 共用的评论过滤流水线，按块处理、向量化字符串操作，内存占用与总评论数无关
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from common.log_config import setup_logger
+from common.spam_detector import NearDuplicateIndex, DEFAULT_MAX_DISTANCE, simhash, spam_reason
+
+# 配置日志
+logger = setup_logger(__name__)
+
+# 默认的垃圾评论规则（逐条正则，命中任意一条即过滤）
+DEFAULT_SPAM_PATTERNS = [
+    r'https?://\S+|www\.\S+',  # 链接
+    r'(.)\1{7,}',              # 同一字符连续重复8次以上
+    r'^\s*(@\S+\s*)+$',        # 只有@提及
+    r'\b(follow|sub)\s*(4|for)\s*(follow|sub)\b',  # 互粉引流
+]
+
+# 按文字体系粗略判断语言
+LANGUAGE_PATTERNS = {
+    'zh': r'[\u4e00-\u9fff]',
+    'ja': r'[\u3040-\u30ff]',
+    'ko': r'[\uac00-\ud7af]',
+    'ru': r'[\u0400-\u04ff]',
+    'ar': r'[\u0600-\u06ff]',
+    'th': r'[\u0e00-\u0e7f]',
+    'en': r'[A-Za-z]{2,}',
+}
+
+
+class CommentFilterRules:
+    """
+    评论过滤规则
+
+    Args:
+        min_length: 预处理后评论的最小长度（含）
+        max_length: 最大长度，None表示不限制
+        languages: 保留的语言代码列表（见 LANGUAGE_PATTERNS），None表示不限制
+        spam_patterns: 垃圾评论正则列表，None表示不过滤
+        dedupe: 去掉同一用户的重复评论
+        dedupe_across_users: 去掉不同用户之间内容完全相同的评论（复制粘贴的刷屏）
+        merge_by_user: 相同用户的评论合并成一条
+        near_duplicates: 近重复（SimHash）的评论只保留第一条，其余计入代表评论的 duplicate_count
+        near_duplicate_distance: 视为近重复的最大汉明距离
+        spam_heuristics: 按字符熵、重复词、链接密度等规则给垃圾评论打上 spam_reason（保留但不送去分析）
+    """
+
+    def __init__(self, min_length=5, max_length=None, languages=None, spam_patterns=None,
+                 dedupe=True, dedupe_across_users=False, merge_by_user=True, near_duplicates=True,
+                 near_duplicate_distance=DEFAULT_MAX_DISTANCE, spam_heuristics=True):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.languages = list(languages) if languages else None
+        self.spam_patterns = list(spam_patterns) if spam_patterns else None
+        self.dedupe = dedupe
+        self.dedupe_across_users = dedupe_across_users
+        self.merge_by_user = merge_by_user
+        self.near_duplicates = near_duplicates
+        self.near_duplicate_distance = near_duplicate_distance
+        self.spam_heuristics = spam_heuristics
+
+    def cache_key(self):
+        """用于缓存过滤结果的键"""
+        return (self.min_length, self.max_length, tuple(self.languages or ()), tuple(self.spam_patterns or ()),
+                self.dedupe, self.dedupe_across_users, self.merge_by_user, self.near_duplicates,
+                self.near_duplicate_distance, self.spam_heuristics)
+
+    def fingerprint(self):
+        """规则的哈希值，记录在过滤水位中，用于判断增量过滤时规则是否变化"""
+        return hashlib.sha256(repr(self.cache_key()).encode('utf-8')).hexdigest()
+
+    def describe(self):
+        """规则说明（用于页面展示）"""
+        lines = ["删除评论中的逗号、单引号和双引号", f"过滤长度小于 {self.min_length} 的评论"]
+        if self.max_length:
+            lines.append(f"过滤长度大于 {self.max_length} 的评论")
+        if self.languages:
+            lines.append(f"只保留语言: {', '.join(self.languages)}")
+        if self.spam_patterns:
+            lines.append(f"过滤命中 {len(self.spam_patterns)} 条垃圾评论规则的评论")
+        if self.dedupe:
+            lines.append("去掉同一用户的重复评论")
+        if self.dedupe_across_users:
+            lines.append("去掉不同用户之间内容相同的评论")
+        if self.merge_by_user:
+            lines.append("相同用户ID的评论合并成一条")
+        if self.near_duplicates:
+            lines.append(f"近重复评论（SimHash汉明距离不超过 {self.near_duplicate_distance}）只保留一条")
+        if self.spam_heuristics:
+            lines.append("按字符熵、重复词、链接密度和表情占比标记垃圾评论，标记后不参与分析")
+        return lines
+
+
+def preprocess_comments(contents):
+    """向量化的评论预处理：删除逗号、单引号和双引号"""
+    return contents.fillna('').astype(str).str.replace(r"[,'\"]", '', regex=True)
+
+
+def to_records(df):
+    """DataFrame 转为字典列表，缺失值转为None以便写入数据库"""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+class CommentFilterPipeline:
+    """
+    按块执行的评论过滤流水线
+
+    输入为数据库流式查询产出的评论块（字典列表）。合并用户评论时要求输入按 user_id 排序，
+    每块末尾的用户可能延续到下一块，会暂存到下一块一起合并，因此同一时间只在内存中保留一块数据。
+
+    近重复检测在最终产出的行上进行，被去掉的行数按代表行的 user_id 累计在 duplicate_counts 中，
+    代表行可能已在之前的块中产出，因此由调用方在保存结束后统一写回。
+    增量过滤时先用 seed_near_duplicates 载入已保存的过滤结果，新评论与之前保存的行近重复时同样会被去掉。
+
+    Args:
+        rules: CommentFilterRules
+        aggregations: 合并用户评论时除 user_id、reply_content 外各列的聚合方式
+    """
+
+    def __init__(self, rules, aggregations):
+        self.rules = rules
+        self.aggregations = aggregations
+        self.stats = {'raw': 0, 'length': 0, 'language': 0, 'spam': 0, 'duplicate': 0, 'near_duplicate': 0,
+                      'spam_tagged': 0, 'output': 0}
+        self.duplicate_counts = {}
+        self._seen_content_hashes = np.array([], dtype=np.uint64)
+        self._near_duplicate_index = NearDuplicateIndex(rules.near_duplicate_distance) if rules.near_duplicates else None
+
+    def seed_near_duplicates(self, chunks):
+        """
+        把已保存的过滤结果（含 user_id、reply_content 的字典列表块）加入近重复索引，不计入统计
+
+        Returns:
+            int: 加入索引的行数
+        """
+        if self._near_duplicate_index is None:
+            return 0
+        seeded = 0
+        for rows in chunks:
+            for row in rows:
+                fingerprint = simhash(row['reply_content'])
+                if fingerprint is not None:
+                    self._near_duplicate_index.add(fingerprint, row['user_id'])
+                    seeded += 1
+        return seeded
+
+    def run(self, chunks):
+        """
+        处理评论块，逐块产出过滤（并合并）后的 DataFrame
+
+        Yields:
+            DataFrame: 已确定不会再变化的结果行
+        """
+        carry = None
+        for comments in chunks:
+            if not comments:
+                continue
+            chunk_df = pd.DataFrame(comments)
+            self.stats['raw'] += len(chunk_df)
+            filtered = self._filter(chunk_df)
+
+            if not self.rules.merge_by_user:
+                yield from self._emit(filtered)
+                continue
+
+            if carry is not None:
+                filtered = pd.concat([carry, filtered], ignore_index=True)
+            # 块末尾的用户可能延续到下一块（按数据库排序规则比较，忽略大小写）
+            last_user = str(chunk_df['user_id'].iloc[-1]).casefold()
+            tail_mask = filtered['user_id'].astype(str).str.casefold() == last_user
+            carry = filtered[tail_mask]
+            yield from self._emit(self._merge(filtered[~tail_mask]))
+
+        if self.rules.merge_by_user and carry is not None:
+            yield from self._emit(self._merge(carry))
+
+    def _emit(self, df):
+        df = self._tag(df)
+        if len(df):
+            self.stats['output'] += len(df)
+            yield df
+
+    def _filter(self, df):
+        rules = self.rules
+        df['reply_content'] = preprocess_comments(df['reply_content'])
+
+        lengths = df['reply_content'].str.len()
+        mask = lengths >= rules.min_length
+        if rules.max_length:
+            mask &= lengths <= rules.max_length
+        self.stats['length'] += int((~mask).sum())
+        df = df[mask]
+
+        if rules.languages and len(df):
+            mask = pd.Series(False, index=df.index)
+            for language in rules.languages:
+                mask |= df['reply_content'].str.contains(LANGUAGE_PATTERNS[language], regex=True)
+            self.stats['language'] += int((~mask).sum())
+            df = df[mask]
+
+        if rules.spam_patterns and len(df):
+            mask = pd.Series(False, index=df.index)
+            for pattern in rules.spam_patterns:
+                mask |= df['reply_content'].str.contains(pattern, case=False, regex=True)
+            self.stats['spam'] += int(mask.sum())
+            df = df[~mask]
+
+        before = len(df)
+        if rules.dedupe:
+            df = df.drop_duplicates(subset=['user_id', 'reply_content'])
+        if rules.dedupe_across_users and len(df):
+            hashes = pd.util.hash_pandas_object(df['reply_content'].str.casefold(), index=False).to_numpy()
+            keep = ~np.isin(hashes, self._seen_content_hashes) & ~pd.Series(hashes).duplicated().to_numpy()
+            df = df[keep]
+            self._seen_content_hashes = np.union1d(self._seen_content_hashes, hashes[keep])
+        self.stats['duplicate'] += before - len(df)
+        return df
+
+    def _tag(self, df):
+        """去掉近重复行并标记垃圾评论"""
+        if df.empty:
+            return df
+        if self._near_duplicate_index is not None:
+            keep = []
+            for user_id, content in zip(df['user_id'], df['reply_content']):
+                fingerprint = simhash(content)
+                representative = None
+                if fingerprint is not None:
+                    representative = self._near_duplicate_index.add(fingerprint, user_id)
+                if representative is None:
+                    keep.append(True)
+                else:
+                    keep.append(False)
+                    self.duplicate_counts[representative] = self.duplicate_counts.get(representative, 0) + 1
+            keep = np.array(keep, dtype=bool)
+            self.stats['near_duplicate'] += int((~keep).sum())
+            df = df[keep]
+        if self.rules.spam_heuristics and len(df):
+            reasons = df['reply_content'].map(spam_reason)
+            self.stats['spam_tagged'] += int(reasons.notna().sum())
+            df = df.assign(spam_reason=reasons)
+        return df
+
+    def _merge(self, df):
+        if df.empty:
+            return df
+        aggregations = {column: how for column, how in self.aggregations.items() if column in df.columns}
+        aggregations['reply_content'] = ' '.join
+        merged = df.groupby('user_id', sort=False).agg(aggregations).reset_index()
+        if 'likes_count' in merged.columns:
+            merged['likes_count'] = merged['likes_count'].fillna(0).astype(int)
+        return merged
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : fake_batch_server.py
+@Software: PyCharm
+@Description: 本地模拟的 Batch API 服务（只依赖标准库），用于在不产生费用的情况下联调批量分析流程
+
+用法:
+    python -m common.fake_batch_server --port 8765 --delay 30
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=test streamlit run 主页.py
+
+支持文件上传/下载、创建/查询/取消批量任务。任务在创建 delay 秒后完成，每个请求按prompt中的评论行
+（见 common.openai.format_comment_row）和 response_format 中的字段生成确定性的结构化结果，
+--drop-every N 时每个请求省略第N、2N...行，--fail-every N 时每第N个请求返回错误，用于检查缺失行和失败请求的处理。
+"""
+import re
+import json
+import time
+import uuid
+import zlib
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMMENT_ROW_PATTERN = re.compile(r'^(\d+)\. 用户ID: (.*?), 评论内容: ', re.MULTILINE)
+
+
+class FakeBatchStore:
+    """内存中的文件和批量任务"""
+
+    def __init__(self, delay=5, drop_every=0, fail_every=0):
+        self.delay = delay
+        self.drop_every = drop_every
+        self.fail_every = fail_every
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with self.lock:
+            self.files[file_id] = {
+                'meta': {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                         'filename': filename, 'purpose': purpose, 'status': 'processed'},
+                'content': content,
+            }
+        return self.files[file_id]['meta']
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        lines = self.files[input_file_id]['content'].decode('utf-8').splitlines()
+        batch = {
+            'id': batch_id, 'object': 'batch', 'endpoint': endpoint, 'input_file_id': input_file_id,
+            'completion_window': completion_window, 'status': 'validating', 'created_at': int(time.time()),
+            'output_file_id': None, 'error_file_id': None, 'errors': None, 'metadata': metadata,
+            'request_counts': {'total': len([line for line in lines if line.strip()]), 'completed': 0, 'failed': 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        return batch
+
+    def get_batch(self, batch_id) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            elapsed = time.time() - batch['created_at']
+            if batch['status'] == 'validating' and elapsed >= 1:
+                batch['status'] = 'in_progress'
+            if batch['status'] in ('in_progress', 'cancelling') and elapsed >= self.delay:
+                self._complete(batch, 'cancelled' if batch['status'] == 'cancelling' else 'completed')
+            return batch
+
+    def cancel_batch(self, batch_id) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch['status'] in ('validating', 'in_progress'):
+                batch['status'] = 'cancelling'
+            return batch
+
+    def _complete(self, batch, status):
+        outputs, errors = [], []
+        lines = self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+        for number, line in enumerate([line for line in lines if line.strip()], 1):
+            request = json.loads(line)
+            if self.fail_every and number % self.fail_every == 0:
+                errors.append({'id': f"batch_req_{number}", 'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'server_error', 'message': "模拟的请求失败"}})
+                continue
+            content = json.dumps(self._fake_rows(request['body']), ensure_ascii=False)
+            outputs.append({
+                'id': f"batch_req_{number}", 'custom_id': request['custom_id'], 'error': None,
+                'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': {
+                    'id': f"chatcmpl-{uuid.uuid4().hex[:24]}", 'object': 'chat.completion',
+                    'model': request['body'].get('model'),
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                }},
+            })
+        batch['request_counts'].update(completed=len(outputs), failed=len(errors))
+        for key, items in (('output_file_id', outputs), ('error_file_id', errors)):
+            if items:
+                content = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items).encode('utf-8')
+                file_id = f"file-{uuid.uuid4().hex[:24]}"
+                self.files[file_id] = {'meta': {'id': file_id, 'object': 'file', 'bytes': len(content),
+                                                'created_at': int(time.time()), 'filename': f"{key}.jsonl",
+                                                'purpose': 'batch_output', 'status': 'processed'},
+                                       'content': content}
+                batch[key] = file_id
+        batch['status'] = status
+
+    def _fake_rows(self, body) -> dict:
+        """按prompt中的评论行和 response_format 的字段生成结果，枚举字段按评论内容的哈希确定性取值"""
+        prompt = body['messages'][0]['content']
+        schema = body['response_format']['json_schema']['schema']['properties']['rows']['items']['properties']
+        rows = []
+        for match in COMMENT_ROW_PATTERN.finditer(prompt):
+            index = int(match.group(1))
+            if self.drop_every and index % self.drop_every == 0:
+                continue
+            row = {'序号': index, '用户ID': match.group(2)}
+            line_end = prompt.find('\n', match.end())
+            seed = zlib.crc32(prompt[match.end():line_end if line_end != -1 else None].encode('utf-8'))
+            for name, spec in schema.items():
+                if name in row:
+                    continue
+                row[name] = spec['enum'][seed % len(spec['enum'])] if 'enum' in spec else "模拟结果"
+            rows.append(row)
+        return {'rows': rows}
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send_json({'error': {'message': f"未知的路径 {self.path}", 'type': 'invalid_request_error'}}, 404)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if match := re.fullmatch(r'/v1/batches/([\w-]+)', path):
+            if match.group(1) in self.store.batches:
+                return self._send_json(self.store.get_batch(match.group(1)))
+        elif match := re.fullmatch(r'/v1/files/([\w-]+)/content', path):
+            if match.group(1) in self.store.files:
+                content = self.store.files[match.group(1)]['content']
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+        elif match := re.fullmatch(r'/v1/files/([\w-]+)', path):
+            if match.group(1) in self.store.files:
+                return self._send_json(self.store.files[match.group(1)]['meta'])
+        self._not_found()
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        body = self._read_body()
+        if path == '/v1/files':
+            # multipart/form-data：字段 purpose 和文件 file
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+            parts = {part.get_param('name', header='content-disposition'): part for part in message.iter_parts()}
+            file_part = parts.get('file')
+            if file_part is None:
+                return self._send_json({'error': {'message': "缺少文件", 'type': 'invalid_request_error'}}, 400)
+            purpose = parts['purpose'].get_content().strip() if 'purpose' in parts else 'batch'
+            return self._send_json(self.store.add_file(file_part.get_payload(decode=True),
+                                                       file_part.get_filename() or 'upload.jsonl', purpose))
+        if path == '/v1/batches':
+            params = json.loads(body or b'{}')
+            if params.get('input_file_id') not in self.store.files:
+                return self._send_json({'error': {'message': "输入文件不存在", 'type': 'invalid_request_error'}}, 400)
+            return self._send_json(self.store.create_batch(params['input_file_id'], params.get('endpoint'),
+                                                           params.get('completion_window'), params.get('metadata')))
+        if match := re.fullmatch(r'/v1/batches/([\w-]+)/cancel', path):
+            if match.group(1) in self.store.batches:
+                return self._send_json(self.store.cancel_batch(match.group(1)))
+        self._not_found()
+
+
+def run_server(host='127.0.0.1', port=8765, delay=5, drop_every=0, fail_every=0):
+    """启动模拟服务（阻塞），返回前不会退出"""
+    FakeBatchHandler.store = FakeBatchStore(delay=delay, drop_every=drop_every, fail_every=fail_every)
+    server = ThreadingHTTPServer((host, port), FakeBatchHandler)
+    print(f"模拟 Batch API 服务已启动: http://{host}:{port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的 Batch API 服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=int, default=5, help="任务创建后多少秒完成")
+    parser.add_argument('--drop-every', type=int, default=0, help="每个请求省略第N、2N...行")
+    parser.add_argument('--fail-every', type=int, default=0, help="每第N个请求返回错误")
+    args = parser.parse_args()
+    run_server(args.host, args.port, args.delay, args.drop_every, args.fail_every)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : gpt_batch.py
+@Software: PyCharm
+@Description: 离线批量分析：把分类请求写成JSONL提交为 Batch API 任务，轮询完成后把结果导入分析结果表，
+              不需要页面一直开着，费用按批量价格计算
+"""
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+
+from common.log_config import setup_logger
+from common.openai import (get_openai_client, pack_comment_batches, build_rows_response_format,
+                           reconcile_structured_rows, get_prompt_template_hash)
+from common.analysis_jobs import build_result_row, save_result_rows
+
+# 配置日志
+logger = setup_logger(__name__)
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_COMPLETION_WINDOW = '24h'
+BATCH_MAX_REQUESTS = int(os.environ.get('GPT_BATCH_MAX_REQUESTS', 50000))  # 单个批量任务最多请求数
+BATCH_MAX_FILE_BYTES = int(os.environ.get('GPT_BATCH_MAX_FILE_BYTES', 190 * 1024 * 1024))  # 单个JSONL文件最大字节数
+BATCH_DIR = os.environ.get('GPT_BATCH_DIR', os.path.join('data', 'gpt_batches'))  # 本地保留的JSONL文件目录
+BATCH_POLL_INTERVAL = int(os.environ.get('GPT_BATCH_POLL_INTERVAL', 60))
+BATCH_SAVE_ROWS = 1000  # 导入结果时每累计多少行写一次数据库
+BATCH_PREPARING_TIMEOUT = int(os.environ.get('GPT_BATCH_PREPARING_TIMEOUT', 3600))  # preparing 状态超过该时长视为提交失败
+
+# 服务端仍在处理中的状态（见 Batch API 文档），preparing 为本地已建记录但尚未提交（超过 BATCH_PREPARING_TIMEOUT 后标记为failed）
+ACTIVE_STATUSES = ['preparing', 'validating', 'in_progress', 'finalizing', 'cancelling']
+# 服务端已结束、可以导入结果的状态（过期和取消的任务也会返回已完成部分的结果）
+FINISHED_STATUSES = ['completed', 'expired', 'cancelled']
+INGESTED_STATUS = 'ingested'
+
+
+def build_batch_line(custom_id: str, model: str, prompt: str, max_tokens: int, response_format: dict,
+                     temperature: float = 0.7, top_p: float = 0.95) -> dict:
+    """一个批量请求（JSONL中的一行），请求体与交互式分析的结构化请求一致"""
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {
+            'model': model,
+            'messages': [{'role': 'system', 'content': prompt}],
+            'temperature': temperature,
+            'top_p': top_p,
+            'max_tokens': max_tokens,
+            'response_format': response_format,
+        },
+    }
+
+
+def split_batch_lines(lines: list) -> list:
+    """按请求数和文件大小上限把请求行分成多个任务，返回 [[(行, 序列化后的文本)]]"""
+    groups, current, current_bytes = [], [], 0
+    for line in lines:
+        text = json.dumps(line, ensure_ascii=False)
+        size = len(text.encode('utf-8')) + 1
+        if current and (len(current) >= BATCH_MAX_REQUESTS or current_bytes + size > BATCH_MAX_FILE_BYTES):
+            groups.append(current)
+            current, current_bytes = [], 0
+        current.append((line, text))
+        current_bytes += size
+    if current:
+        groups.append(current)
+    return groups
+
+
+def submit_batch_jobs(db, platform: str, keyword: str, analysis_round: int, model: str, prompt_template: str,
+                      comments: list, fields: dict, max_rows: int = None) -> list:
+    """
+    把评论打包成批量请求并提交。
+
+    打包方式与交互式分析相同（按token预算，结构化输出），请求数或文件大小超过上限时拆成多个任务。
+    每个请求对应的评论记录在 gpt_batch_requests 表中，导入结果时不依赖提交时的进程。
+
+    :param analysis_round: 1 为第一轮（潜在客户），2 为第二轮（意向等级）。
+    :param fields: 结构化输出的字段，见 build_rows_response_format。
+    :return: 创建的任务ID列表。
+    """
+    client = get_openai_client()
+    if not client:
+        raise RuntimeError("无法创建 OpenAI 客户端，请检查 API 密钥设置")
+
+    template_hash = get_prompt_template_hash(prompt_template)
+    response_format = build_rows_response_format(fields)
+    packed_batches = pack_comment_batches(comments, prompt_template, model, max_rows=max_rows, echo_text=False)
+    lines = [build_batch_line(f"req-{index}", model, batch.prompt, batch.max_tokens, response_format)
+             for index, batch in enumerate(packed_batches)]
+    comments_by_id = {
+        line['custom_id']: [{'user_id': comment['user_id'], 'reply_content': comment['reply_content']}
+                            for comment in batch.comments]
+        for line, batch in zip(lines, packed_batches)
+    }
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    job_ids = []
+    for group in split_batch_lines(lines):
+        job_id = db.create_gpt_batch_job(platform, keyword, analysis_round, model, template_hash, fields)
+        if not job_id:
+            raise RuntimeError("创建批量任务记录失败")
+        try:
+            path = os.path.join(BATCH_DIR, f"{platform}_{job_id}.jsonl")
+            with open(path, 'w', encoding='utf-8') as f:
+                for _, text in group:
+                    f.write(text + '\n')
+            custom_ids = [line['custom_id'] for line, _ in group]
+            db.add_gpt_batch_requests(job_id, [(custom_id, comments_by_id[custom_id]) for custom_id in custom_ids])
+            db.update_gpt_batch_job(job_id, request_count=len(group),
+                                    comment_count=sum(len(comments_by_id[custom_id]) for custom_id in custom_ids))
+
+            with open(path, 'rb') as f:
+                input_file = client.files.create(file=f, purpose='batch')
+            batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=BATCH_COMPLETION_WINDOW,
+                                          metadata={'platform': platform, 'keyword': keyword[:200],
+                                                    'job_id': str(job_id)})
+            db.update_gpt_batch_job(job_id, status=batch.status, provider_batch_id=batch.id,
+                                    input_file_id=input_file.id)
+            logger.info(f"已提交批量任务 {job_id}（{batch.id}），共 {len(group)} 个请求")
+            job_ids.append(job_id)
+        except Exception as e:
+            logger.error(f"提交批量任务 {job_id} 失败: {e}")
+            db.update_gpt_batch_job(job_id, status='failed', error_message=str(e), finished_at=datetime.now())
+            raise
+    return job_ids
+
+
+def parse_batch_output(text: str) -> dict:
+    """
+    解析批量任务的输出/错误文件。
+
+    :return: {custom_id: (响应内容, 错误信息)}，成功时错误信息为None。
+    """
+    results = {}
+    for line in (text or '').splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response') or {}
+        if item.get('error') or response.get('status_code') != 200:
+            results[item['custom_id']] = (None, str(item.get('error') or response.get('body')))
+            continue
+        try:
+            results[item['custom_id']] = (response['body']['choices'][0]['message']['content'], None)
+        except (KeyError, IndexError, TypeError):
+            results[item['custom_id']] = (None, f"无法解析的响应: {response.get('body')}")
+    return results
+
+
+def ingest_batch_job(db, job: dict, client=None) -> dict:
+    """
+    下载已结束任务的结果，核对后写入分析结果表和GPT结果缓存。
+
+    保存使用按 (keyword, user_id) 的更新写入，导入中断后重新导入不会产生重复数据。
+    没有结果的评论只计数，不写入，下次提交批量任务或交互式分析时会重新处理。
+
+    :return: {'saved': 保存行数, 'missing': 没有有效结果的评论数}。
+    """
+    client = client or get_openai_client()
+    requests = db.get_gpt_batch_requests(job['id'])
+    outputs = {}
+    for file_id in (job.get('output_file_id'), job.get('error_file_id')):
+        if file_id:
+            outputs.update(parse_batch_output(client.files.content(file_id).text))
+
+    fields = job['output_fields']
+    saved, missing, pending = 0, 0, []
+
+    def flush():
+        save_result_rows(db, job['platform'], job['analysis_round'], job['keyword'], pending, job['model'],
+                         job['template_hash'])
+        pending.clear()
+
+    for custom_id, comments in requests.items():
+        content, error = outputs.get(custom_id, (None, "没有返回结果"))
+        if error:
+            logger.warning(f"批量任务 {job['id']} 的请求 {custom_id} 失败: {error}")
+            missing += len(comments)
+            continue
+        valid, invalid = reconcile_structured_rows(content, comments, fields)
+        missing += len(invalid)
+        pending.extend(build_result_row(job['analysis_round'], comment, result) for comment, result in valid)
+        saved += len(valid)
+        if len(pending) >= BATCH_SAVE_ROWS:
+            flush()
+    flush()
+
+    db.update_gpt_batch_job(job['id'], status=INGESTED_STATUS, saved_count=saved, missing_count=missing,
+                            finished_at=datetime.now())
+    logger.info(f"批量任务 {job['id']} 导入完成：保存 {saved} 条，{missing} 条没有有效结果")
+    return {'saved': saved, 'missing': missing}
+
+
+def refresh_batch_job(db, job: dict, client=None) -> dict:
+    """查询任务在服务端的状态并更新记录，已结束的任务导入结果，返回更新后的任务"""
+    client = client or get_openai_client()
+    if not job.get('provider_batch_id'):
+        return job
+    batch = client.batches.retrieve(job['provider_batch_id'])
+    counts = batch.request_counts
+    updates = {
+        'status': batch.status,
+        'output_file_id': batch.output_file_id,
+        'error_file_id': batch.error_file_id,
+        'completed_requests': counts.completed if counts else 0,
+        'failed_requests': counts.failed if counts else 0,
+    }
+    if batch.status == 'failed':
+        errors = getattr(batch, 'errors', None)
+        updates['error_message'] = str(errors.data if errors and errors.data else errors)
+        updates['finished_at'] = datetime.now()
+    db.update_gpt_batch_job(job['id'], **updates)
+    job = {**job, **updates}
+
+    if batch.status in FINISHED_STATUSES:
+        job.update(ingest_batch_job(db, job, client))
+        job['status'] = INGESTED_STATUS
+    return job
+
+
+def cancel_batch_job(db, job: dict):
+    """取消服务端的任务，已完成部分的结果在任务变为 cancelled 后照常导入"""
+    client = get_openai_client()
+    if job.get('provider_batch_id'):
+        batch = client.batches.cancel(job['provider_batch_id'])
+        db.update_gpt_batch_job(job['id'], status=batch.status)
+    else:
+        db.update_gpt_batch_job(job['id'], status='cancelled', finished_at=datetime.now())
+
+
+def poll_batch_jobs(db, platform: str = None, keyword: str = None) -> list:
+    """刷新所有未结束的任务（已结束的导入结果），返回刷新后的任务列表；提交中途退出、长时间停留在 preparing 的任务标记为failed"""
+    db.expire_stale_gpt_batch_jobs(BATCH_PREPARING_TIMEOUT)
+    jobs = db.get_gpt_batch_jobs(platform=platform, keyword=keyword, statuses=ACTIVE_STATUSES + FINISHED_STATUSES)
+    refreshed = []
+    for job in jobs:
+        try:
+            refreshed.append(refresh_batch_job(db, job))
+        except Exception as e:
+            logger.error(f"刷新批量任务 {job['id']} 失败: {e}")
+            refreshed.append(job)
+    return refreshed
+
+
+if __name__ == "__main__":
+    # python -m common.gpt_batch          刷新一次所有未结束的批量任务并导入已完成的结果（可配置为定时任务）
+    # python -m common.gpt_batch --watch  持续轮询，直到没有未结束的任务
+    from collectors.common.mysql import MySQLDatabase
+
+    parser = argparse.ArgumentParser(description="轮询GPT批量任务并导入结果")
+    parser.add_argument('--watch', action='store_true', help="持续轮询直到所有任务结束")
+    parser.add_argument('--interval', type=int, default=BATCH_POLL_INTERVAL, help="轮询间隔（秒）")
+    parser.add_argument('--platform', choices=['tiktok', 'x'], default=None)
+    args = parser.parse_args()
+
+    db = MySQLDatabase()
+    db.connect()
+    try:
+        while True:
+            jobs = poll_batch_jobs(db, platform=args.platform)
+            active = [job for job in jobs if job['status'] in ACTIVE_STATUSES]
+            for job in jobs:
+                print(f"任务 {job['id']} [{job['platform']}/{job['keyword']}/第{job['analysis_round']}轮] "
+                      f"{job['status']}，请求 {job.get('completed_requests', 0)}/{job.get('request_count', 0)}")
+            if not args.watch or not active:
+                break
+            time.sleep(args.interval)
+    finally:
+        db.disconnect()
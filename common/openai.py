@@ -7,20 +7,88 @@
 @Software: PyCharm
 """
 import traceback
-import csv
 import os
 import json
-import pandas as pd
-from openai import OpenAI
-from io import StringIO
-import streamlit as st
+import queue
+import math
+import hashlib
+import unicodedata
+import random
+import asyncio
+import threading
+from collections import namedtuple
+import httpx
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+
+try:
+    import tiktoken
+except ImportError:  # 未安装 tiktoken 时按字符数估算token数
+    tiktoken = None
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 from common.log_config import setup_logger
 
 # 配置日志
 logger = setup_logger(__name__)
 
-def get_openai_api_key():
+# 并发调度配置
+GPT_MAX_CONCURRENCY = int(os.environ.get('GPT_MAX_CONCURRENCY', 8))  # 同时在途的最大请求数
+GPT_MAX_RETRIES = int(os.environ.get('GPT_MAX_RETRIES', 5))  # 单个批次的最大重试次数
+GPT_RETRY_BASE_DELAY = float(os.environ.get('GPT_RETRY_BASE_DELAY', 1.0))  # 重试退避的初始等待（秒）
+GPT_RETRY_MAX_DELAY = float(os.environ.get('GPT_RETRY_MAX_DELAY', 60.0))  # 重试退避的最长等待（秒）
+
+# HTTP 连接配置（进程内共享的客户端）
+GPT_HTTP_TIMEOUT = float(os.environ.get('GPT_HTTP_TIMEOUT', 120.0))  # 单个请求的读写超时（秒）
+GPT_CONNECT_TIMEOUT = float(os.environ.get('GPT_CONNECT_TIMEOUT', 10.0))  # 建立连接的超时（秒）
+GPT_MAX_CONNECTIONS = int(os.environ.get('GPT_MAX_CONNECTIONS', 32))  # 连接池最大连接数
+GPT_KEEPALIVE_EXPIRY = float(os.environ.get('GPT_KEEPALIVE_EXPIRY', 60.0))  # 空闲连接保持时间（秒）
+GPT_HTTP2 = os.environ.get('GPT_HTTP2', '1') == '1'  # 是否启用HTTP/2（需要安装 h2）
+
+# 批次打包配置
+GPT_INPUT_TOKEN_BUDGET = int(os.environ.get('GPT_INPUT_TOKEN_BUDGET', 6000))  # 每个批次prompt的目标输入token数
+GPT_MAX_OUTPUT_TOKENS = int(os.environ.get('GPT_MAX_OUTPUT_TOKENS', 8000))  # 单个请求允许预留的最大输出token数
+GPT_OUTPUT_TOKENS_PER_ROW = 40  # 每行输出除评论原文外的token数（用户ID、分类结果、分析理由、引号和分隔符）
+GPT_OUTPUT_TOKENS_OVERHEAD = 100  # 每个请求输出的固定开销（标题行、代码块标记）
+
+# 流式输出配置
+GPT_STREAM_RESPONSES = os.environ.get('GPT_STREAM_RESPONSES', '1') == '1'  # 结构化分析是否边生成边解析
+GPT_STREAM_FLUSH_ROWS = int(os.environ.get('GPT_STREAM_FLUSH_ROWS', 10))  # 流式解析出多少行后交给调用方保存一次
+
+# 打包后的一个批次：批次中的评论、完整prompt、该请求的 max_tokens
+PackedBatch = namedtuple('PackedBatch', ['comments', 'prompt', 'max_tokens'])
+
+# 结构化输出的一个批次结果：rows 为本次新得到的 [(评论, 结果字典)]，missing 为补请求后仍没有有效结果的评论，
+# retried 表示是否发送过补请求，final 为False时是流式输出中途的部分结果（同一批次之后还会产出）
+StructuredBatchResult = namedtuple('StructuredBatchResult', ['batch_index', 'rows', 'missing', 'error', 'retried',
+                                                             'final'], defaults=(True,))
+
+_token_encodings = {}
+
+# 进程内共享的 API 密钥、客户端和异步请求使用的事件循环
+_client_lock = threading.Lock()
+_api_key = None
+_sync_client = None
+_async_client = None
+_dispatch_loop = None
+
+def get_openai_api_key(refresh: bool = False):
+    """
+    获取 OPENAI_API_KEY（进程内只解析一次，refresh 为True时重新读取）
+    """
+    global _api_key
+    if _api_key and not refresh:
+        return _api_key
+    with _client_lock:
+        if not _api_key or refresh:
+            _api_key = _load_openai_api_key()
+        return _api_key
+
+def _load_openai_api_key():
     """
     从环境变量或本地文件缓存中获取 OPENAI_API_KEY
     """
@@ -41,211 +109,70 @@ def get_openai_api_key():
     logger.error("未找到 OPENAI_API_KEY，请设置环境变量或在本地文件中配置")
     return None
 
+def _http_client_options():
+    """共享客户端的 httpx 连接池、超时和HTTP/2配置"""
+    return {
+        'timeout': httpx.Timeout(GPT_HTTP_TIMEOUT, connect=GPT_CONNECT_TIMEOUT),
+        'limits': httpx.Limits(max_connections=GPT_MAX_CONNECTIONS, max_keepalive_connections=GPT_MAX_CONNECTIONS,
+                               keepalive_expiry=GPT_KEEPALIVE_EXPIRY),
+        'http2': GPT_HTTP2 and HTTP2_AVAILABLE,
+    }
+
 def get_openai_client():
     """
-    创建并返回 OpenAI 客户端实例
+    返回进程内共享的 OpenAI 客户端（长连接，线程安全），首次调用时创建
     """
+    global _sync_client
+    if _sync_client is not None:
+        return _sync_client
     api_key = get_openai_api_key()
-    if api_key:
-        return OpenAI(api_key=api_key)
-    else:
+    if not api_key:
         logger.error("未设置 OPENAI_API_KEY，无法创建 OpenAI 客户端")
         return None
+    with _client_lock:
+        if _sync_client is None:
+            _sync_client = OpenAI(api_key=api_key, http_client=httpx.Client(**_http_client_options()))
+            logger.info(f"创建共享 OpenAI 客户端，HTTP/2: {_http_client_options()['http2']}")
+        return _sync_client
 
-def send_text_to_gpt(model: str, system_prompt: str, data: pd.DataFrame, batch_size: int = 100) -> pd.DataFrame:
+def get_async_openai_client():
     """
-    发送数据到GPT模型，获取分析结果。
-    :param model: 使用的GPT模型名称。
-    :param system_prompt: 系统级指令，用于提供分析上下文。
-    :param data: 包含需要分析的数据的DataFrame。
-    :param batch_size: 每次发送的数据行数，默认100行。
-    :return: 包含分析结果的DataFrame。
-    """
-    client = get_openai_client()
-    if not client:
-        st.error("无法创建 OpenAI 客户端，请检查 API 密钥设置")
-        return pd.DataFrame()
-
-    results = []
-    max_tokens = 2000
+    返回进程内共享的异步 OpenAI 客户端。
 
-    # 初始化Streamlit进度条和文本显示
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    # 计算总批次数量
-    total_batches = len(data) // batch_size + (1 if len(data) % batch_size != 0 else 0)
-
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        batch_csv = batch.to_csv(index=False)
-
-        batch_prompt = f"{system_prompt}\n\n" \
-               f"分析以下数据并以CSV格式提供输出，结构如下：" \
-               f"\n1. 保持原始数据的所有列不变。" \
-               f"\n2. 新增一列名为'分析说明'，" \
-               f"为每行数据提供基于数据的见解或解释。" \
-               f"每个解释应用双引号括起，并限制在20个字符以内。" \
-               f"\n3. 新增一列名为'分类标签'，包含两个固定类别或标签之一：" \
-               f'"高兴趣"或"低兴趣"，表示每行对产品XYZ的潜在兴趣水平。' \
-               f"\n\n数据：\n{batch_csv}"
-
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": batch_prompt}
-                ],
-                temperature=0.7,
-                top_p=0.95,
-                max_tokens=max_tokens
-            )
-            response_content = response.choices[0].message.content
-        except Exception as error:
-            error_message = traceback.format_exc()
-            st.error(f"批次{i // batch_size + 1}/{total_batches}失败：{error_message}")
-            logger.error(f"异常详情：{error_message}")
-            continue
-
-        # 处理响应内容
-        if "```csv" in response_content:
-            csv_content = response_content.split("```csv")[1].split("```")[0].strip()
-        else:
-            csv_content = response_content
-
-        logger.info("输出==============================================")
-        logger.info(csv_content)
-        logger.info("输出==============================================")
-
-        # 处理CSV内容
-        csv_rows = []
-        try:
-            csv_reader = csv.reader(StringIO(csv_content), delimiter=',', quotechar='"')
-            for row in csv_reader:
-                if len(row) == 4:
-                    results.append(row)
-                    csv_rows.append(row)
-                else:
-                    st.warning(f"跳过字段数量不符的行：{row}")
-        except csv.Error as e:
-            st.error(f"CSV解析错误：{e}")
-
-        # 更新进度和状态
-        progress_percentage = (i + batch_size) / len(data)
-        progress_bar.progress(min(progress_percentage, 1.0))
-        status_message = (
-            f"> 批次 {i // batch_size + 1}/{total_batches}：已发送 {len(batch)} 行，"
-            f"已接收 {len(csv_rows)} 行。"
-        )
-        status_text.markdown(status_message)
-
-    # 合并结果
-    if results:
-        result_df = pd.DataFrame(results[1:], columns=results[0])
-    else:
-        result_df = pd.DataFrame()
-
-    # 清理进度显示
-    progress_bar.empty()
-    status_text.text("处理完成！")
-
-    return result_df
-
-def generate_promotional_sms(model: str, system_prompt: str, user_data: pd.DataFrame, batch_size: int = 100) -> pd.DataFrame:
-    """
-    使用大模型根据用户和评论信息生成推广短信。
-    :param model: 使用的GPT模型名称。
-    :param system_prompt: 系统级指令，用于提供分析上下文。
-    :param user_data: 包含用户和评论信息的DataFrame。
-    :param batch_size: 每次发送的数据行数，默认100行。
-    :return: 包含推广短信的DataFrame。
+    异步客户端的连接绑定在事件循环上，只能在 get_gpt_dispatch_loop() 返回的事件循环中使用。
+    重试由 process_with_gpt_async 负责，客户端自身不再重试。
     """
-    client = get_openai_client()
-    if not client:
-        st.error("无法创建 OpenAI 客户端，请检查 API 密钥设置")
-        return pd.DataFrame()
-
-    results = []
-    max_tokens = 2000
-
-    # 初始化 Streamlit 进度条和文本显示
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    # 计算总批次数量
-    total_batches = len(user_data) // batch_size + (1 if len(user_data) % batch_size != 0 else 0)
-
-    for i in range(0, len(user_data), batch_size):
-        batch = user_data.iloc[i:i + batch_size]
-        batch_csv = batch.to_csv(index=False)
-
-        batch_prompt = f"{system_prompt}\n\n" \
-                       f"根据每个用户的信息和评论生成推广短信。" \
-                       f"输出应为CSV格式，结构如下：" \
-                       f"\n1. 保持原始数据的所有列不变。" \
-                       f"\n2. 新增一列名为'推广短信'，包含为每个用户定制的推广信息。" \
-                       f"每条信息应用双引号括起。" \
-                       f"\n\n数据：\n{batch_csv}"
-
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": batch_prompt}
-                ],
-                temperature=0.7,
-                top_p=0.95,
-                max_tokens=max_tokens
-            )
-            response_content = response.choices[0].message.content
-        except Exception as error:
-            error_message = traceback.format_exc()
-            st.error(f"批次 {i // batch_size + 1}/{total_batches} 失败：{error_message}")
-            logger.error(f"异常详情：{error_message}")
-            continue
-
-        if "```csv" in response_content:
-            csv_content = response_content.split("```csv")[1].split("```")[0].strip()
-        else:
-            csv_content = response_content
-
-        logger.info("输出==============================================")
-        logger.info(csv_content)
-        logger.info("输出==============================================")
-
-        # 处理CSV内容
-        csv_rows = []
-        try:
-            csv_reader = csv.reader(StringIO(csv_content), delimiter=',', quotechar='"')
-            for row in csv_reader:
-                if len(row) == 4:
-                    results.append(row)
-                    csv_rows.append(row)
-                else:
-                    st.warning(f"跳过字段数量不符的行：{row}")
-        except csv.Error as e:
-            st.error(f"CSV解析错误：{e}")
-
-        # 更新进度和状态
-        progress_percentage = (i + batch_size) / len(user_data)
-        progress_bar.progress(min(progress_percentage, 1.0))
-        status_message = (
-            f"> 批次 {i // batch_size + 1}/{total_batches}：已发送 {len(batch)} 行，"
-            f"已接收 {len(csv_rows)} 行。"
-        )
-        status_text.markdown(status_message)
-
-    # 合并结果
-    if results:
-        result_df = pd.DataFrame(results[1:], columns=results[0])
+    global _async_client
+    if _async_client is not None:
+        return _async_client
+    api_key = get_openai_api_key()
+    if api_key:
+        _async_client = AsyncOpenAI(api_key=api_key, max_retries=0,
+                                    http_client=httpx.AsyncClient(**_http_client_options()))
+        return _async_client
     else:
-        result_df = pd.DataFrame()
-
-    # 清理进度显示
-    progress_bar.empty()
-    status_text.text("处理完成！")
+        logger.error("未设置 OPENAI_API_KEY，无法创建异步 OpenAI 客户端")
+        return None
 
-    return result_df
+def get_gpt_dispatch_loop():
+    """返回进程内共享的事件循环（在后台线程中常驻运行），所有并发GPT请求都在其中执行"""
+    global _dispatch_loop
+    with _client_lock:
+        if _dispatch_loop is None or _dispatch_loop.is_closed():
+            _dispatch_loop = asyncio.new_event_loop()
+            threading.Thread(target=_dispatch_loop.run_forever, name='gpt-dispatcher', daemon=True).start()
+        return _dispatch_loop
+
+def reset_openai_clients():
+    """关闭共享客户端并清除缓存的密钥（更换 API 密钥后调用）"""
+    global _api_key, _sync_client, _async_client
+    with _client_lock:
+        sync_client, async_client = _sync_client, _async_client
+        _api_key = _sync_client = _async_client = None
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None and _dispatch_loop is not None and not _dispatch_loop.is_closed():
+        asyncio.run_coroutine_threadsafe(async_client.close(), _dispatch_loop)
 
 def process_with_gpt(model: str, prompt: str, max_tokens: int = 2000, temperature: float = 0.7, 
                      top_p: float = 0.95) -> str:
@@ -289,3 +216,616 @@ def process_with_gpt(model: str, prompt: str, max_tokens: int = 2000, temperatur
     logger.info("输出==============================================")
 
     return response_content
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    自适应并发限制器
+
+    遇到429限流时把允许的并发数减半，之后每连续成功"当前并发数"次请求就把并发数加1，
+    直到恢复到初始上限。
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self._success_streak = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, rate_limited=False):
+        async with self._condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self._success_streak = 0
+                if self.limit > 1:
+                    self.limit = max(1, self.limit // 2)
+                    logger.warning(f"触发GPT限流，并发数降为 {self.limit}")
+            else:
+                self._success_streak += 1
+                if self.limit < self.max_concurrency and self._success_streak >= self.limit:
+                    self._success_streak = 0
+                    self.limit += 1
+                    logger.info(f"GPT请求恢复正常，并发数升为 {self.limit}")
+            self._condition.notify_all()
+
+
+def _get_retry_delay(error, attempt):
+    """计算重试等待时间：优先使用服务端的 Retry-After，否则按指数退避加随机抖动"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get('retry-after'))
+            return min(retry_after, GPT_RETRY_MAX_DELAY)
+        except (TypeError, ValueError):
+            pass
+    delay = min(GPT_RETRY_BASE_DELAY * (2 ** attempt), GPT_RETRY_MAX_DELAY)
+    return delay * (0.5 + random.random() / 2)
+
+
+async def process_with_gpt_async(client, limiter, model: str, prompt: str, max_tokens: int = 2000,
+                                 temperature: float = 0.7, top_p: float = 0.95, response_format: dict = None,
+                                 on_delta=None) -> str:
+    """
+    异步版本的 process_with_gpt，受并发限制器约束，对限流、超时、连接错误和5xx错误做退避重试。
+
+    :param client: AsyncOpenAI 客户端。
+    :param limiter: AdaptiveConcurrencyLimiter 实例。
+    :param response_format: 结构化输出格式（见 build_rows_response_format），None表示普通文本输出。
+    :param on_delta: 传入时以流式方式请求，每收到一段内容调用 on_delta(文本)；
+                     每次（重新）开始请求时先调用 on_delta(None)，调用方据此丢弃上一次未完成的内容。
+    :return: GPT模型的完整响应内容。
+    """
+    extra_params = {'response_format': response_format} if response_format else {}
+    for attempt in range(GPT_MAX_RETRIES + 1):
+        await limiter.acquire()
+        rate_limited = False
+        try:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": prompt}
+                ],
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens,
+                stream=on_delta is not None,
+                **extra_params
+            )
+            if on_delta is not None:
+                on_delta(None)
+                parts = []
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        on_delta(chunk.choices[0].delta.content)
+                response_content = ''.join(parts)
+            else:
+                response_content = response.choices[0].message.content
+            logger.info("输出==============================================")
+            logger.info(response_content)
+            logger.info("输出==============================================")
+            return response_content
+        except RateLimitError as error:
+            rate_limited = True
+            last_error = error
+        except (APITimeoutError, APIConnectionError, InternalServerError, httpx.TransportError) as error:
+            # 流式读取中途断开时抛出的是 httpx 的传输错误
+            last_error = error
+        finally:
+            await limiter.release(rate_limited)
+
+        if attempt == GPT_MAX_RETRIES:
+            break
+        delay = _get_retry_delay(last_error, attempt)
+        logger.warning(f"GPT请求失败（第 {attempt + 1} 次）：{last_error}，{delay:.1f} 秒后重试")
+        await asyncio.sleep(delay)
+
+    logger.error(f"GPT请求重试 {GPT_MAX_RETRIES} 次后仍失败：{last_error}")
+    raise last_error
+
+
+def iter_gpt_batches(model: str, prompts: list, max_tokens=2000, temperature: float = 0.7,
+                     top_p: float = 0.95, max_concurrency: int = GPT_MAX_CONCURRENCY, response_format: dict = None):
+    """
+    并发发送多个批次的prompt，按完成顺序逐个产出结果。
+
+    请求在进程共享的后台事件循环中执行（复用共享异步客户端的长连接），结果通过队列交回调用方线程，
+    因此调用方可以在循环中直接更新 Streamlit 进度条和保存结果。
+
+    :param prompts: 每个批次的完整prompt。
+    :param max_tokens: 所有批次共用的最大输出token数，或与 prompts 一一对应的列表（见 pack_comment_batches）。
+    :param max_concurrency: 初始最大并发数，遇到限流时自动降低。
+    :param response_format: 结构化输出格式，所有批次共用。
+    :return: 生成器，产出 (批次序号, 响应内容, 异常)，成功时异常为None，失败时响应内容为None。
+    """
+    for index, kind, payload in iter_gpt_batch_events(model, prompts, max_tokens=max_tokens, temperature=temperature,
+                                                      top_p=top_p, max_concurrency=max_concurrency,
+                                                      response_format=response_format):
+        if kind == 'done':
+            yield index, payload, None
+        elif kind == 'error':
+            yield index, None, payload
+
+
+def iter_gpt_batch_events(model: str, prompts: list, max_tokens=2000, temperature: float = 0.7,
+                          top_p: float = 0.95, max_concurrency: int = GPT_MAX_CONCURRENCY, response_format: dict = None,
+                          stream: bool = False):
+    """
+    iter_gpt_batches 的事件版本，stream 为True时以流式方式请求并产出中间内容。
+
+    :return: 生成器，产出 (批次序号, 事件类型, 内容)，事件类型为：
+             'restart'（开始或重试请求，内容为None）、'delta'（一段新内容）、
+             'done'（完整响应内容）、'error'（异常）。
+    """
+    result_queue = queue.Queue()
+    finished = object()
+
+    async def run_all():
+        client = get_async_openai_client()
+        if not client:
+            for index in range(len(prompts)):
+                result_queue.put((index, 'error', RuntimeError("无法创建 OpenAI 客户端，请检查 API 密钥设置")))
+            return
+
+        limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+
+        async def run_one(index, prompt):
+            def on_delta(text):
+                result_queue.put((index, 'restart' if text is None else 'delta', text))
+
+            try:
+                batch_max_tokens = max_tokens[index] if isinstance(max_tokens, (list, tuple)) else max_tokens
+                response = await process_with_gpt_async(client, limiter, model, prompt, max_tokens=batch_max_tokens,
+                                                        temperature=temperature, top_p=top_p,
+                                                        response_format=response_format,
+                                                        on_delta=on_delta if stream else None)
+                result_queue.put((index, 'done', response))
+            except Exception as error:
+                logger.error(f"批次 {index + 1} 处理失败：{traceback.format_exc()}")
+                result_queue.put((index, 'error', error))
+
+        logger.info(f"开始并发处理 {len(prompts)} 个批次，使用模型：{model}，最大并发数：{max_concurrency}")
+        await asyncio.gather(*(run_one(index, prompt) for index, prompt in enumerate(prompts)))
+
+    def on_done(future):
+        if future.cancelled():
+            logger.info("GPT批次处理已取消")
+        result_queue.put(finished)
+
+    main_future = asyncio.run_coroutine_threadsafe(run_all(), get_gpt_dispatch_loop())
+    main_future.add_done_callback(on_done)
+
+    try:
+        while True:
+            item = result_queue.get()
+            if item is finished:
+                break
+            yield item
+    finally:
+        # 调用方提前退出（如页面刷新）时取消剩余请求
+        if not main_future.done():
+            main_future.cancel()
+
+
+def process_batches_with_gpt(model: str, prompts: list, max_tokens: int = 2000, temperature: float = 0.7,
+                             top_p: float = 0.95, max_concurrency: int = GPT_MAX_CONCURRENCY) -> list:
+    """
+    并发处理多个批次，按prompt顺序返回结果。
+
+    :return: 与 prompts 一一对应的列表，元素为 (响应内容, 异常)。
+    """
+    results = [(None, None)] * len(prompts)
+    for index, response, error in iter_gpt_batches(model, prompts, max_tokens=max_tokens, temperature=temperature,
+                                                   top_p=top_p, max_concurrency=max_concurrency):
+        results[index] = (response, error)
+    return results
+
+
+def get_token_encoding(model: str):
+    """获取模型的 tiktoken 编码，未安装 tiktoken 时返回None"""
+    if tiktoken is None:
+        return None
+    if model not in _token_encodings:
+        try:
+            _token_encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _token_encodings[model] = tiktoken.get_encoding('o200k_base')
+    return _token_encodings[model]
+
+
+def _estimate_char_tokens(char) -> float:
+    """
+    未安装 tiktoken 时单个字符的token估算上限：ASCII按2个字符1个token，其他字符按UTF-8字节数减1
+    （西里尔等2字节字符1个、中日韩等3字节字符2个、表情等4字节字符3个）。实际token数通常只有估算的一半左右
+    """
+    if char < '\x80':
+        return 0.5
+    return len(char.encode('utf-8', errors='replace')) - 1
+
+
+def count_tokens(text: str, model: str = 'gpt-4o-mini') -> int:
+    """
+    计算文本的token数。
+
+    未安装 tiktoken 时按 _estimate_char_tokens 估算，估算值通常高于实际token数，只会让批次偏小。
+    """
+    encoding = get_token_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(sum(_estimate_char_tokens(char) for char in text))
+
+
+def split_text_by_tokens(text: str, max_tokens: int, model: str = 'gpt-4o-mini') -> list:
+    """把超长文本切成每段不超过 max_tokens 的多段"""
+    encoding = get_token_encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+    parts, current, current_tokens = [], [], 0
+    for char in text:
+        char_tokens = _estimate_char_tokens(char)
+        if current and current_tokens + char_tokens > max_tokens:
+            parts.append(''.join(current))
+            current, current_tokens = [], 0
+        current.append(char)
+        current_tokens += char_tokens
+    if current:
+        parts.append(''.join(current))
+    return parts
+
+
+def format_comment_row(index: int, comment: dict) -> str:
+    """分析prompt中一条评论的格式，index 从1开始"""
+    return f"{index}. 用户ID: {comment['user_id']}, 评论内容: {comment['reply_content']}"
+
+
+def pack_comment_batches(comments: list, prompt_template: str, model: str, max_rows: int = None,
+                         input_token_budget: int = GPT_INPUT_TOKEN_BUDGET,
+                         max_output_tokens: int = GPT_MAX_OUTPUT_TOKENS,
+                         output_tokens_per_row: int = GPT_OUTPUT_TOKENS_PER_ROW,
+                         format_row=format_comment_row, text_field: str = 'reply_content',
+                         echo_text: bool = True) -> list:
+    """
+    按token预算把评论打包成批次。
+
+    - 每个批次的prompt（模板 + 评论行）不超过 input_token_budget
+    - 输出按行预留：每行 output_tokens_per_row，echo_text 为True时再加上评论原文的token数（结果CSV会复述评论），
+      预留总数不超过 max_output_tokens，并作为该请求的 max_tokens，避免输出被截断
+    - 单条评论超过单批上限时prompt中只放截断后的前一部分；批次中保留原评论，结果按原评论保存，
+      同一用户不会因为切段出现在多个批次里
+
+    :param prompt_template: 包含 {comments} 占位符的prompt模板。
+    :param max_rows: 每批最多评论数，None表示只受token预算限制。
+    :return: PackedBatch 列表。
+    """
+    template_tokens = count_tokens(prompt_template.replace("{comments}", ""), model)
+    row_overhead_tokens = count_tokens(format_row(1, {**comments[0], text_field: ''}), model) if comments else 0
+    # 单条评论原文允许的最大token数：既要放得进输入预算，复述时也要放得进输出预算
+    max_text_tokens = input_token_budget - template_tokens - row_overhead_tokens
+    if echo_text:
+        max_text_tokens = min(max_text_tokens, max_output_tokens - GPT_OUTPUT_TOKENS_OVERHEAD - output_tokens_per_row)
+    max_text_tokens = max(max_text_tokens, 1)
+
+    batches = []
+    current, rows, input_tokens, output_tokens = [], [], template_tokens, GPT_OUTPUT_TOKENS_OVERHEAD
+
+    def flush():
+        if current:
+            comments_text = "\n".join(rows)
+            batches.append(PackedBatch(list(current), prompt_template.replace("{comments}", comments_text),
+                                       output_tokens))
+
+    for comment in comments:
+        text = str(comment.get(text_field) or '')
+        text_tokens = count_tokens(text, model)
+        prompt_comment = comment
+        if text_tokens > max_text_tokens:
+            logger.info(f"评论超出单批token上限（{text_tokens} > {max_text_tokens}），prompt中截断")
+            prompt_comment = {**comment, text_field: split_text_by_tokens(text, max_text_tokens, model)[0]}
+            text_tokens = count_tokens(prompt_comment[text_field], model)
+
+        row_input = row_overhead_tokens + text_tokens
+        row_output = output_tokens_per_row + (text_tokens if echo_text else 0)
+        if current and (input_tokens + row_input > input_token_budget
+                        or output_tokens + row_output > max_output_tokens
+                        or (max_rows and len(current) >= max_rows)):
+            flush()
+            current, rows, input_tokens, output_tokens = [], [], template_tokens, GPT_OUTPUT_TOKENS_OVERHEAD
+        current.append(comment)
+        rows.append(format_row(len(current), prompt_comment))
+        input_tokens += row_input
+        output_tokens += row_output
+    flush()
+
+    logger.info(f"{len(comments)} 条评论按token预算打包为 {len(batches)} 个批次"
+                f"（输入预算 {input_token_budget}，输出上限 {max_output_tokens}，"
+                f"{'tiktoken' if tiktoken is not None else '估算'}计数）")
+    return batches
+
+
+def build_rows_response_format(fields: dict) -> dict:
+    """
+    生成逐行结果的 JSON Schema 结构化输出格式。
+
+    每行固定包含 序号（prompt中评论的编号）和 用户ID，用于和提交的评论逐条核对。
+
+    :param fields: {字段名: 允许的取值列表，None表示任意字符串}。
+    """
+    properties = {"序号": {"type": "integer"}, "用户ID": {"type": "string"}}
+    for name, choices in fields.items():
+        properties[name] = {"type": "string", "enum": list(choices)} if choices else {"type": "string"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "comment_rows",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "rows": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": properties,
+                            "required": list(properties),
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["rows"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def validate_structured_row(row, comments: list, fields: dict):
+    """
+    核对结构化输出的一行：序号越界、用户ID对不上、字段缺失或取值不在允许范围内时视为无效。
+
+    :return: (序号, 结果字典)，无效时返回None。
+    """
+    if not isinstance(row, dict):
+        return None
+    index = row.get("序号")
+    if not isinstance(index, int) or not 1 <= index <= len(comments):
+        return None
+    if str(row.get("用户ID", "")).strip() != str(comments[index - 1]['user_id']):
+        logger.warning(f"第 {index} 行的用户ID与提交的评论不一致: {row.get('用户ID')}")
+        return None
+    result = {}
+    for name, choices in fields.items():
+        value = row.get(name)
+        if not isinstance(value, str) or not value.strip() or (choices and value.strip() not in choices):
+            return None
+        result[name] = value.strip()
+    return index, result
+
+
+def reconcile_structured_rows(response: str, comments: list, fields: dict) -> tuple:
+    """
+    把结构化输出的行和提交的评论逐条核对，重复的序号只取第一行。
+
+    :return: (有效结果 [(评论, 结果字典)], 没有有效结果的评论列表)。
+    """
+    content = (response or '').strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        rows = json.loads(content).get("rows", [])
+    except (ValueError, AttributeError):
+        logger.warning("结构化输出不是有效的JSON，整批重新请求")
+        rows = []
+
+    matched = {}
+    for row in rows if isinstance(rows, list) else []:
+        validated = validate_structured_row(row, comments, fields)
+        if validated and validated[0] not in matched:
+            matched[validated[0]] = validated[1]
+
+    valid = [(comments[index - 1], matched[index]) for index in sorted(matched)]
+    missing = [comment for index, comment in enumerate(comments, 1) if index not in matched]
+    return valid, missing
+
+
+class IncrementalRowsParser:
+    """
+    从流式输出的 {"rows": [{...}, {...}, ...]} 中逐个取出已经完整的行对象
+
+    按字符跟踪字符串和括号层级，rows 数组中的对象一闭合就解析，不需要等整个JSON结束。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current = None
+
+    def feed(self, text: str) -> list:
+        """输入一段新内容，返回其中新闭合的行对象列表"""
+        rows = []
+        for char in text:
+            if self._current is not None:
+                self._current.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+                # 第1层为外层对象，第2层为 rows 数组，第3层为行对象
+                if char == '{' and self._depth == 3:
+                    self._current = [char]
+            elif char in '}]':
+                if char == '}' and self._depth == 3 and self._current is not None:
+                    try:
+                        rows.append(json.loads(''.join(self._current)))
+                    except ValueError:
+                        logger.warning(f"流式输出中的行不是有效的JSON: {''.join(self._current)}")
+                    self._current = None
+                self._depth -= 1
+        return rows
+
+
+def iter_structured_gpt_batches(model: str, prompt_template: str, packed_batches: list, fields: dict,
+                                output_tokens_per_row: int = GPT_OUTPUT_TOKENS_PER_ROW,
+                                max_concurrency: int = GPT_MAX_CONCURRENCY, stream: bool = GPT_STREAM_RESPONSES):
+    """
+    以结构化输出并发处理打包好的批次，缺失或无效的行在一次补请求中重新发送。
+
+    第一轮所有批次并发发送，结果完整的批次立即产出；有缺失的批次在第一轮结束后只把缺失的评论
+    组成小批次再请求一次，合并结果后产出。
+
+    stream 为True时以流式方式请求，每解析出 GPT_STREAM_FLUSH_ROWS 行有效结果就产出一次部分结果
+    （final=False），调用方可以立即保存；请求中途失败时已产出的行不受影响，只有未完成的行进入补请求。
+    每个批次的 rows 合起来不重复，最后一次产出的 final 为True。
+
+    :param prompt_template: 打包时使用的prompt模板，用于生成补请求的prompt。
+    :param packed_batches: pack_comment_batches(..., echo_text=False) 的结果。
+    :param fields: 每行除序号和用户ID外的字段，见 build_rows_response_format。
+    :return: 生成器，产出 StructuredBatchResult。
+    """
+    response_format = build_rows_response_format(fields)
+    pending = {}
+    delivered = {index: {} for index in range(len(packed_batches))}  # 流式输出中已产出的 {序号: 结果}
+    buffers = {index: [] for index in range(len(packed_batches))}
+    parsers = {index: IncrementalRowsParser() for index in range(len(packed_batches))}
+
+    def take_buffer(index):
+        rows, buffers[index] = buffers[index], []
+        return rows
+
+    for index, kind, payload in iter_gpt_batch_events(model, [batch.prompt for batch in packed_batches],
+                                                      max_tokens=[batch.max_tokens for batch in packed_batches],
+                                                      max_concurrency=max_concurrency,
+                                                      response_format=response_format, stream=stream):
+        comments = packed_batches[index].comments
+        if kind == 'restart':
+            # 重试时重新解析，已产出的行按序号去重
+            parsers[index].reset()
+        elif kind == 'delta':
+            for row in parsers[index].feed(payload):
+                validated = validate_structured_row(row, comments, fields)
+                if validated and validated[0] not in delivered[index]:
+                    delivered[index][validated[0]] = validated[1]
+                    buffers[index].append((comments[validated[0] - 1], validated[1]))
+            if len(buffers[index]) >= GPT_STREAM_FLUSH_ROWS:
+                yield StructuredBatchResult(index, take_buffer(index), [], None, False, False)
+        elif kind == 'error':
+            missing = [comment for position, comment in enumerate(comments, 1) if position not in delivered[index]]
+            if delivered[index]:
+                # 流式输出中途失败，已得到的行保留，只补请求未完成的行
+                logger.info(f"批次 {index + 1} 中途失败，已得到 {len(delivered[index])} 行，稍后补请求其余 {len(missing)} 行")
+                pending[index] = (take_buffer(index), missing)
+            else:
+                # 请求本身已按退避策略重试过，不再补请求
+                yield StructuredBatchResult(index, [], comments, payload, False)
+        else:
+            valid, _ = reconcile_structured_rows(payload, comments, fields)
+            for comment, result in valid:
+                position = next(position for position, item in enumerate(comments, 1) if item is comment)
+                if position not in delivered[index]:
+                    delivered[index][position] = result
+                    buffers[index].append((comment, result))
+            missing = [comment for position, comment in enumerate(comments, 1) if position not in delivered[index]]
+            if missing:
+                logger.info(f"批次 {index + 1} 有 {len(missing)}/{len(comments)} 条评论没有有效结果，稍后补请求")
+                pending[index] = (take_buffer(index), missing)
+            else:
+                yield StructuredBatchResult(index, take_buffer(index), [], None, False)
+
+    if not pending:
+        return
+
+    # 每个有缺失的批次补请求一次（缺失的评论来自同一个已在预算内的批次，打包后通常只有一个小批次）
+    followups = []
+    for index, (_, missing) in pending.items():
+        for batch in pack_comment_batches(missing, prompt_template, model, output_tokens_per_row=output_tokens_per_row,
+                                          echo_text=False):
+            followups.append((index, batch))
+
+    logger.info(f"发送 {len(followups)} 个补请求，共 {sum(len(batch.comments) for _, batch in followups)} 条评论")
+    errors = {}
+    for followup_index, response, error in iter_gpt_batches(model, [batch.prompt for _, batch in followups],
+                                                            max_tokens=[batch.max_tokens for _, batch in followups],
+                                                            max_concurrency=max_concurrency,
+                                                            response_format=response_format):
+        index, batch = followups[followup_index]
+        if error:
+            errors[index] = error
+            continue
+        valid, _ = reconcile_structured_rows(response, batch.comments, fields)
+        pending[index][0].extend(valid)
+
+    for index, (valid, missing) in pending.items():
+        resolved = {id(comment) for comment, _ in valid}
+        still_missing = [comment for comment in missing if id(comment) not in resolved]
+        yield StructuredBatchResult(index, valid, still_missing, errors.get(index), True)
+
+
+def normalize_comment_text(text) -> str:
+    """规范化评论文本（Unicode NFKC、大小写折叠、合并空白），用于生成缓存键"""
+    text = unicodedata.normalize('NFKC', str(text or ''))
+    return ' '.join(text.casefold().split())
+
+
+def get_prompt_template_hash(prompt_template: str) -> str:
+    """计算prompt模板的哈希，模板（含产品/客户描述）变化时缓存自动失效"""
+    return hashlib.sha256(prompt_template.encode('utf-8')).hexdigest()
+
+
+def get_gpt_cache_key(model: str, template_hash: str, text) -> str:
+    """由 (模型, prompt模板哈希, 规范化评论文本) 生成内容寻址的缓存键"""
+    payload = json.dumps([model, template_hash, normalize_comment_text(text)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_cached_gpt_results(db, model: str, template_hash: str, comments: list, text_field: str = 'reply_content') -> list:
+    """
+    查询评论的GPT结果缓存。
+
+    :param db: MySQLDatabase 实例。
+    :param comments: 评论字典列表。
+    :param text_field: 评论文本所在的字段。
+    :return: 与 comments 一一对应的列表，命中时为缓存的结果字典，未命中为None。
+    """
+    cache_keys = [get_gpt_cache_key(model, template_hash, comment[text_field]) for comment in comments]
+    try:
+        cached = db.get_gpt_cache_results(set(cache_keys))
+    except Exception as e:
+        logger.error(f"查询GPT结果缓存失败：{e}")
+        cached = {}
+    return [cached.get(cache_key) for cache_key in cache_keys]
+
+
+def save_gpt_results_to_cache(db, model: str, template_hash: str, results: list):
+    """
+    写入GPT结果缓存。
+
+    :param results: [(评论文本, 结果字典)]。
+    """
+    entries = [
+        (get_gpt_cache_key(model, template_hash, text), model, template_hash, result)
+        for text, result in results
+    ]
+    try:
+        return db.save_gpt_cache_results(entries)
+    except Exception as e:
+        logger.error(f"写入GPT结果缓存失败：{e}")
+        return -1
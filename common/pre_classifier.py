@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : pre_classifier.py
+@Software: PyCharm
+@Description: 第一轮分析前的本地预分类模型（哈希字符n-gram TF-IDF + 逻辑回归，仅依赖numpy），
+              用已有的GPT分类结果训练，高置信度的非目标客户直接标注，不再发送给GPT
+"""
+import io
+import math
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from common.log_config import setup_logger
+from common.spam_detector import normalize_text
+
+# 配置日志
+logger = setup_logger(__name__)
+
+POSITIVE_LABEL = '潜在客户'
+NEGATIVE_LABEL = '非目标客户'
+
+# 训练数据的最低要求
+MIN_TRAINING_SAMPLES = 200
+MIN_CLASS_SAMPLES = 20
+
+DEFAULT_THRESHOLD = 0.9  # 非目标客户概率达到该值才直接标注
+N_FEATURES = 2 ** 18
+NGRAM_RANGE = (2, 4)
+
+
+class PreClassifierError(Exception):
+    """训练数据不足等无法训练的情况"""
+
+
+class SparseRows:
+    """按 (行号, 列号, 值) 三元组存储的稀疏矩阵，只支持逻辑回归需要的两种乘法"""
+
+    def __init__(self, rows, cols, vals, n_rows):
+        self.rows = rows
+        self.cols = cols
+        self.vals = vals
+        self.n_rows = n_rows
+
+    def dot(self, weights):
+        """X @ w"""
+        return np.bincount(self.rows, weights=self.vals * weights[self.cols], minlength=self.n_rows)
+
+    def transpose_dot(self, vector, n_features):
+        """X.T @ v"""
+        return np.bincount(self.cols, weights=self.vals * vector[self.rows], minlength=n_features)
+
+
+class HashedTfidfVectorizer:
+    """字符 n-gram 哈希到固定维度后计算 TF-IDF，哈希函数固定（crc32），模型可以跨进程复用"""
+
+    def __init__(self, n_features=N_FEATURES, ngram_range=NGRAM_RANGE):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.idf = None
+
+    def _term_counts(self, texts):
+        rows, cols, counts = [], [], []
+        for row, text in enumerate(texts):
+            padded = f" {normalize_text(text)} "
+            terms = Counter()
+            for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+                for i in range(len(padded) - n + 1):
+                    terms[zlib.crc32(padded[i:i + n].encode('utf-8')) % self.n_features] += 1
+            rows.extend([row] * len(terms))
+            cols.extend(terms.keys())
+            counts.extend(terms.values())
+        return (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+                np.array(counts, dtype=np.float64))
+
+    def fit(self, texts):
+        _, cols, _ = self._term_counts(texts)
+        document_frequency = np.bincount(cols, minlength=self.n_features)
+        self.idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+        return self
+
+    def transform(self, texts):
+        rows, cols, counts = self._term_counts(texts)
+        vals = (1 + np.log(counts)) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=vals ** 2, minlength=len(texts)))
+        norms[norms == 0] = 1
+        return SparseRows(rows, cols, vals / norms[rows], len(texts))
+
+
+class PreClassifier:
+    """
+    二分类逻辑回归（潜在客户 / 非目标客户）
+
+    Args:
+        l2: L2正则系数
+        epochs: 全量梯度下降（Adam）的轮数
+        learning_rate: 学习率
+    """
+
+    def __init__(self, l2=1e-4, epochs=200, learning_rate=0.05, n_features=N_FEATURES):
+        self.vectorizer = HashedTfidfVectorizer(n_features=n_features)
+        self.l2 = l2
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.weights = None
+        self.bias = 0.0
+
+    def fit(self, texts, labels):
+        """labels 为分类结果字符串，POSITIVE_LABEL 视为正类，其余为负类"""
+        y = np.array([label == POSITIVE_LABEL for label in labels], dtype=np.float64)
+        X = self.vectorizer.fit(texts).transform(texts)
+        n_features = self.vectorizer.n_features
+
+        # 按类别频率加权，避免非目标客户占绝大多数时模型全部预测为负类
+        positive_rate = min(max(y.mean(), 1e-6), 1 - 1e-6)
+        sample_weights = np.where(y == 1, 0.5 / positive_rate, 0.5 / (1 - positive_rate))
+        sample_weights /= sample_weights.sum()
+
+        self.weights = np.zeros(n_features)
+        self.bias = 0.0
+        m_w, v_w = np.zeros(n_features), np.zeros(n_features)
+        m_b = v_b = 0.0
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        for step in range(1, self.epochs + 1):
+            error = (self._sigmoid(X.dot(self.weights) + self.bias) - y) * sample_weights
+            grad_w = X.transpose_dot(error, n_features) + self.l2 * self.weights
+            grad_b = error.sum()
+            m_w = beta1 * m_w + (1 - beta1) * grad_w
+            v_w = beta2 * v_w + (1 - beta2) * grad_w ** 2
+            m_b = beta1 * m_b + (1 - beta1) * grad_b
+            v_b = beta2 * v_b + (1 - beta2) * grad_b ** 2
+            correction1, correction2 = 1 - beta1 ** step, 1 - beta2 ** step
+            self.weights -= self.learning_rate * (m_w / correction1) / (np.sqrt(v_w / correction2) + eps)
+            self.bias -= self.learning_rate * (m_b / correction1) / (math.sqrt(v_b / correction2) + eps)
+        return self
+
+    def predict_negative_proba(self, texts):
+        """返回每条评论属于非目标客户的概率"""
+        if self.weights is None:
+            raise PreClassifierError("模型尚未训练")
+        if not len(texts):
+            return np.array([])
+        X = self.vectorizer.transform(texts)
+        return 1 - self._sigmoid(X.dot(self.weights) + self.bias)
+
+    def evaluate(self, texts, labels, threshold=DEFAULT_THRESHOLD):
+        """
+        在给定阈值下评估模型
+
+        Returns:
+            dict: precision/recall 为潜在客户类在0.5阈值下的指标；
+                  negative_precision 为直接标注为非目标客户的评论中确实是非目标客户的比例；
+                  auto_label_rate 为直接标注（不再发送给GPT）的比例；
+                  positive_forward_recall 为潜在客户中仍被发送给GPT的比例
+        """
+        y = np.array([label == POSITIVE_LABEL for label in labels])
+        negative_proba = self.predict_negative_proba(texts)
+        predicted_positive = negative_proba < 0.5
+        auto_labeled = negative_proba >= threshold
+
+        true_positive = int((predicted_positive & y).sum())
+        return {
+            'samples': len(y),
+            'positives': int(y.sum()),
+            'precision': true_positive / max(int(predicted_positive.sum()), 1),
+            'recall': true_positive / max(int(y.sum()), 1),
+            'negative_precision': int((auto_labeled & ~y).sum()) / max(int(auto_labeled.sum()), 1),
+            'auto_label_rate': float(auto_labeled.mean()) if len(y) else 0.0,
+            'positive_forward_recall': int((~auto_labeled & y).sum()) / max(int(y.sum()), 1),
+        }
+
+    def to_bytes(self) -> bytes:
+        """把模型参数保存为 npz（只含数值数组），随分析任务保存到数据库"""
+        if self.weights is None:
+            raise PreClassifierError("模型尚未训练")
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, weights=self.weights, bias=np.array(self.bias), idf=self.vectorizer.idf,
+                            ngram_range=np.array(self.vectorizer.ngram_range))
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """从 to_bytes 的结果恢复模型（不反序列化任何对象），格式不对时抛出 PreClassifierError"""
+        try:
+            with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+                model = cls(n_features=len(arrays['weights']))
+                model.vectorizer.ngram_range = tuple(int(n) for n in arrays['ngram_range'])
+                model.vectorizer.idf = arrays['idf']
+                model.weights = arrays['weights']
+                model.bias = float(arrays['bias'])
+        except (ValueError, KeyError, OSError) as e:
+            raise PreClassifierError(f"无法读取预分类模型: {e}") from e
+        return model
+
+    @staticmethod
+    def _sigmoid(z):
+        return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+class HoldoutEvaluation:
+    """留出集上的评估，阈值变化时直接重新计算，不需要重新训练"""
+
+    def __init__(self, model, texts, labels, train_size):
+        self.model = model
+        self.texts = texts
+        self.labels = labels
+        self.train_size = train_size
+
+    def report(self, threshold=DEFAULT_THRESHOLD):
+        report = self.model.evaluate(self.texts, self.labels, threshold)
+        report.update({'train_size': self.train_size, 'test_size': len(self.labels)})
+        return report
+
+
+def train_pre_classifier(texts, labels, test_size=0.2, seed=42):
+    """
+    按类别分层划分训练集和留出集，训练并在留出集上评估，最后用全部数据重新训练
+
+    Returns:
+        (PreClassifier, HoldoutEvaluation): 用全部数据训练的模型和留出集评估
+
+    Raises:
+        PreClassifierError: 训练数据不足
+    """
+    labels = list(labels)
+    texts = list(texts)
+    positives = [i for i, label in enumerate(labels) if label == POSITIVE_LABEL]
+    negatives = [i for i, label in enumerate(labels) if label != POSITIVE_LABEL]
+    if len(labels) < MIN_TRAINING_SAMPLES or min(len(positives), len(negatives)) < MIN_CLASS_SAMPLES:
+        raise PreClassifierError(
+            f"训练数据不足：共 {len(labels)} 条（潜在客户 {len(positives)} 条），"
+            f"至少需要 {MIN_TRAINING_SAMPLES} 条且每类不少于 {MIN_CLASS_SAMPLES} 条"
+        )
+
+    rng = np.random.default_rng(seed)
+    test_indices = []
+    for indices in (positives, negatives):
+        shuffled = rng.permutation(indices)
+        test_indices.extend(shuffled[:max(1, int(len(shuffled) * test_size))].tolist())
+    test_set = set(test_indices)
+    train_indices = [i for i in range(len(labels)) if i not in test_set]
+
+    holdout_model = PreClassifier().fit([texts[i] for i in train_indices], [labels[i] for i in train_indices])
+    evaluation = HoldoutEvaluation(holdout_model, [texts[i] for i in test_indices],
+                                   [labels[i] for i in test_indices], len(train_indices))
+    logger.info(f"预分类模型留出集评估: {evaluation.report()}")
+
+    return PreClassifier().fit(texts, labels), evaluation
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : spam_detector.py
+@Software: PyCharm
+@Description: 本地的近重复评论聚类（SimHash + LSH分段索引）和垃圾评论启发式判断，在GPT分析前减少无效评论
+"""
+import re
+import math
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+# SimHash 指纹位数和分段数：汉明距离小于分段数的两个指纹至少有一段完全相同，分段索引不会漏掉
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+DEFAULT_MAX_DISTANCE = 3
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+NORMALIZE_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+# 启发式阈值
+MIN_ENTROPY_LENGTH = 10  # 长度达到该值才检查字符熵
+MIN_ENTROPY = 2.0  # 字符熵（bit）低于该值视为刷屏
+MIN_UNIQUE_TOKEN_RATIO = 0.34  # 词数不少于4且不同词占比低于该值视为重复词刷屏
+MAX_URL_RATIO = 0.5  # 链接占词数的比例
+MIN_LETTER_RATIO = 0.3  # 文字（含中日韩文字）占字符数的比例，低于该值视为表情/符号为主
+
+
+def normalize_text(text):
+    """用于比较的归一化文本：忽略大小写，标点、表情和空白折叠成一个空格"""
+    return NORMALIZE_PATTERN.sub(' ', str(text).casefold()).strip()
+
+
+def simhash(text, shingle_size=3):
+    """计算文本的64位 SimHash 指纹（字符 n-gram），空文本（含None）返回None"""
+    normalized = normalize_text(text) if text is not None else ''
+    if not normalized:
+        return None
+    if len(normalized) <= shingle_size:
+        shingles = [normalized]
+    else:
+        shingles = [normalized[i:i + shingle_size] for i in range(len(normalized) - shingle_size + 1)]
+    digests = b''.join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(len(shingles), SIMHASH_BITS)
+    # 按有符号整数计票，uint8 求和得到的无符号结果减去 len(shingles) 会下溢
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), 'big')
+
+
+def hamming_distance(a, b):
+    # int.bit_count 需要 Python 3.10
+    return bin(a ^ b).count('1')
+
+
+def char_entropy(text):
+    """字符的香农熵（bit）"""
+    counts = Counter(text)
+    total = len(text)
+    return -sum(count / total * math.log2(count / total) for count in counts.values())
+
+
+def spam_reason(text):
+    """按启发式规则判断垃圾评论，返回原因，正常评论返回None"""
+    text = str(text or '').strip()
+    if not text:
+        return "空评论"
+    tokens = text.split()
+    if tokens and len(URL_PATTERN.findall(text)) / len(tokens) >= MAX_URL_RATIO:
+        return "链接过多"
+    letters = sum(1 for char in text if char.isalpha())
+    if len(text) >= 5 and letters / len(text) < MIN_LETTER_RATIO:
+        return "表情/符号为主"
+    if len(tokens) >= 4 and len({token.casefold() for token in tokens}) / len(tokens) < MIN_UNIQUE_TOKEN_RATIO:
+        return "重复词刷屏"
+    if len(text) >= MIN_ENTROPY_LENGTH and char_entropy(text) < MIN_ENTROPY:
+        return "字符熵过低"
+    return None
+
+
+class NearDuplicateIndex:
+    """
+    近重复评论索引
+
+    每个指纹按 SIMHASH_BANDS 段建索引，新指纹只和至少一段相同的代表指纹比较汉明距离，
+    距离不超过 max_distance 时视为近重复，否则成为新的代表。
+
+    Args:
+        max_distance: 视为近重复的最大汉明距离，需小于 SIMHASH_BANDS
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        if max_distance >= SIMHASH_BANDS:
+            raise ValueError(f"max_distance 必须小于分段数 {SIMHASH_BANDS}")
+        self.max_distance = max_distance
+        self._band_bits = SIMHASH_BITS // SIMHASH_BANDS
+        self._band_mask = (1 << self._band_bits) - 1
+        self._buckets = {}
+        self._representatives = []  # [(指纹, 代表标识)]
+
+    def _bands(self, fingerprint):
+        return [(band, (fingerprint >> (band * self._band_bits)) & self._band_mask) for band in range(SIMHASH_BANDS)]
+
+    def add(self, fingerprint, key):
+        """
+        加入一个指纹
+
+        Returns:
+            与之近重复的代表标识；没有近重复时该指纹成为新代表，返回None
+        """
+        bands = self._bands(fingerprint)
+        checked = set()
+        for band in bands:
+            for index in self._buckets.get(band, ()):
+                if index in checked:
+                    continue
+                checked.add(index)
+                representative, representative_key = self._representatives[index]
+                if hamming_distance(fingerprint, representative) <= self.max_distance:
+                    return representative_key
+        index = len(self._representatives)
+        self._representatives.append((fingerprint, key))
+        for band in bands:
+            self._buckets.setdefault(band, []).append(index)
+        return None
+
+    def __len__(self):
+        return len(self._representatives)
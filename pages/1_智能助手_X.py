@@ -14,7 +14,8 @@ import streamlit as st
 from common.config import CONFIG
 from common.log_config import setup_logger
 from sidebar import sidebar_for_x
-from collectors.common.mysql import MySQLDatabase
+from collectors.common.mysql import MySQLDatabase, SchemaMigrationError, ensure_database_schema
+from common.analysis_jobs import get_analysis_scheduler
 
 # 导入各个标签页的函数
 from pages.x_tab.data_collect import data_collect
@@ -85,6 +86,16 @@ st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 # 添加大标题
 st.title("X智能助手（开发中...）")
 
+# 确保表结构已迁移到当前版本（每个进程成功执行一次），迁移失败时不在不完整的表结构上继续渲染
+try:
+    ensure_database_schema()
+except SchemaMigrationError as e:
+    st.error(f"❌ 数据库迁移失败，请检查数据库后刷新页面: {e}")
+    st.stop()
+
+# 进程内的后台分析调度器随页面加载启动（重复调用无副作用），进程重启后排队中和租约过期的任务会被继续执行
+get_analysis_scheduler()
+
 # 创建数据库连接
 db = MySQLDatabase()
 db.connect()
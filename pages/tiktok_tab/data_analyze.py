@@ -4,13 +4,26 @@ import streamlit as st
 import pandas as pd
 from collectors.common.mysql import MySQLDatabase
 from common.openai import process_with_gpt
+from common.gpt_batch import (submit_batch_jobs, poll_batch_jobs, cancel_batch_job, ACTIVE_STATUSES,
+                              FINISHED_STATUSES)
+from common.analysis_jobs import (FIRST_ROUND_FIELDS, SECOND_ROUND_FIELDS, prepare_first_round, prepare_second_round,
+                                  serialize_pre_classifier, get_analysis_scheduler)
+from common.pre_classifier import train_pre_classifier, PreClassifierError, DEFAULT_THRESHOLD
 from io import StringIO
-import csv
-import logging
-import io
 import time
 from datetime import datetime
 
+# 本地预分类模型在会话中的缓存键
+PRE_CLASSIFIER_SESSION_KEY = 'tiktok_pre_classifier'
+
+# 后台分析任务进度的刷新间隔（秒）
+ANALYSIS_PROGRESS_REFRESH_SECONDS = 3
+
+# 分析任务状态的显示名称
+ANALYSIS_JOB_STATUS_LABELS = {'pending': '排队中', 'running': '运行中', 'completed': '已完成', 'failed': '失败',
+                              'cancelled': '已取消'}
+ANALYSIS_JOB_STAGE_LABELS = {'first_round': '第一轮分析', 'second_round': '第二轮分析', 'done': '完成'}
+
 # 定义缓存文件路径
 DESCRIPTION_CACHE_FILE = 'tiktok_description_cache.json'
 
@@ -75,6 +88,163 @@ def save_descriptions_to_cache(keyword, descriptions):
     with open(DESCRIPTION_CACHE_FILE, 'w') as f:
         json.dump(cache, f)
 
+def pre_classifier_panel(db, keyword):
+    """本地预分类设置，启用且模型已训练时返回 (模型, 阈值)，否则返回 (None, None)"""
+    with st.expander("本地预分类（减少发送给GPT的评论）"):
+        st.caption("用本关键词已有的GPT第一轮分类结果训练本地模型，非目标客户概率达到阈值的评论直接标注，不再发送给GPT。"
+                   "修改产品或客户描述后旧的分类结果可能不再适用，请重新训练。")
+        col1, col2 = st.columns(2)
+        with col1:
+            enabled = st.checkbox("启用本地预分类", value=False, key="pre_classifier_enabled")
+        with col2:
+            threshold = st.slider("非目标客户置信度阈值", min_value=0.5, max_value=0.99, value=DEFAULT_THRESHOLD,
+                                  step=0.01, key="pre_classifier_threshold")
+
+        state = st.session_state.get(PRE_CLASSIFIER_SESSION_KEY)
+        if state and state['keyword'] != keyword:
+            state = None
+        if st.button("训练模型", key="pre_classifier_train"):
+            training_data = db.get_pre_classifier_training_data(keyword)
+            try:
+                with st.spinner("正在训练本地预分类模型..."):
+                    model, evaluation = train_pre_classifier([row['reply_content'] for row in training_data],
+                                                             [row['classification'] for row in training_data])
+                state = {'keyword': keyword, 'model': model, 'evaluation': evaluation}
+                st.session_state[PRE_CLASSIFIER_SESSION_KEY] = state
+            except PreClassifierError as e:
+                st.warning(str(e))
+
+        if state:
+            # 留出集上的效果随阈值实时更新
+            report = state['evaluation'].report(threshold)
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("潜在客户精确率", f"{report['precision']:.1%}")
+            col2.metric("潜在客户召回率", f"{report['recall']:.1%}")
+            col3.metric("直接标注比例", f"{report['auto_label_rate']:.1%}")
+            col4.metric("潜在客户漏判率", f"{1 - report['positive_forward_recall']:.1%}")
+            st.caption(f"留出集 {report['test_size']} 条（训练集 {report['train_size']} 条），"
+                       f"直接标注为非目标客户的评论中 {report['negative_precision']:.1%} 确实是非目标客户")
+        elif enabled:
+            st.info("尚未训练模型，所有评论仍发送给GPT")
+
+    if enabled and state:
+        return state['model'], threshold
+    return None, None
+
+def batch_analysis_panel(db, keyword, model, batch_size, total_comments, prompt_template_first, prompt_template_second,
+                         pre_classifier=None, pre_threshold=None):
+    """离线批量分析：提交 Batch API 任务、查看状态并导入结果"""
+    with st.expander("批量模式（离线处理，费用更低）"):
+        st.caption("把待分析的评论提交为 Batch API 批量任务，通常在24小时内完成，不需要保持页面打开。"
+                   "可在这里刷新状态并导入结果，或在服务器上运行 python -m common.gpt_batch --watch 自动导入。"
+                   "第二轮批量任务请在第一轮结果导入后再提交。")
+
+        if st.button("🔄 刷新状态并导入已完成的结果", key="batch_refresh"):
+            with st.spinner("正在查询批量任务状态..."):
+                poll_batch_jobs(db, platform='tiktok', keyword=keyword)
+
+        jobs = db.get_gpt_batch_jobs(platform='tiktok', keyword=keyword, limit=20)
+        # 同一关键词同一轮次只允许一个未导入的任务，避免同一批评论重复提交
+        pending_rounds = {job['analysis_round'] for job in jobs if job['status'] in ACTIVE_STATUSES + FINISHED_STATUSES}
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("提交第一轮批量任务", disabled=1 in pending_rounds, key="batch_submit_first"):
+                try:
+                    filtered_comments = db.get_filtered_tiktok_comments_by_keyword(keyword, limit=total_comments)
+                    prepared = prepare_first_round(db, 'tiktok', keyword, model, filtered_comments, prompt_template_first,
+                                                   pre_classifier, pre_threshold)
+                    st.info(f"{prepared['cached']} 条评论命中分析缓存，本地预分类直接标注 {prepared['pre_labeled']} 条")
+                    uncached_comments = prepared['uncached']
+                    if uncached_comments:
+                        with st.spinner(f"正在提交 {len(uncached_comments)} 条评论..."):
+                            job_ids = submit_batch_jobs(db, 'tiktok', keyword, 1, model, prompt_template_first,
+                                                        uncached_comments, FIRST_ROUND_FIELDS, max_rows=batch_size)
+                        st.success(f"✅ 已提交 {len(uncached_comments)} 条评论，批量任务: {', '.join(map(str, job_ids))}")
+                    else:
+                        st.info("没有需要提交的评论")
+                except Exception as e:
+                    st.error(f"❌ 提交批量任务失败: {str(e)}")
+        with col2:
+            if st.button("提交第二轮批量任务", disabled=2 in pending_rounds, key="batch_submit_second"):
+                try:
+                    potential_customers = db.get_potential_customers(keyword)
+                    prepared = prepare_second_round(db, 'tiktok', keyword, model, potential_customers or [],
+                                                    prompt_template_second)
+                    st.info(f"{prepared['cached']} 条评论命中第二轮分析缓存")
+                    uncached_comments = prepared['uncached']
+                    if uncached_comments:
+                        with st.spinner(f"正在提交 {len(uncached_comments)} 条评论..."):
+                            job_ids = submit_batch_jobs(db, 'tiktok', keyword, 2, model, prompt_template_second,
+                                                        uncached_comments, SECOND_ROUND_FIELDS, max_rows=batch_size)
+                        st.success(f"✅ 已提交 {len(uncached_comments)} 条评论，批量任务: {', '.join(map(str, job_ids))}")
+                    else:
+                        st.info("没有需要提交的潜在客户评论")
+                except Exception as e:
+                    st.error(f"❌ 提交批量任务失败: {str(e)}")
+
+        if jobs:
+            columns = ['id', 'analysis_round', 'model', 'status', 'request_count', 'completed_requests', 'failed_requests',
+                       'comment_count', 'saved_count', 'missing_count', 'created_at', 'finished_at', 'error_message']
+            st.dataframe(pd.DataFrame(jobs)[columns], hide_index=True)
+
+            active_jobs = [job for job in jobs if job['status'] in ACTIVE_STATUSES]
+            if active_jobs:
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    job_to_cancel = st.selectbox("取消批量任务", active_jobs, key="batch_cancel_select",
+                                                 format_func=lambda job: f"任务 {job['id']}（第{job['analysis_round']}轮，{job['status']}）")
+                with col2:
+                    if st.button("取消任务", key="batch_cancel"):
+                        try:
+                            cancel_batch_job(db, job_to_cancel)
+                            st.success("已请求取消，已完成部分的结果会在任务结束后导入")
+                        except Exception as e:
+                            st.error(f"❌ 取消批量任务失败: {str(e)}")
+
+@st.fragment(run_every=ANALYSIS_PROGRESS_REFRESH_SECONDS)
+def analysis_jobs_panel(keyword):
+    """后台分析任务的进度（定时局部刷新），任务在后台执行，刷新或关闭页面不影响运行"""
+    # 局部刷新时页面主体不会重新执行，使用独立的数据库连接
+    db = MySQLDatabase()
+    db.connect()
+    try:
+        jobs = db.get_analysis_jobs(platform='tiktok', keyword=keyword, limit=5)
+        if not jobs:
+            return
+        st.subheader("分析任务")
+        for job in jobs:
+            status = ANALYSIS_JOB_STATUS_LABELS.get(job['status'], job['status'])
+            stage = ANALYSIS_JOB_STAGE_LABELS.get(job['stage'], job['stage'])
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.caption(f"任务 {job['id']}（{job['model']}，{job['total_comments']} 条，提交于 {job['created_at']}）："
+                           f"{status} · {stage}")
+                if job['status'] in ('pending', 'running') and job['progress_total']:
+                    st.progress(min(job['progress_done'] / job['progress_total'], 1.0),
+                                text=f"{stage}：已处理 {job['progress_done']}/{job['progress_total']} 条评论")
+                details = (f"命中缓存 {job['cached_count']} 条，本地预分类 {job['pre_labeled_count']} 条，"
+                           f"第一轮GPT分析 {job['first_round_saved']} 条，第二轮GPT分析 {job['second_round_saved']} 条")
+                if job['ignored_count']:
+                    details += f"，{job['ignored_count']} 条补请求后仍没有有效结果（可重新提交分析）"
+                st.caption(details)
+                if job['status'] == 'failed' and job['error_message']:
+                    st.error(f"失败原因: {job['error_message']}")
+            with col2:
+                if job['status'] in ('pending', 'running'):
+                    if st.button("取消", key=f"cancel_analysis_job_{job['id']}"):
+                        db.cancel_analysis_job(job['id'])
+                        st.rerun(scope="fragment")
+                elif job['status'] in ('failed', 'cancelled'):
+                    if st.button("继续执行", key=f"retry_analysis_job_{job['id']}"):
+                        db.retry_analysis_job(job['id'])
+                        scheduler = get_analysis_scheduler()
+                        if scheduler:
+                            scheduler.wake()
+                        st.rerun(scope="fragment")
+    finally:
+        db.disconnect()
+
 def data_analyze(db: MySQLDatabase):
     """
     本页面用于分析和分类TikTok评论数据。
@@ -108,8 +278,8 @@ def data_analyze(db: MySQLDatabase):
                                       index=0)  # 默选择最大值
 
     with col3:
-        # 选择每轮入的数据量
-        batch_size = st.selectbox("批次大小", [10, 50, 100, 200], index=1)
+        # 选择每批最多的评论数，实际批次按token预算打包，长评论多时每批条数更少
+        batch_size = st.selectbox("每批最多条数", [10, 50, 100, 200], index=1)
 
     with col4:
         # 选择模型
@@ -117,7 +287,7 @@ def data_analyze(db: MySQLDatabase):
 
     # 显示可用的评论总数和预估问答次数
     estimated_rounds = (total_comments + batch_size - 1) // batch_size
-    st.info(f"关键字 '{selected_keyword}' 共 {total_comments} 条评论待分析, 预估需进行 {estimated_rounds} 轮问答")
+    st.info(f"关键字 '{selected_keyword}' 共 {total_comments} 条评论待分析, 预估至少需进行 {estimated_rounds} 轮问答")
 
     # 获取或生成描述
     descriptions = load_descriptions_from_cache(selected_keyword)
@@ -157,34 +327,27 @@ def data_analyze(db: MySQLDatabase):
 
 请分析以下评论数据，并将每条评论分类为"潜在客户"或"非目标客户"。
 对于每条评论，请提供以下输出：
-1. 用户ID
-2. 原始评论内容
+1. 序号（评论前的编号）
+2. 用户ID
 3. 分类结果（"潜在客户"或"非目标客户"）
 4. 简短的分析理由（不超过20个字）
 
 评论数据：
 {{comments}}
 
-请以CSV格式输出结果，包含以下列：
-"用户ID", "评论内容", "分类结果", "分析理由"
-
-请确保输出的CSV格式正确，每个字段都用双引号包围，并用逗号分隔。"""
+请按JSON格式输出，每条评论对应 rows 中的一项，不要遗漏任何评论。"""
 
     prompt_template_second_round = f"""请对以下被识别为"潜在客户"的评论进行更深入的分析，将每条评论分类为"高意向客户"、"中等意向客户"或"低意向客户"。
 对于每条评论，请提供以下输出：
-1. 用户ID
-2. 原始评论内容
-3. 第一轮分类结果（"潜在客户"）
-4. 第二轮分类结果（"高意向客户"、"中等意向客户"或"低意向客户"）
-5. 简短的分析理由（不超过20个字）
+1. 序号（评论前的编号）
+2. 用户ID
+3. 第二轮分类结果（"高意向客户"、"中等意向客户"或"低意向客户"）
+4. 简短的分析理由（不超过20个字）
 
 评论数据：
 {{comments}}
 
-请以CSV格式输出结果，包含以下列：
-"用户ID", "评论内容", "第一轮分类结果", "第二轮分类结果", "分析理由"
-
-请确保输出的CSV格式正确每个字段都用双引号包围，并用逗号分隔。"""
+请按JSON格式输出，每条评论对应 rows 中的一项，不要遗漏任何评论。"""
 
     # 显示完整的prompt示例
     col1, col2 = st.columns(2)
@@ -194,14 +357,32 @@ def data_analyze(db: MySQLDatabase):
     with col2:
         st.text_area("第二轮分析Prompt（筛选高意向客户）", prompt_template_second_round, height=250)
 
+    # 本地预分类设置
+    pre_classifier, pre_threshold = pre_classifier_panel(db, selected_keyword)
+
+    # 离线批量分析
+    batch_analysis_panel(db, selected_keyword, model, batch_size, total_comments, prompt_template_first_round,
+                         prompt_template_second_round, pre_classifier, pre_threshold)
+
     # 创建一列布局用于显示分析按钮和结果
     col1, _ = st.columns(2)
 
     with col1:
         if st.button("开始分析", type="primary"):
-            # 在开始分析按钮之前添加警告提示
-            st.warning("警告：分析过程中请勿刷新页面，否则可能导致分析中断。")
-            analyze_comments(db, selected_keyword, model, batch_size, total_comments, prompt_template_first_round, prompt_template_second_round)
+            # 分析作为后台任务执行，刷新或关闭页面不会中断，进度见下方的分析任务
+            job_id = db.create_analysis_job('tiktok', selected_keyword, model, batch_size, total_comments,
+                                            prompt_template_first_round, prompt_template_second_round,
+                                            serialize_pre_classifier(pre_classifier), pre_threshold)
+            if job_id:
+                scheduler = get_analysis_scheduler()
+                if scheduler:
+                    scheduler.wake()
+                st.success(f"已提交分析任务 {job_id}，可以关闭页面，稍后回来查看结果")
+            else:
+                st.error("提交分析任务失败")
+
+    # 后台分析任务的进度
+    analysis_jobs_panel(selected_keyword)
         
     # 使用expander来显示分析结果，默认折叠
     with st.expander("查看分析结果", expanded=True):
@@ -232,38 +413,6 @@ def data_analyze(db: MySQLDatabase):
         status_text.empty()
         progress_bar.empty()
 
-def analyze_comments(db, keyword, model, batch_size, total_comments, prompt_template_first, prompt_template_second):
-    # 第一轮分析
-    st.info("开始第一轮分析...")
-    first_round_analyze(db, keyword, model, batch_size, total_comments, prompt_template_first)
-    
-    # 获取潜在客户数量
-    potential_customers_count = db.get_potential_customers_count(keyword)
-    st.success(f"第一轮分析完成，发现 {potential_customers_count} 个潜在客户")
-    
-    if potential_customers_count > 0:
-        # 第二轮分析
-        st.info("开始第二轮分析...")
-        second_round_analyze(db, keyword, model, batch_size, prompt_template_second)
-        
-        # 获取第二轮分析结果
-        second_round_results = db.get_second_round_analyzed_comments(keyword)
-        if second_round_results:
-            df_second_round = pd.DataFrame(second_round_results)
-            classification_counts = df_second_round['second_round_classification'].value_counts()
-            high_intent_customers_count = classification_counts.get('高意向客户', 0)
-            medium_intent_customers_count = classification_counts.get('中等意向客户', 0)
-            low_intent_customers_count = classification_counts.get('低意向客户', 0)
-            
-            st.success(f"第二轮分析完成，发现：\n"
-                       f"高意向客户: {high_intent_customers_count} 个\n"
-                       f"中等意向客户: {medium_intent_customers_count} 个\n"
-                       f"低意向客户: {low_intent_customers_count} 个")
-        else:
-            st.warning("第二轮分析完成，但未找到分析结果")
-    else:
-        st.warning("未发现潜在客户，跳过第二轮分析")
-
 def display_analysis_results(db, keyword):
     # 显示第一轮分析结果
     st.subheader("第一轮分析结果")
@@ -292,174 +441,3 @@ def display_analysis_results(db, keyword):
         st.dataframe(df_second_round)
     else:
         st.info("没有找到第二轮分析的评论数据")
-
-def remove_punctuation(text):
-    """移除字符串开头和结尾的标点符号"""
-    return text.strip('.,;:!?"\' ')
-
-def first_round_analyze(db, keyword, model, batch_size, total_comments, prompt_template):
-    # 获取过滤后的评论数据
-    filtered_comments = db.get_filtered_tiktok_comments_by_keyword(keyword, limit=total_comments)
-
-    ignored_comments = []
-    total_ignored = 0
-
-    if filtered_comments:
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        results = []
-        for i in range(0, len(filtered_comments), batch_size):
-            with st.spinner(f'正在处理第 {i//batch_size + 1} 批次...'):
-                batch = filtered_comments[i:i+batch_size]
-                comments_text = "\n".join([f"{j+1}. 用户ID: {comment['user_id']}, 评论内容: {comment['reply_content']}" for j, comment in enumerate(batch)])
-                
-                current_prompt = prompt_template.replace("{comments}", comments_text)
-                
-                try:
-                    response = process_with_gpt(model, current_prompt, max_tokens=5000)
-                    
-                    # 去除可能存在的 ```csv 标记
-                    response = response.strip()
-                    if response.startswith("```csv"):
-                        response = response[7:]
-                    if response.endswith("```"):
-                        response = response[:-3]
-                    csv_content = response.strip()
-                    
-                    # 使用固定的列名
-                    fixed_headers = ["用户ID", "评论内容", "分类结果", "分析理由"]
-                    
-                    # 使用 csv.reader 来解析 CSV 内容，并去除多余的引号
-                    csv_reader = csv.reader(io.StringIO(csv_content))
-                    next(csv_reader)  # 跳过 GPT 生成的标题行
-                    
-                    rows = []
-                    for row in csv_reader:
-                        if len(row) == len(fixed_headers):
-                            cleaned_row = [remove_punctuation(cell) for cell in row]
-                            row_dict = dict(zip(fixed_headers, cleaned_row))
-                            
-                            # 只保存分类结果为"潜在客户"或"非目标客户"的数据
-                            if row_dict['分类结果'] in ["潜在客户", "非目标客户"]:
-                                rows.append(row_dict)
-                            else:
-                                logging.warning(f"忽略分类结果不符合预期的行: {row_dict}")
-                        else:
-                            total_ignored += 1
-                            if len(ignored_comments) < 5:  # 只保存前5个被忽略的评论作为示例
-                                ignored_comments.append(row)
-                            logging.warning(f"忽略字段数量不匹配的行: {row}")
-                    
-                    # 使用处理后的数据创建 DataFrame
-                    if rows:
-                        batch_results = pd.DataFrame(rows)
-                        results.append(batch_results)
-
-                        # 保存批次结果到数据库
-                        db.save_analyzed_comments(keyword, batch_results)
-                    else:
-                        logging.warning("本批次没有有效的数据行")
-
-                except Exception as e:
-                    st.error(f"处理批次 {i//batch_size + 1} 时发生错误: {str(e)}")
-                
-                progress = (i + batch_size) / len(filtered_comments)
-                progress_bar.progress(min(progress, 1.0))
-                status_text.text(f"已处理 {min(i+batch_size, len(filtered_comments))}/{len(filtered_comments)} 条评论")
-
-        # 合并所有结果
-        if results:
-            # 显示忽略的评论信息
-            if total_ignored > 0:
-                st.warning(f"共有 {total_ignored} 条评论因格式问题被忽略。")
-                if ignored_comments:
-                    st.warning(f"被忽略的评论示例：\n" + "\n".join([str(comment) for comment in ignored_comments]))
-        else:
-            st.warning("没有成功处理任何评论数据")
-
-    else:
-        st.warning("没有找到相关的过滤后的评论数据")
-
-def second_round_analyze(db, keyword, model, batch_size, prompt_template):
-    potential_customers = db.get_potential_customers(keyword)
-    
-    if not potential_customers:
-        st.warning("没有找到潜在客户数据进行第二轮分析")
-        return
-
-    ignored_comments = []
-    total_ignored = 0
-
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    results = []
-    for i in range(0, len(potential_customers), batch_size):
-        with st.spinner(f'正在处理第 {i//batch_size + 1} 批次...'):
-            batch = potential_customers[i:i+batch_size]
-            comments_text = "\n".join([f"{j+1}. 用户ID: {comment['user_id']}, 评论内容: {comment['reply_content']}" for j, comment in enumerate(batch)])
-            
-            current_prompt = prompt_template.replace("{comments}", comments_text)
-            
-            try:
-                response = process_with_gpt(model, current_prompt, max_tokens=5000)
-                
-                # 去除可能存在的 ```csv 标记
-                response = response.strip()
-                if response.startswith("```csv"):
-                    response = response[7:]
-                if response.endswith("```"):
-                    response = response[:-3]
-                csv_content = response.strip()
-                
-                # 使用固定的列名
-                fixed_headers = ["用户ID", "评论内容", "第一轮分类结果", "第二轮分类结果", "分析理由"]
-                
-                # 使用 csv.reader 来解析 CSV 内容，并去除多余的引号
-                csv_reader = csv.reader(io.StringIO(csv_content))
-                next(csv_reader)  # 跳过 GPT 生成的标题行
-                
-                rows = []
-                for row in csv_reader:
-                    if len(row) == len(fixed_headers):
-                        cleaned_row = [remove_punctuation(cell) for cell in row]
-                        row_dict = dict(zip(fixed_headers, cleaned_row))
-                        
-                        # 只保存第二轮分类结果为"高意向客户"、"中等意向客户"或"低意向客户"的数据
-                        if row_dict['第二轮分类结果'] in ["高意向客户", "中等意向客户", "低意向客户"]:
-                            rows.append(row_dict)
-                        else:
-                            logging.warning(f"忽略第二轮分类结果不符合预期的行: {row_dict}")
-                    else:
-                        total_ignored += 1
-                        if len(ignored_comments) < 5:  # 只保存前5个被忽略的评论作为示例
-                            ignored_comments.append(row)
-                        logging.warning(f"忽略字段数量不匹配的行: {row}")
-                
-                # 使用处理后的数据创建 DataFrame
-                if rows:
-                    batch_results = pd.DataFrame(rows)
-                    results.append(batch_results)
-
-                    # 保存批次结果到数据库
-                    db.save_second_round_analyzed_comments(keyword, batch_results)
-                else:
-                    logging.warning("本批次没有有效的数据行")
-
-            except Exception as e:
-                st.error(f"处理第二轮分析批次 {i//batch_size + 1} 时发生错误: {str(e)}")
-            
-            progress = (i + batch_size) / len(potential_customers)
-            progress_bar.progress(min(progress, 1.0))
-            status_text.text(f"已处理 {min(i+batch_size, len(potential_customers))}/{len(potential_customers)} 条评论")
-
-    # 合并所有结果
-    if results:
-        # 显示忽略的评论信息
-        if total_ignored > 0:
-            st.warning(f"第二轮中共有 {total_ignored} 条评论因格式问题被忽略。")
-            if ignored_comments:
-                st.warning(f"第二轮被忽略的评论示例：\n" + "\n".join([str(comment) for comment in ignored_comments]))
-    else:
-        st.warning("没有成功处理任何评论数据")
@@ -34,6 +34,8 @@ def data_collect(db: MySQLDatabase):
         else:
             default_search_keyword = st.session_state.cached_keyword
         search_keyword = st.text_input("关键词", value=default_search_keyword, key="data_collect_keyword_input")
+        block_resources = st.checkbox("⚡ 快速采集（不加载视频、图片和字体）", value=True,
+                                      help="开启后每个浏览器占用的带宽、CPU和内存大幅减少，页面显示异常时可关闭")
         submit_task = st.form_submit_button("🚀 创建任务")
 
     if submit_task and search_keyword:
@@ -54,7 +56,7 @@ def data_collect(db: MySQLDatabase):
                 st.error(f"❌ 当前已有 {MAX_RUNNING_TASKS} 个任务在运行，请等待其他任务完成后再创建新任务。")
             else:
                 # 在MySQL中创建新任务
-                task_id = db.create_tiktok_task(search_keyword)
+                task_id = db.create_tiktok_task(search_keyword, block_resources=block_resources)
                 if task_id:
                     st.success(f"✅ 成功在数据库中创建任务。ID: {task_id}")
                 else:
@@ -94,6 +96,8 @@ def data_collect(db: MySQLDatabase):
     def update_task_list():
         tasks = db.get_all_tiktok_tasks()
         if tasks:
+            # 一次读取所有关键词的统计汇总
+            keyword_stats = db.get_all_keyword_stats()
             task_data = []
             for task in tasks:
                 status_emoji = {
@@ -104,10 +108,11 @@ def data_collect(db: MySQLDatabase):
                     'failed': '❌'
                 }.get(task['status'], '❓')
                 
-                total_videos = db.get_total_videos_for_keyword(task['keyword'])
-                processed_videos = db.get_processed_videos_for_keyword(task['keyword'])
+                stats = keyword_stats.get(task['keyword'], {})
+                total_videos = stats.get('total_videos', 0)
+                processed_videos = stats.get('processed_videos', 0)
                 pending_videos = total_videos - processed_videos
-                comments_count = len(db.get_tiktok_comments_by_keyword(task['keyword']))
+                comments_count = stats.get('comments_count', 0)
                 
                 # 计算运行时间
                 if task['status'] in ['running', 'completed', 'failed', 'paused']:
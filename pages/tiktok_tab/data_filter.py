@@ -3,11 +3,37 @@ import json
 import streamlit as st
 import pandas as pd
 from collectors.common.mysql import MySQLDatabase
+from common.comment_filter import (CommentFilterRules, CommentFilterPipeline, DEFAULT_SPAM_PATTERNS,
+                                   LANGUAGE_PATTERNS, to_records)
 
+# 预览时最多展示的过滤结果行数
+PREVIEW_ROWS = 1000
 
-def preprocess_comment(comment):
-    """预处理评论内容，删除逗号、单引号和双引号"""
-    return comment.replace(',', '').replace("'", "").replace('"', '')
+# 合并相同用户的评论时各列的聚合方式
+COMMENT_AGGREGATIONS = {
+    'video_id': 'first',
+    'keyword': 'first',
+    'reply_time': 'first',
+    'likes_count': 'sum',
+    'is_pinned': 'any',
+    'parent_comment_id': 'first',
+    'collected_at': 'first',
+    'collected_by': 'first',
+    'video_url': 'first'
+}
+
+
+def run_filter(db: MySQLDatabase, keyword, rules, on_chunk, min_id=None, max_id=None):
+    """流式执行过滤（只处理 id 在 (min_id, max_id] 内的评论），每产出一块结果调用一次 on_chunk(df)，返回流水线（含过滤统计和近重复计数）"""
+    pipeline = CommentFilterPipeline(rules, COMMENT_AGGREGATIONS)
+    if min_id is not None and rules.near_duplicates:
+        # 增量过滤：新评论也要和之前保存的结果比较近重复
+        pipeline.seed_near_duplicates(db.stream_filtered_tiktok_comment_texts(keyword))
+    chunks = db.stream_tiktok_comments_by_keyword(keyword, order_by_user=rules.merge_by_user,
+                                                  min_id=min_id, max_id=max_id)
+    for df in pipeline.run(chunks):
+        on_chunk(df)
+    return pipeline
 
 
 def data_filter(db: MySQLDatabase):
@@ -21,61 +47,108 @@ def data_filter(db: MySQLDatabase):
     keywords = db.get_all_tiktok_keywords()
 
     # 创建下拉框让用户选择关键字，使用session_state中的cached_keyword作为默认值
-    selected_keyword = st.selectbox("选择关键字", keywords, 
+    selected_keyword = st.selectbox("选择关键字", keywords,
                                     index=keywords.index(st.session_state.cached_keyword) if st.session_state.cached_keyword in keywords else 0,
                                     key="filter_keyword_select")
 
+    # 过滤规则
+    with st.expander("过滤规则设置"):
+        col1, col2 = st.columns(2)
+        with col1:
+            min_length = st.number_input("最小长度", min_value=0, value=5, key="filter_min_length")
+            languages = st.multiselect("只保留语言（不选则不限制）", list(LANGUAGE_PATTERNS), key="filter_languages")
+        with col2:
+            filter_spam = st.checkbox("过滤垃圾评论（链接、刷屏、纯@）", value=True, key="filter_spam")
+            dedupe_across_users = st.checkbox("去掉不同用户之间的相同评论", value=False, key="filter_dedupe_across_users")
+            near_duplicates = st.checkbox("合并近重复评论（复制粘贴、略改几个字）", value=True, key="filter_near_duplicates")
+            spam_heuristics = st.checkbox("标记垃圾评论（表情刷屏、重复词、链接），不参与分析", value=True,
+                                          key="filter_spam_heuristics")
+    rules = CommentFilterRules(
+        min_length=min_length,
+        languages=languages,
+        spam_patterns=DEFAULT_SPAM_PATTERNS if filter_spam else None,
+        dedupe_across_users=dedupe_across_users,
+        near_duplicates=near_duplicates,
+        spam_heuristics=spam_heuristics,
+    )
+
     if selected_keyword:
-        # 获取选定关键字的评论数据
-        comments = db.get_tiktok_comments_by_keyword(selected_keyword)
-
-        if comments:
-            st.write(f"原始评论数量: {len(comments)}")
-
-            # 过滤和处理数据
-            df = pd.DataFrame(comments)
-            
-            # 预处理评论内容
-            df['reply_content'] = df['reply_content'].apply(preprocess_comment)
-            
-            # 1. 过滤长度小于或等于5的评论
-            df = df[df['reply_content'].str.len() >= 5]
-
-            # 2. 相同用户ID的评论合并成一条
-            df = df.groupby('user_id').agg({
-                'video_id': 'first',
-                'keyword': 'first',
-                'reply_content': lambda x: ' '.join(x),
-                'reply_time': 'first',
-                'likes_count': 'sum',
-                'is_pinned': 'any',
-                'parent_comment_id': 'first',
-                'collected_at': 'first',
-                'collected_by': 'first',
-                'video_url': 'first'
-            }).reset_index()
-
-            st.write(f"过滤后的评论数量: {len(df)}")
+        # 过滤水位：上次保存时已处理到的评论ID
+        watermark = db.get_filter_watermark('tiktok', selected_keyword)
+        incremental = False
+        if watermark:
+            st.caption(f"上次过滤: {watermark['updated_at']}，已处理到评论ID {watermark['last_comment_id']}")
+            incremental = st.radio("过滤方式", ["增量（只处理上次过滤后新增的评论）", "全量重新过滤"],
+                                   horizontal=True, key="filter_mode") != "全量重新过滤"
+            if incremental and watermark['rules_hash'] != rules.fingerprint():
+                st.warning("⚠️ 过滤规则与上次不同，增量过滤只会对新评论使用新规则，建议全量重新过滤")
+        min_id = watermark['last_comment_id'] if incremental else None
+        # 本次处理的上界（预览和保存相同），刚采集的评论可能还有ID更小的未提交，留到下次增量处理
+        max_id = db.get_max_tiktok_comment_id(selected_keyword)
+
+        # 相同关键字、规则和评论范围的预览结果缓存在会话中，页面重新运行时不再重复过滤
+        preview_key = (selected_keyword, rules.cache_key(), min_id, max_id)
+        preview = st.session_state.get('tiktok_filter_preview')
+        recompute = st.button("🔄 重新计算")
+        if recompute or not preview or preview['key'] != preview_key:
+            preview_frames = []
+
+            def collect_preview(df):
+                remaining = PREVIEW_ROWS - sum(len(frame) for frame in preview_frames)
+                if remaining > 0:
+                    preview_frames.append(df.head(remaining))
+
+            with st.spinner("正在过滤评论..."):
+                stats = run_filter(db, selected_keyword, rules, collect_preview, min_id=min_id, max_id=max_id).stats
+            preview = {
+                'key': preview_key,
+                'stats': stats,
+                'df': pd.concat(preview_frames, ignore_index=True) if preview_frames else pd.DataFrame(),
+            }
+            st.session_state['tiktok_filter_preview'] = preview
+
+        stats = preview['stats']
+        if stats['raw']:
+            st.write(f"原始评论数量: {stats['raw']}")
+            st.write(f"过滤后的评论数量: {stats['output']}")
+            st.caption(f"长度不符: {stats['length']}，语言不符: {stats['language']}，"
+                       f"垃圾评论: {stats['spam']}，重复: {stats['duplicate']}，近重复: {stats['near_duplicate']}，"
+                       f"标记为垃圾评论（保留但不参与分析）: {stats['spam_tagged']}")
 
             # 数据过滤规则
             st.caption("数据过滤规则:")
-            st.markdown("""
-            - 删除评论中的逗号、单引号和双引号
-            - 过滤长度小于或等于5的评论
-            - 相同用户ID的评论合并成一条
-            """)
+            st.markdown("\n".join(f"- {line}" for line in rules.describe()))
 
-            # 保存过滤后的数据
+            # 保存过滤后的数据：重新流式过滤并逐块写入（按关键词和用户ID合并到已有结果），完成后记录水位。
+            # 全量模式的清空、逐块写入和水位在同一个事务中，任何一步出错（含流式读取中断）整体回滚
             if st.button("保存过滤后的数据", type="primary"):
                 try:
-                    saved_count = db.save_filtered_comments(df.to_dict('records'))
-                    st.success(f"✅ 成功保存 {saved_count} 条过滤后的评论")
+                    progress = st.progress(0.0)
+                    saved = {'count': 0}
+
+                    def save_chunk(df):
+                        db.save_filtered_comments(to_records(df))
+                        saved['count'] += len(df)
+                        progress.progress(min(saved['count'] / max(stats['output'], 1), 1.0))
+
+                    with db.transaction():
+                        if not incremental:
+                            db.clear_filtered_comments_by_keyword(selected_keyword)
+                        pipeline = run_filter(db, selected_keyword, rules, save_chunk, min_id=min_id, max_id=max_id)
+                        db.add_filtered_duplicate_counts(selected_keyword, pipeline.duplicate_counts)
+                        db.save_filter_watermark('tiktok', selected_keyword, max_id, rules.fingerprint())
+                    st.session_state.pop('tiktok_filter_preview', None)
+                    st.success(f"✅ 成功保存 {saved['count']} 条过滤后的评论")
                 except Exception as e:
                     st.error(f"❌ 保存过滤后的数据时发生错误: {str(e)}")
 
             # 显示过滤后的数据
             st.subheader("过滤后的评论数据")
-            st.dataframe(df)
+            if stats['output'] > len(preview['df']):
+                st.caption(f"仅展示前 {len(preview['df'])} 条")
+            st.dataframe(preview['df'])
 
+        elif incremental:
+            st.info("没有需要过滤的新评论")
         else:
             st.warning("⚠️ 没有找到相关评论数据")
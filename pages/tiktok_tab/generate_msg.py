@@ -1,6 +1,6 @@
 import streamlit as st
 import pandas as pd
-from common.openai import process_with_gpt
+from common.openai import process_with_gpt, iter_gpt_batches
 from collectors.common.mysql import MySQLDatabase
 import time
 import json
@@ -47,6 +47,10 @@ def generate_messages(model, prompt, product_info, user_comments_str, additional
         return {}
     
     response = process_with_gpt(model, formatted_prompt, max_tokens=5000)
+    return parse_generated_messages(response)
+
+def parse_generated_messages(response):
+    """解析GPT返回的 {用户ID: 消息} JSON"""
     try:
         # 尝试直接解析 JSON
         messages = json.loads(response.strip())
@@ -167,7 +171,8 @@ def generate_msg(db: MySQLDatabase):
         
         total_customers = len(filtered_df)
         
-        all_messages = {}
+        # 构建所有批次的prompt，并发生成
+        user_comments_batches = []
         for i in range(0, total_customers, batch_size):
             batch = filtered_df.iloc[i:min(i+batch_size, total_customers)]
             
@@ -182,15 +187,30 @@ def generate_msg(db: MySQLDatabase):
                 st.warning("没有有效的用户评论数据。请检查数据源。")
                 break
             
-            # 生成消息
-            user_comments_str = "\n".join([f"{user_id}: {comment}" for user_id, comment in user_comments.items()])
-            messages = generate_messages(model, prompt, product_info, user_comments_str, additional_prompt)
-            all_messages.update(messages)
+            user_comments_batches.append(user_comments)
+        
+        prompts = [
+            prompt.replace("{user_comments}", "\n".join([f"{user_id}: {comment}" for user_id, comment in user_comments.items()]))
+            for user_comments in user_comments_batches
+        ]
+        
+        batch_messages = [{}] * len(prompts)
+        generated_count = 0
+        for batch_index, response, error in iter_gpt_batches(model, prompts, max_tokens=5000):
+            if error:
+                st.error(f"生成第 {batch_index + 1} 批推广信息时出错: {str(error)}")
+            else:
+                batch_messages[batch_index] = parse_generated_messages(response)
             
             # 更新进度
-            progress = min((i + batch_size) / total_customers, 1.0)
-            progress_bar.progress(progress)
-            status_text.text(f"已生成 {min(i+batch_size, total_customers)}/{total_customers} 条推广信息")
+            generated_count += len(user_comments_batches[batch_index])
+            progress_bar.progress(min(generated_count / total_customers, 1.0))
+            status_text.text(f"已生成 {generated_count}/{total_customers} 条推广信息")
+        
+        # 按批次顺序合并结果
+        all_messages = {}
+        for messages in batch_messages:
+            all_messages.update(messages)
         
         st.session_state.generated_messages = all_messages
         
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_batch_packing.py
+@Software: PyCharm
+@Description: 按token预算打包评论（pack_comment_batches）和未安装 tiktoken 时的token估算
+"""
+import pytest
+
+pytest.importorskip('openai')
+
+from common import openai as gpt_helpers  # noqa: E402
+from common.openai import count_tokens, pack_comment_batches  # noqa: E402
+
+
+@pytest.fixture
+def no_tiktoken(monkeypatch):
+    """按字符估算token数，结果不依赖 tiktoken 编码文件"""
+    monkeypatch.setattr(gpt_helpers, 'tiktoken', None)
+
+
+def test_count_tokens_fallback_estimate(no_tiktoken):
+    assert count_tokens("abcd") == 2
+    assert count_tokens("abc") == 2
+    assert count_tokens("中文") == 4
+    assert count_tokens("") == 0
+
+
+def test_pack_respects_max_rows_and_keeps_order(no_tiktoken):
+    comments = [{'user_id': f"user{index}", 'reply_content': f"评论{index}"} for index in range(7)]
+    batches = pack_comment_batches(comments, "分析：\n{comments}", 'gpt-4o-mini', max_rows=3)
+    assert [len(batch.comments) for batch in batches] == [3, 3, 1]
+    assert [comment for batch in batches for comment in batch.comments] == comments
+    # 每批的序号从1开始
+    assert batches[1].prompt.splitlines()[1].startswith("1. 用户ID: user3")
+
+
+def test_pack_respects_token_budgets(no_tiktoken):
+    comments = [{'user_id': f"user{index}", 'reply_content': "想了解一下价格和发货时间" * 3} for index in range(30)]
+    batches = pack_comment_batches(comments, "分析：\n{comments}", 'gpt-4o-mini', input_token_budget=300,
+                                   max_output_tokens=2000)
+    assert len(batches) > 1
+    assert sum(len(batch.comments) for batch in batches) == len(comments)
+    for batch in batches:
+        assert count_tokens(batch.prompt) <= 300
+        assert batch.max_tokens <= 2000
+
+
+def test_pack_truncates_oversized_comment_in_prompt_only(no_tiktoken):
+    long_comment = {'user_id': 'long', 'reply_content': "很长的评论" * 200}
+    comments = [{'user_id': 'a', 'reply_content': "短评论"}, long_comment, {'user_id': 'b', 'reply_content': "短评论"}]
+    batches = pack_comment_batches(comments, "分析：\n{comments}", 'gpt-4o-mini', input_token_budget=200,
+                                   max_output_tokens=4000, echo_text=False)
+    packed = [comment for batch in batches for comment in batch.comments]
+    # 超长评论只出现在一个批次中，并且批次中保留原评论
+    assert packed == comments
+    long_batch = next(batch for batch in batches if long_comment in batch.comments)
+    assert long_comment['reply_content'] not in long_batch.prompt
+    assert "用户ID: long, 评论内容: 很长的评论" in long_batch.prompt
+    assert count_tokens(long_batch.prompt) <= 200
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_gpt_batch.py
+@Software: PyCharm
+@Description: 在进程内的模拟 Batch API 服务（FakeBatchStore）上跑通 提交 → 刷新 → 导入 的完整流程，
+              检查缺失行（drop_every）和失败请求（fail_every）的计数
+"""
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+openai = pytest.importorskip('openai')
+pytest.importorskip('pymysql')
+
+from common import gpt_batch, openai as gpt_helpers  # noqa: E402
+from common.analysis_jobs import FIRST_ROUND_FIELDS  # noqa: E402
+from common.fake_batch_server import FakeBatchHandler, FakeBatchStore  # noqa: E402
+
+PROMPT_TEMPLATE = "判断以下评论是否为潜在客户：\n{comments}"
+
+
+class FakeBatchDatabase:
+    """只实现批量流程用到的方法，数据保存在内存中"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.requests = {}
+        self.saved_rows = []
+        self.cache_entries = []
+
+    def create_gpt_batch_job(self, platform, keyword, analysis_round, model, template_hash, fields):
+        job_id = len(self.jobs) + 1
+        self.jobs[job_id] = {'id': job_id, 'platform': platform, 'keyword': keyword,
+                             'analysis_round': analysis_round, 'model': model, 'template_hash': template_hash,
+                             'output_fields': json.loads(json.dumps(fields)), 'status': 'preparing',
+                             'provider_batch_id': None}
+        return job_id
+
+    def add_gpt_batch_requests(self, job_id, requests):
+        self.requests.setdefault(job_id, {}).update(
+            {custom_id: json.loads(json.dumps(comments)) for custom_id, comments in requests})
+        return len(requests)
+
+    def get_gpt_batch_requests(self, job_id):
+        return dict(self.requests.get(job_id, {}))
+
+    def update_gpt_batch_job(self, job_id, **kwargs):
+        self.jobs[job_id].update(kwargs)
+        return 1
+
+    def save_analyzed_comments(self, keyword, df):
+        self.saved_rows.extend(df.to_dict('records'))
+        return len(df)
+
+    def save_gpt_cache_results(self, entries):
+        self.cache_entries.extend(entries)
+        return len(entries)
+
+
+@pytest.fixture
+def fake_batch_api(monkeypatch, tmp_path):
+    """启动模拟服务：每个请求省略第3、6...行，每第2个请求失败"""
+    store = FakeBatchStore(delay=0, drop_every=3, fail_every=2)
+    handler = type('Handler', (FakeBatchHandler,), {'store': store, 'log_message': lambda *args: None})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = openai.OpenAI(api_key='test', base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                           max_retries=0)
+    monkeypatch.setattr(gpt_batch, 'get_openai_client', lambda: client)
+    monkeypatch.setattr(gpt_batch, 'BATCH_DIR', str(tmp_path))
+    # 按字符估算token数，不下载 tiktoken 编码文件
+    monkeypatch.setattr(gpt_helpers, 'tiktoken', None)
+    yield store, client
+    server.shutdown()
+    server.server_close()
+
+
+def test_submit_refresh_ingest_counts_missing_rows(fake_batch_api):
+    store, client = fake_batch_api
+    db = FakeBatchDatabase()
+    comments = [{'user_id': f"user{index}", 'reply_content': f"这是第{index}条评论，想了解价格"} for index in range(20)]
+
+    job_ids = gpt_batch.submit_batch_jobs(db, 'tiktok', '关键词', 1, 'gpt-4o-mini', PROMPT_TEMPLATE, comments,
+                                          FIRST_ROUND_FIELDS, max_rows=5)
+    assert len(job_ids) == 1
+    job = db.jobs[job_ids[0]]
+    assert job['request_count'] == 4 and job['comment_count'] == 20
+    assert job['status'] == 'validating' and job['provider_batch_id']
+
+    # 模拟服务按创建时间推进状态：刚创建时仍在校验，回拨创建时间后直接完成
+    job = gpt_batch.refresh_batch_job(db, job, client)
+    assert job['status'] == 'validating' and not db.saved_rows
+    store.batches[job['provider_batch_id']]['created_at'] -= 10
+    job = gpt_batch.refresh_batch_job(db, job, client)
+
+    # 4个请求各5条：第2、4个请求失败（10条），其余请求各省略第3行（2条）
+    assert job['status'] == gpt_batch.INGESTED_STATUS
+    assert (job['saved'], job['missing']) == (8, 12)
+    assert db.jobs[job['id']]['status'] == gpt_batch.INGESTED_STATUS
+    assert (db.jobs[job['id']]['saved_count'], db.jobs[job['id']]['missing_count']) == (8, 12)
+    assert db.jobs[job['id']]['completed_requests'] == 2 and db.jobs[job['id']]['failed_requests'] == 2
+
+    saved_users = {row['用户ID'] for row in db.saved_rows}
+    assert len(saved_users) == 8
+    assert saved_users == {f"user{index}" for index in (0, 1, 3, 4, 10, 11, 13, 14)}
+    assert all(row['分类结果'] in FIRST_ROUND_FIELDS['分类结果'] for row in db.saved_rows)
+    assert len(db.cache_entries) == 8
+
+
+def test_refresh_skips_jobs_not_yet_submitted(fake_batch_api):
+    _, client = fake_batch_api
+    db = FakeBatchDatabase()
+    job_id = db.create_gpt_batch_job('tiktok', '关键词', 1, 'gpt-4o-mini', 'hash', FIRST_ROUND_FIELDS)
+    assert gpt_batch.refresh_batch_job(db, db.jobs[job_id], client)['status'] == 'preparing'
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_pre_classifier.py
+@Software: PyCharm
+@Description: 本地预分类模型的分层划分、留出集评估指标和参数序列化
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+from common.pre_classifier import (MIN_CLASS_SAMPLES, MIN_TRAINING_SAMPLES, NEGATIVE_LABEL,  # noqa: E402
+                                   POSITIVE_LABEL, PreClassifier, PreClassifierError, train_pre_classifier)
+
+POSITIVE_TEMPLATES = ["where can I buy this {}", "how much is the {}", "price of this {} please",
+                      "do you ship the {} to canada", "I want to order the {}"]
+NEGATIVE_TEMPLATES = ["lol this is so funny {}", "first comment {}", "the music in this video {}",
+                      "haha my cat does the same {}", "nice dance moves {}"]
+
+
+def make_dataset(positives, negatives):
+    texts = [POSITIVE_TEMPLATES[i % 5].format(f"item{i}") for i in range(positives)]
+    texts += [NEGATIVE_TEMPLATES[i % 5].format(f"day{i}") for i in range(negatives)]
+    return texts, [POSITIVE_LABEL] * positives + [NEGATIVE_LABEL] * negatives
+
+
+@pytest.fixture(scope='module')
+def trained():
+    texts, labels = make_dataset(60, 240)
+    model, evaluation = train_pre_classifier(texts, labels, test_size=0.2, seed=7)
+    return texts, labels, model, evaluation
+
+
+def test_split_is_stratified_and_disjoint(trained):
+    texts, _, _, evaluation = trained
+    assert evaluation.labels.count(POSITIVE_LABEL) == 12
+    assert evaluation.labels.count(NEGATIVE_LABEL) == 48
+    assert evaluation.train_size + len(evaluation.labels) == len(texts)
+    # 留出集的样本没有参与留出模型的训练：样本各不相同，留出集内也不重复
+    assert len(set(evaluation.texts)) == len(evaluation.texts)
+
+
+def test_split_is_reproducible_with_seed(trained):
+    texts, labels, _, evaluation = trained
+    _, again = train_pre_classifier(texts, labels, test_size=0.2, seed=7)
+    assert again.texts == evaluation.texts
+
+
+def test_holdout_metrics_on_separable_data(trained):
+    _, _, _, evaluation = trained
+    report = evaluation.report(threshold=0.9)
+    assert report['samples'] == report['test_size'] == 60
+    assert report['positives'] == 12
+    assert report['train_size'] == 240
+    assert report['precision'] >= 0.9 and report['recall'] >= 0.9
+    assert report['negative_precision'] >= 0.9
+    assert 0 < report['auto_label_rate'] <= 48 / 60
+    assert report['positive_forward_recall'] >= 0.9
+
+
+def test_higher_threshold_labels_fewer_comments(trained):
+    _, _, _, evaluation = trained
+    assert evaluation.report(threshold=0.99)['auto_label_rate'] <= evaluation.report(threshold=0.6)['auto_label_rate']
+
+
+def test_evaluate_counts_on_known_predictions():
+    model = PreClassifier()
+    model.weights = np.zeros(1)
+    model.predict_negative_proba = lambda texts: np.array([0.1, 0.95, 0.95, 0.4])
+    report = model.evaluate(['a', 'b', 'c', 'd'], [POSITIVE_LABEL, NEGATIVE_LABEL, POSITIVE_LABEL, NEGATIVE_LABEL],
+                            threshold=0.9)
+    # 预测为潜在客户: a、d，其中a正确；直接标注为非目标客户: b、c，其中b正确
+    assert report['precision'] == 0.5
+    assert report['recall'] == 0.5
+    assert report['negative_precision'] == 0.5
+    assert report['auto_label_rate'] == 0.5
+    assert report['positive_forward_recall'] == 0.5
+
+
+@pytest.mark.parametrize('positives, negatives', [
+    (MIN_CLASS_SAMPLES - 1, MIN_TRAINING_SAMPLES),
+    (MIN_TRAINING_SAMPLES, MIN_CLASS_SAMPLES - 1),
+    (MIN_CLASS_SAMPLES, MIN_CLASS_SAMPLES),
+])
+def test_insufficient_training_data(positives, negatives):
+    with pytest.raises(PreClassifierError):
+        train_pre_classifier(*make_dataset(positives, negatives))
+
+
+def test_bytes_round_trip(trained):
+    texts, _, model, _ = trained
+    restored = PreClassifier.from_bytes(model.to_bytes())
+    np.testing.assert_allclose(restored.predict_negative_proba(texts), model.predict_negative_proba(texts))
+
+
+def test_from_bytes_rejects_pickle():
+    with pytest.raises(PreClassifierError):
+        PreClassifier.from_bytes(pickle.dumps({'weights': [1.0]}))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_query_plans.py
+@Software: PyCharm
+@Description: QUERY_PLAN_CHECKS 检查的语句与各方法实际执行的语句一致，并且在本地MySQL上没有全表扫描。
+              全表扫描检查需要设置 MYSQL_HOST 等环境变量指向本地测试库（会在该库上建表并执行迁移）
+"""
+import os
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from collectors.common import mysql  # noqa: E402
+
+
+class RecordingCursor:
+    """记录在游标上直接执行的SQL，查询结果始终为空"""
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchone(self):
+        return None
+
+
+class RecordingConnection:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def cursor(self):
+        return RecordingCursor(self.statements)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class RecordingDatabase(mysql.MySQLDatabase):
+    """不连接数据库，只记录方法执行的SQL"""
+
+    def __init__(self):
+        self.in_transaction = False
+        self.statements = []
+        self.connection = RecordingConnection(self.statements)
+
+    def execute_query(self, query, params=None):
+        self.statements.append(query)
+        return []
+
+    def execute_update(self, query, params=None):
+        self.statements.append(query)
+        return 0
+
+    def stream_query(self, query, params=None, chunk_size=mysql.STREAM_CHUNK_SIZE):
+        self.statements.append(query)
+        return iter(())
+
+
+# 检查项名称 -> 执行对应查询的方法
+METHOD_CALLS = {
+    "任务列表-按关键词查询任务": lambda db: db.get_tiktok_tasks_by_keyword('k'),
+    "任务列表-视频总数": lambda db: db.refresh_keyword_stats('k', ['total_videos']),
+    "任务列表-已处理视频数": lambda db: db.refresh_keyword_stats('k', ['processed_videos']),
+    "任务列表-评论数": lambda db: db.refresh_keyword_stats('k', ['comments_count']),
+    "任务列表-过滤后评论数": lambda db: db.refresh_keyword_stats('k', ['filtered_count']),
+    "任务列表-潜在客户数": lambda db: db.refresh_keyword_stats('k', ['potential_count']),
+    "任务列表-已发送消息数": lambda db: db.refresh_keyword_stats('k', ['messages_sent_count']),
+    "任务日志-按关键词查询": lambda db: db.get_tiktok_task_logs_by_keyword('k'),
+    "采集-领取过期租约视频": lambda db: db.claim_next_video(1, 'owner'),
+    "采集-领取待处理视频": lambda db: db.claim_next_video(1, 'owner'),
+    "采集-任务未完成视频数": lambda db: db.count_unfinished_task_videos(1),
+    "采集页-按关键词读取评论": lambda db: db.get_tiktok_comments_by_keyword('k'),
+    "过滤页-按关键词读取评论": lambda db: db.stream_tiktok_comments_by_keyword('k', order_by_user=True, max_id=10),
+    "过滤页-增量读取新评论": lambda db: db.stream_tiktok_comments_by_keyword('k', min_id=1, max_id=10),
+    "过滤页-增量过滤读取已保存结果": lambda db: db.stream_filtered_tiktok_comment_texts('k'),
+    "分析页-按关键词读取过滤后评论": lambda db: db.get_filtered_tiktok_comments_by_keyword('k'),
+    "分析页-潜在客户": lambda db: db.get_potential_customers('k'),
+    "触达页-处理中的消息": lambda db: db.get_worker_ip_for_processing_messages('k'),
+    "X过滤页-按关键词读取评论": lambda db: db.stream_x_comments_by_keyword('k', order_by_user=True, max_id=10),
+    "X过滤页-增量读取新评论": lambda db: db.stream_x_comments_by_keyword('k', min_id=1, max_id=10),
+    "X过滤页-增量过滤读取已保存结果": lambda db: db.stream_filtered_x_comment_texts('k'),
+    "X分析页-按关键词读取过滤后评论": lambda db: db.get_filtered_x_comments_by_keyword('k'),
+    "X分析页-潜在客户": lambda db: db.get_x_potential_customers('k'),
+    "X触达页-处理中的消息": lambda db: db.get_worker_ip_for_processing_x_messages('k'),
+}
+
+
+@pytest.mark.parametrize('name, query, param_names', mysql.QUERY_PLAN_CHECKS,
+                         ids=[check[0] for check in mysql.QUERY_PLAN_CHECKS])
+def test_checked_query_is_executed_by_method(name, query, param_names):
+    assert name in METHOD_CALLS, f"检查项 {name} 没有对应的方法"
+    db = RecordingDatabase()
+    METHOD_CALLS[name](db)
+    assert any(query in statement for statement in db.statements)
+    assert query.count('%s') == len(param_names)
+
+
+@pytest.mark.skipif(not os.environ.get('MYSQL_HOST'), reason="需要本地MySQL（设置 MYSQL_HOST 等环境变量）")
+def test_no_full_table_scans():
+    mysql.ensure_database_schema()
+    db = mysql.MySQLDatabase()
+    db.connect()
+    try:
+        assert db.check_query_plans() == []
+    finally:
+        db.disconnect()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_scroll_controller.py
+@Software: PyCharm
+@Description: 评论页自适应滚动的停止条件、等待时间和数量解析
+"""
+import pytest
+
+from collectors.scroll_controller import MAX_WAIT_SECONDS, MIN_WAIT_SECONDS, ScrollController, parse_count
+
+
+def test_stops_immediately_when_video_has_no_comments():
+    controller = ScrollController(expected_total=0)
+    assert controller.should_stop(0)
+    assert controller.stop_reason == "视频没有评论"
+
+
+def test_stops_when_coverage_target_reached():
+    controller = ScrollController(expected_total=100, coverage_target=0.98)
+    controller.record_round(97, 500, 1.0)
+    assert not controller.should_stop(97)
+    assert controller.stop_reason is None
+    controller.record_round(1, 500, 1.0)
+    assert controller.should_stop(98)
+    assert "98" in controller.stop_reason
+
+
+def test_stops_after_consecutive_idle_rounds():
+    controller = ScrollController(idle_rounds=3)
+    controller.record_round(0, 0, None)
+    controller.record_round(0, 0, None)
+    assert not controller.should_stop(10)
+    controller.record_round(0, 0, None)
+    assert controller.should_stop(10)
+    assert controller.stop_reason.startswith("连续 3 轮")
+
+
+@pytest.mark.parametrize('new_comments, height_delta', [(5, 0), (0, 300)])
+def test_new_comments_or_page_growth_reset_idle_count(new_comments, height_delta):
+    controller = ScrollController(idle_rounds=3)
+    controller.record_round(0, 0, None)
+    controller.record_round(0, 0, None)
+    controller.record_round(new_comments, height_delta, 1.0)
+    controller.record_round(0, 0, None)
+    assert controller.consecutive_idle == 1
+    assert not controller.should_stop(10)
+
+
+def test_stops_at_max_rounds():
+    controller = ScrollController(max_rounds=5)
+    for _ in range(4):
+        controller.record_round(10, 500, 1.0)
+        assert not controller.should_stop(100)
+    controller.record_round(10, 500, 1.0)
+    assert controller.should_stop(100)
+    assert controller.stop_reason == "达到最大滚动轮数 5"
+
+
+def test_unknown_total_never_stops_on_coverage():
+    controller = ScrollController(expected_total=None)
+    controller.record_round(10000, 500, 1.0)
+    assert not controller.should_stop(10000)
+
+
+def test_expected_total_can_be_updated_from_api():
+    controller = ScrollController(expected_total=None)
+    controller.update_expected_total(50)
+    controller.update_expected_total(None)
+    assert controller.expected_total == 50
+    assert controller.should_stop(49)
+
+
+def test_jumps_to_bottom_after_two_idle_rounds():
+    controller = ScrollController()
+    controller.record_round(0, 0, None)
+    assert not controller.should_jump_to_bottom()
+    controller.record_round(0, 0, None)
+    assert controller.should_jump_to_bottom()
+
+
+def test_waits_follow_observed_latency_within_bounds():
+    controller = ScrollController()
+    for _ in range(30):
+        controller.record_latency(0.01)
+    assert controller.load_timeout() == 2
+    assert controller.reply_idle_timeout() == 5
+    assert controller.next_wait() == MIN_WAIT_SECONDS
+    for _ in range(30):
+        controller.record_latency(100)
+    assert controller.load_timeout() == 10
+    assert controller.reply_idle_timeout() == 60
+    assert controller.next_wait() == MAX_WAIT_SECONDS
+
+
+def test_summary_reports_coverage():
+    controller = ScrollController(expected_total=200)
+    controller.record_round(100, 500, 1.0)
+    controller.should_stop(100)
+    assert "覆盖率 50%" in controller.summary(100)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("1,234", 1234),
+    ("1.2K", 1200),
+    ("3M", 3000000),
+    ("2.5万", 25000),
+    ("共 56 条评论", 56),
+    ("", None),
+    (None, None),
+    ("评论", None),
+])
+def test_parse_count(text, expected):
+    assert parse_count(text) == expected
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_spam_detector.py
+@Software: PyCharm
+@Description: SimHash 指纹、汉明距离和近重复索引（NearDuplicateIndex）
+"""
+import random
+
+import pytest
+
+from common.spam_detector import (NearDuplicateIndex, SIMHASH_BANDS, SIMHASH_BITS, hamming_distance,  # noqa: E402
+                                  simhash, spam_reason)
+
+
+def flip_bits(fingerprint, positions):
+    for position in positions:
+        fingerprint ^= 1 << position
+    return fingerprint
+
+
+def test_hamming_distance():
+    assert hamming_distance(0, 0) == 0
+    assert hamming_distance(0b1011, 0) == 3
+    assert hamming_distance(2 ** 64 - 1, 0) == 64
+    assert hamming_distance(0xF0F0, 0x0FF0) == 8
+
+
+@pytest.mark.parametrize('text', ['', '   ', '!!! ???', '🙂🙂🙂', None])
+def test_simhash_of_empty_text_is_none(text):
+    assert simhash(text) is None
+
+
+def test_simhash_ignores_case_and_punctuation():
+    assert simhash("Hello, World!") == simhash("hello world")
+    assert simhash("这个多少钱？") == simhash("这个多少钱")
+
+
+def test_simhash_is_stable_64_bit():
+    fingerprint = simhash("where can I buy this jacket")
+    assert fingerprint == simhash("where can I buy this jacket")
+    assert 0 <= fingerprint < 2 ** SIMHASH_BITS
+
+
+def test_simhash_near_duplicates_are_closer_than_unrelated_text():
+    base = simhash("where can I buy this jacket, it looks amazing on you")
+    edited = simhash("where can I buy this jacket, it looks amazing on you!! 😍")
+    unrelated = simhash("the sunset at the beach yesterday was beautiful")
+    assert hamming_distance(base, edited) < hamming_distance(base, unrelated)
+
+
+def test_index_returns_representative_for_near_duplicate():
+    index = NearDuplicateIndex(max_distance=3)
+    fingerprint = simhash("where can I buy this jacket")
+    assert index.add(fingerprint, 'alice') is None
+    assert index.add(flip_bits(fingerprint, [5, 40]), 'bob') == 'alice'
+    assert index.add(fingerprint ^ (2 ** 64 - 1), 'carol') is None
+    assert len(index) == 2
+
+
+def test_index_respects_max_distance():
+    index = NearDuplicateIndex(max_distance=1)
+    index.add(0, 'alice')
+    assert index.add(flip_bits(0, [3]), 'bob') == 'alice'
+    assert index.add(flip_bits(0, [3, 60]), 'carol') is None
+
+
+def test_index_finds_every_fingerprint_within_max_distance():
+    """分段索引不漏：距离不超过 max_distance 的指纹至少有一段完全相同"""
+    rng = random.Random(0)
+    index = NearDuplicateIndex(max_distance=SIMHASH_BANDS - 1)
+    representatives = [rng.getrandbits(SIMHASH_BITS) for _ in range(200)]
+    for key, fingerprint in enumerate(representatives):
+        index.add(fingerprint, key)
+    # 随机指纹之间的距离远大于3，全部成为代表
+    assert len(index) == len(representatives)
+    for key, fingerprint in enumerate(representatives):
+        positions = rng.sample(range(SIMHASH_BITS), rng.randint(0, SIMHASH_BANDS - 1))
+        assert index.add(flip_bits(fingerprint, positions), f"dup-{key}") == key
+
+
+def test_index_rejects_distance_not_below_band_count():
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(max_distance=SIMHASH_BANDS)
+
+
+@pytest.mark.parametrize('text, reason', [
+    ("", "空评论"),
+    ("看这里 https://a.example https://b.example", "链接过多"),
+    ("😂😂😂😂😂😂", "表情/符号为主"),
+    ("buy buy buy buy buy buy", "重复词刷屏"),
+    ("哈哈哈哈哈哈哈哈哈哈哈哈", "字符熵过低"),
+    ("where can I buy this jacket", None),
+])
+def test_spam_reason(text, reason):
+    assert spam_reason(text) == reason
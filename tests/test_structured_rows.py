@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_structured_rows.py
+@Software: PyCharm
+@Description: 结构化输出的逐行核对（reconcile_structured_rows）和流式行解析（IncrementalRowsParser）
+"""
+import json
+
+import pytest
+
+pytest.importorskip('openai')
+
+from common.openai import IncrementalRowsParser, reconcile_structured_rows  # noqa: E402
+
+FIELDS = {"分类结果": ["潜在客户", "非目标客户"], "分析理由": None}
+COMMENTS = [{'user_id': 'alice', 'reply_content': "多少钱"},
+            {'user_id': 'bob', 'reply_content': "哈哈哈"},
+            {'user_id': 'carol', 'reply_content': "哪里能买到"}]
+
+
+def make_row(index, user_id, label="潜在客户", reason="询问价格"):
+    return {"序号": index, "用户ID": user_id, "分类结果": label, "分析理由": reason}
+
+
+def test_reconcile_matches_rows_by_index():
+    response = json.dumps({"rows": [make_row(3, 'carol'), make_row(1, 'alice')]}, ensure_ascii=False)
+    valid, missing = reconcile_structured_rows(response, COMMENTS, FIELDS)
+    assert [(comment['user_id'], result['分类结果']) for comment, result in valid] == [('alice', "潜在客户"),
+                                                                                   ('carol', "潜在客户")]
+    assert missing == [COMMENTS[1]]
+
+
+def test_reconcile_accepts_code_fence():
+    response = "```json\n" + json.dumps({"rows": [make_row(2, 'bob', "非目标客户")]}, ensure_ascii=False) + "\n```"
+    valid, missing = reconcile_structured_rows(response, COMMENTS, FIELDS)
+    assert [comment['user_id'] for comment, _ in valid] == ['bob']
+    assert len(missing) == 2
+
+
+def test_reconcile_keeps_first_of_duplicate_indexes():
+    rows = [make_row(1, 'alice', "潜在客户", "第一次"), make_row(1, 'alice', "非目标客户", "第二次")]
+    valid, _ = reconcile_structured_rows(json.dumps({"rows": rows}, ensure_ascii=False), COMMENTS, FIELDS)
+    assert valid == [(COMMENTS[0], {"分类结果": "潜在客户", "分析理由": "第一次"})]
+
+
+@pytest.mark.parametrize('row', [
+    make_row(0, 'alice'),
+    make_row(4, 'alice'),
+    make_row("1", 'alice'),
+    make_row(1, 'bob'),                # 用户ID与序号对应的评论不一致
+    make_row(1, 'alice', "高意向客户"),  # 取值不在枚举中
+    make_row(1, 'alice', reason=" "),  # 必填字段为空
+    {"序号": 1, "用户ID": 'alice', "分类结果": "潜在客户"},  # 缺少字段
+    ["不是对象"],
+])
+def test_reconcile_rejects_invalid_rows(row):
+    valid, missing = reconcile_structured_rows(json.dumps({"rows": [row]}, ensure_ascii=False), COMMENTS, FIELDS)
+    assert valid == []
+    assert missing == COMMENTS
+
+
+@pytest.mark.parametrize('response', ['', '不是JSON', '[1, 2]', '{"rows": {"序号": 1}}', None])
+def test_reconcile_treats_unparseable_response_as_all_missing(response):
+    assert reconcile_structured_rows(response, COMMENTS, FIELDS) == ([], COMMENTS)
+
+
+def test_reconcile_strips_user_id_whitespace():
+    valid, _ = reconcile_structured_rows(json.dumps({"rows": [make_row(2, ' bob ')]}), COMMENTS, FIELDS)
+    assert [comment['user_id'] for comment, _ in valid] == ['bob']
+
+
+ROWS_WITH_SPECIAL_CHARS = [
+    make_row(1, 'alice', reason='包含 "引号" 和 {花括号} 以及 [方括号]'),
+    make_row(2, 'bob', "非目标客户", reason='反斜杠结尾\\'),
+    make_row(3, 'carol', reason='转义 \\" 后仍在字符串中 }]'),
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 10000])
+def test_incremental_parser_handles_split_chunks(chunk_size):
+    text = json.dumps({"rows": ROWS_WITH_SPECIAL_CHARS}, ensure_ascii=False)
+    parser = IncrementalRowsParser()
+    rows = []
+    for start in range(0, len(text), chunk_size):
+        rows.extend(parser.feed(text[start:start + chunk_size]))
+    assert rows == ROWS_WITH_SPECIAL_CHARS
+
+
+def test_incremental_parser_emits_rows_as_soon_as_they_close():
+    text = json.dumps({"rows": ROWS_WITH_SPECIAL_CHARS[:2]}, ensure_ascii=False)
+    first_end = text.index('}, {') + 1  # 第一行对象的结尾（字符串中的花括号不算）
+    parser = IncrementalRowsParser()
+    assert parser.feed(text[:first_end - 1]) == []
+    assert parser.feed(text[first_end - 1:first_end]) == [ROWS_WITH_SPECIAL_CHARS[0]]
+    assert parser.feed(text[first_end:]) == [ROWS_WITH_SPECIAL_CHARS[1]]
+
+
+def test_incremental_parser_keeps_nested_values_in_row():
+    row = {"序号": 1, "用户ID": "alice", "附加": {"标签": ["a", "b"]}}
+    assert IncrementalRowsParser().feed(json.dumps({"rows": [row]}, ensure_ascii=False)) == [row]
+
+
+def test_incremental_parser_reset_discards_partial_row():
+    parser = IncrementalRowsParser()
+    parser.feed('{"rows": [{"序号": 1, "用户ID": "al')
+    parser.reset()
+    text = json.dumps({"rows": [make_row(2, 'bob')]}, ensure_ascii=False)
+    assert parser.feed(text) == [make_row(2, 'bob')]
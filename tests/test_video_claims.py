@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : test_video_claims.py
+@Software: PyCharm
+@Description: 两个会话并发领取同一任务的视频时领到不同的行（SELECT ... FOR UPDATE SKIP LOCKED），
+              过期租约优先于待处理视频。需要设置 MYSQL_HOST 等环境变量指向本地测试库
+"""
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from collectors.common import mysql  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not os.environ.get('MYSQL_HOST'),
+                                reason="需要本地MySQL（设置 MYSQL_HOST 等环境变量）")
+
+
+@pytest.fixture
+def sessions():
+    """两个独立连接的会话和一个带3个待处理视频的任务"""
+    mysql.ensure_database_schema()
+    first, second = mysql.MySQLDatabase(), mysql.MySQLDatabase()
+    first.connect()
+    second.connect()
+    keyword = f"claim-test-{uuid.uuid4().hex[:8]}"
+    task_id = first.create_tiktok_task(keyword)
+    first.add_tiktok_videos_batch(task_id, [f"https://example.com/{keyword}/{index}" for index in range(3)], keyword)
+    yield first, second, task_id
+    second.connection.rollback()
+    first.connection.rollback()
+    first.execute_update("DELETE FROM tiktok_videos WHERE task_id = %s", (task_id,))
+    first.execute_update("DELETE FROM tiktok_tasks WHERE id = %s", (task_id,))
+    first.execute_update("DELETE FROM keyword_stats WHERE keyword = %s", (keyword,))
+    first.disconnect()
+    second.disconnect()
+
+
+def test_locked_row_is_skipped_by_other_session(sessions):
+    first, second, task_id = sessions
+    # 第一个会话在未提交的事务中锁住第一个待处理视频
+    with first.connection.cursor() as cursor:
+        cursor.execute(mysql.CLAIM_PENDING_VIDEO_QUERY, (task_id,))
+        locked = cursor.fetchone()
+
+    claimed = second.claim_next_video(task_id, 'second')
+    assert claimed is not None and claimed['id'] != locked['id']
+    first.connection.rollback()
+
+    claimed_again = first.claim_next_video(task_id, 'first')
+    assert claimed_again['id'] == locked['id']
+
+
+def test_sessions_claim_different_rows_until_exhausted(sessions):
+    first, second, task_id = sessions
+    claimed = [first.claim_next_video(task_id, 'first'), second.claim_next_video(task_id, 'second'),
+               first.claim_next_video(task_id, 'first')]
+    assert len({video['id'] for video in claimed}) == 3
+    assert second.claim_next_video(task_id, 'second') is None
+
+
+def test_expired_lease_is_claimed_before_pending_rows(sessions):
+    first, second, task_id = sessions
+    video = first.claim_next_video(task_id, 'first')
+    first.execute_update("UPDATE tiktok_videos SET lease_expires_at = NOW() - INTERVAL 1 SECOND WHERE id = %s",
+                         (video['id'],))
+
+    reclaimed = second.claim_next_video(task_id, 'second')
+    assert reclaimed['id'] == video['id'] and reclaimed['reclaimed']
+    assert not first.extend_video_lease(video['id'], 'first')